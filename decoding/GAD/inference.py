@@ -130,20 +130,35 @@ def forward_decoder(model, input_tokens, encoder_out, incremental_state=None,
                                         parallel_forward_start_pos=parallel_forward_start_pos)
     decoder_out_tuple = (decoder_out[0].div_(temperature), decoder_out[1])
     topk_scores, indexes = torch.topk(decoder_out_tuple[0], beta, dim=-1)
-    topk_scores_list = topk_scores.tolist()
-    indexes_list = indexes.tolist()
-    for i in range(indexes.size(0)):
-        for j in range(indexes.size(1)):
-            for k, s in enumerate(topk_scores_list[i][j]):
-                if topk_scores_list[i][j][0] - s > tau:
-                    indexes_list[i][j][k] = -1
-    return indexes_list
+    # candidates more than tau below the top-1 score are excluded
+    return indexes.masked_fill(topk_scores[:, :, :1] - topk_scores > tau, -1)
+
+
+def align_incremental_state(incremental_state, encoder_state_ids, new_order, index, padding_mask):
+    # keep the rows in new_order and move the cached keys / values of each row to the right end,
+    # the self-attention cache of row i becomes old[i, :, index[i]] with padding_mask marking the empty slots
+    for n in incremental_state:
+        is_encoder_state = n[: n.index('.')] in encoder_state_ids
+        for k in incremental_state[n]:
+            state = incremental_state[n][k]
+            if state is None:
+                continue
+            state = state.index_select(0, new_order)
+            if not is_encoder_state and state.dim() == 4:
+                state = state.gather(2, index[:, None, :, None].expand(-1, state.size(1), -1, state.size(3)))
+            incremental_state[n][k] = state
+        if not is_encoder_state:
+            incremental_state[n]['prev_key_padding_mask'] = padding_mask
 
 
+@torch.no_grad()
 def gad_generate(data_lines, model, AR_model, task, block_size, batch_size, device, beta=1, tau=0, max_len=200):
     # Generalized Aggressive Decoding
     src_dict = task.source_dictionary
     tgt_dict = task.target_dictionary
+    encoder_state_ids = []
+    for i in range(len(AR_model.decoder.layers)):
+        encoder_state_ids.append(AR_model.decoder.layers[i].encoder_attn._incremental_state_id)
     data_size = len(data_lines)
     all_results = []
     logger.info(f'GAD generate')
@@ -160,22 +175,40 @@ def gad_generate(data_lines, model, AR_model, task, block_size, batch_size, devi
         net_input = batch['net_input']
         AR_encoder_out = AR_model.encoder.forward(net_input['src_tokens'], net_input['src_lengths'])
         encoder_out = model.encoder.forward(net_input['src_tokens'], net_input['src_lengths'])
-        sentences = [[tgt_dict.eos()] for _ in range(batch_size)]
-        prev_output_tokens = [[tgt_dict.unk()] * block_size for _ in range(batch_size)]
-        start_pos_list = [0] * batch_size
-        finish_list = []
+        incremental_state = torch.jit.annotate(Dict[str, Dict[str, Optional[Tensor]]],
+                                               torch.jit.annotate(Dict[str, Dict[str, Optional[Tensor]]], {}))
+        # accepted tokens, then the block to draft, room for the longest output and one more block
+        width = max_len + 2 * block_size + 1
+        output_tokens = torch.full((batch_size, width), tgt_dict.pad()).to(device)
+        output_tokens[:, :block_size] = tgt_dict.unk()
+        start_pos = torch.zeros(batch_size).long().to(device)
+        max_start_pos = 0
+        # finished sentences, unfinished ones are left as an empty output
+        sentences = torch.full((batch_size, width), tgt_dict.eos()).to(device)
+        sent_lens = torch.ones(batch_size).long().to(device)
+        sent_ids = list(range(batch_size))
         for step in range(0, max_len):
-            prev_output_tokens, start_pos_list = gad_forward(start_pos_list, block_size, batch_size,
-                                                             tgt_dict, prev_output_tokens,
-                                                             encoder_out, AR_encoder_out, model, AR_model, beta, tau)
-            for i, start_pos in enumerate(start_pos_list):
-                if i not in finish_list:
-                    if start_pos == -1:
-                        finish_list.append(i)
-                        sentences[i] = prev_output_tokens[i]
-
-            if len(finish_list) == batch_size:
+            output_tokens, start_pos, end_pos, finished, max_start_pos = gad_forward(
+                incremental_state, encoder_state_ids, output_tokens, start_pos, max_start_pos, block_size, tgt_dict,
+                encoder_out, AR_encoder_out, model, AR_model, beta, tau, max_len=max_len)
+            if not any(finished):
+                continue
+            done = [i for i, f in enumerate(finished) if f]
+            done_order = torch.tensor(done).to(device)
+            done_ids = torch.tensor([sent_ids[i] for i in done]).to(device)
+            sentences.index_copy_(0, done_ids, output_tokens.index_select(0, done_order))
+            sent_lens.index_copy_(0, done_ids, end_pos.index_select(0, done_order))
+
+            keep = [i for i, f in enumerate(finished) if not f]
+            if len(keep) == 0:
                 break
+            new_order = torch.tensor(keep).to(device)
+            encoder_out = model.encoder.reorder_encoder_out(encoder_out, new_order)
+            AR_encoder_out = AR_model.encoder.reorder_encoder_out(AR_encoder_out, new_order)
+            output_tokens = output_tokens.index_select(0, new_order)
+            start_pos = start_pos.index_select(0, new_order)
+            sent_ids = [sent_ids[i] for i in keep]
+        sentences = [s[:l] for s, l in zip(sentences.tolist(), sent_lens.tolist())]
         batch_sents = [y for x, y in sorted(zip(batch['id'].cpu().tolist(), sentences))]
         for s in batch_sents:
             all_results.append(tgt_dict.string(s))
@@ -184,55 +217,63 @@ def gad_generate(data_lines, model, AR_model, task, block_size, batch_size, devi
     return remove_bpe_results, delta
 
 
-def gad_forward(start_pos_list, block_size, batch_size, tgt_dict, prev_output_tokens,
+def gad_forward(incremental_state, encoder_state_ids, output_tokens, start_pos, max_start_pos, block_size, tgt_dict,
                 encoder_out, AR_encoder_out, model, AR_model, beta, tau, max_len=200):
-    pad_tokens = [[tgt_dict.pad()] * (max_len + block_size) for _ in range(batch_size)]
-    for i in range(batch_size):
-        pad_tokens[i][:len(prev_output_tokens[i])] = prev_output_tokens[i]
-    output_tokens = torch.tensor(pad_tokens).to(device)
-    output_tokens = output_tokens[:, : output_tokens.ne(tgt_dict.pad()).sum(1).max()]
-
-    _, tensor_tokens = model.decoder(
-        normalize=False,
-        prev_output_tokens=output_tokens,
-        encoder_out=encoder_out,
-    ).max(-1)
-
-    _tokens = tensor_tokens.tolist()
-    for i, start_pos in enumerate(start_pos_list):
-        if start_pos_list[i] != -1:
-            output_tokens[i, start_pos:start_pos + block_size] = tensor_tokens[i, start_pos:start_pos + block_size]
-            prev_output_tokens[i][start_pos:start_pos + block_size] = _tokens[i][start_pos:start_pos + block_size]
-
-    append_eos = torch.tensor([[tgt_dict.eos()] for _ in range(batch_size)]).to(device)
-    cur_span_input_tokens = torch.cat((append_eos, output_tokens), dim=-1)
-
-    AR_verify_tokens = forward_decoder(AR_model, cur_span_input_tokens, AR_encoder_out, beta=beta, tau=tau)
-
-    next_output_tokens = prev_output_tokens.copy()
-    for i in range(batch_size):
-        if start_pos_list[i] != -1:
-            bifurcation = block_size
-            for j, (token, AR_verify_token) in enumerate(
-                    zip(prev_output_tokens[i][start_pos_list[i]:], AR_verify_tokens[i][start_pos_list[i]:-1])):
-                if token not in AR_verify_token:
-                    bifurcation = j
-                    break
-            next_output_tokens[i] = prev_output_tokens[i][:start_pos_list[i] + bifurcation] + \
-                                    [AR_verify_tokens[i][start_pos_list[i] + bifurcation][0]] + \
-                                    [tgt_dict.unk()] * block_size
-
-            find_eos = False
-            for j, o in enumerate(next_output_tokens[i][start_pos_list[i]:start_pos_list[i] + bifurcation + 1]):
-                if o == tgt_dict.eos() or start_pos_list[i] + j == max_len:
-                    next_output_tokens[i] = next_output_tokens[i][:start_pos_list[i] + j]
-                    start_pos_list[i] = -1
-                    find_eos = True
-                    break
-            if not find_eos:
-                start_pos_list[i] = start_pos_list[i] + bifurcation + 1
-
-    return next_output_tokens, start_pos_list
+    # output_tokens holds the accepted tokens of each sentence up to start_pos followed by [unk] * block_size,
+    # all bookkeeping stays on the device, the only host sync is the finished mask at the end
+    batch_size = output_tokens.size(0)
+    block_pos = start_pos[:, None] + torch.arange(block_size).to(start_pos)
+
+    # the drafter sees the whole prefix, but only the block positions go through the output projection
+    features, _ = model.decoder.extract_features(output_tokens[:, :max_start_pos + block_size], encoder_out=encoder_out,
+                                                 embedding_copy=model.decoder.src_embedding_copy)
+    features = features.gather(1, block_pos[:, :, None].expand(-1, -1, features.size(2)))
+    draft_tokens = model.decoder.output_layer(features).argmax(-1)
+    output_tokens.scatter_(1, block_pos, draft_tokens)
+
+    # the AR verifier only runs on the last accepted token and the drafted block, the sentences are left padded
+    # so that the block starts at the same column, which is the length of the cached keys / values
+    offset = max_start_pos - start_pos
+    cols = torch.arange(max_start_pos + block_size + 1).to(start_pos)[None, :]
+    src_cols = cols - offset[:, None] - 1
+    cur_span_input_tokens = output_tokens.gather(1, src_cols.clamp(min=0))
+    cur_span_input_tokens.masked_fill_(src_cols == -1, tgt_dict.eos())
+    cur_span_input_tokens.masked_fill_(src_cols < -1, tgt_dict.pad())
+    AR_verify_tokens = forward_decoder(AR_model, cur_span_input_tokens, AR_encoder_out, incremental_state,
+                                       parallel_forward_start_pos=max_start_pos, beta=beta, tau=tau)
+
+    # accept the longest prefix of the block within the verifier's top-beta, then the verifier's top-1 token
+    accepted = (draft_tokens[:, :, None] == AR_verify_tokens[:, :-1]).any(-1)
+    bifurcation = accepted.long().cumprod(1).sum(1)
+    AR_token = AR_verify_tokens[:, :, 0].gather(1, bifurcation[:, None])
+    cols = torch.arange(2 * block_size + 1).to(start_pos)[None, :]
+    span = torch.cat([draft_tokens, torch.full_like(draft_tokens, tgt_dict.unk()), AR_token], dim=1)
+    span = torch.where(cols == bifurcation[:, None], AR_token, span)
+    span = torch.where((cols > bifurcation[:, None]) & (cols <= bifurcation[:, None] + block_size),
+                       torch.full_like(span, tgt_dict.unk()), span)
+    span.masked_fill_(cols > bifurcation[:, None] + block_size, tgt_dict.pad())
+    output_tokens.scatter_(1, start_pos[:, None] + cols, span)
+
+    # a sentence ends before the first accepted eos, or at max_len
+    is_end = (span.eq(tgt_dict.eos()) | (start_pos[:, None] + cols == max_len)) & (cols <= bifurcation[:, None])
+    finished = is_end.any(1)
+    end_pos = start_pos + is_end.long().argmax(1)
+    next_start_pos = start_pos + bifurcation + 1
+
+    status = torch.cat([finished.long(), next_start_pos.masked_fill(finished, 0).max()[None]]).tolist()
+    finished, next_max_start_pos = status[:-1], status[-1]
+
+    # roll the cache back to the accepted draft tokens, the AR token is fed in the next step
+    keep = [i for i, f in enumerate(finished) if not f]
+    if keep:
+        new_order = torch.tensor(keep).to(device)
+        keep_len = next_start_pos.index_select(0, new_order)
+        pad_len = (next_max_start_pos - keep_len)[:, None]
+        cols = torch.arange(next_max_start_pos).to(start_pos)[None, :]
+        index = (cols - pad_len + offset.index_select(0, new_order)[:, None]).clamp(min=0)
+        align_incremental_state(incremental_state, encoder_state_ids, new_order, index, cols < pad_len)
+
+    return output_tokens, next_start_pos, end_pos, finished, next_max_start_pos
 
 
 if __name__ == '__main__':
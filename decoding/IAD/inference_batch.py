@@ -158,6 +158,16 @@ def find_hash_sets(hash_set, tokens, min_gram=1, max_gram=3):
     return -1
 
 
+def find_wrong_pos(input_tokens, pred_tokens, start_pos):
+    """first position at or after start_pos where the prediction differs from the next input token,
+    counted from start_pos, -1 if start_pos is beyond the input"""
+    seq_len = input_tokens.size(1)
+    mismatch = torch.cat([input_tokens[:, 1:].ne(pred_tokens[:, :-1]),
+                          input_tokens.new_ones(input_tokens.size(0), 1).bool()], dim=1)
+    mismatch &= torch.arange(seq_len).to(start_pos)[None, :] >= start_pos[:, None]
+    return torch.where(start_pos < seq_len, mismatch.long().argmax(1) - start_pos, torch.full_like(start_pos, -1))
+
+
 def cut_incremental_state(incremental_state, keep_len, encoder_state_ids):
     for n in incremental_state:
         if n[: n.index('.')] in encoder_state_ids:
@@ -214,19 +224,17 @@ def aggressive_generate(data_lines, model, task, batch_size, device, max_len=200
                     pad_tokens[i][:index] = batch_tokens[i][:index]
                 cur_span_input_tokens = torch.tensor(pad_tokens).to(device)
                 cur_span_input_tokens = cur_span_input_tokens[:, : cur_span_input_tokens.ne(tgt_dict.pad()).sum(1).max()]
-            input_tokens_add = [t[1:] + [-1] for t in cur_span_input_tokens.cpu().tolist()]
             pred_tensor = forward_decoder(model, cur_span_input_tokens, encoder_out)
-            pred_tokens = pred_tensor.cpu().tolist()
-            if batch_size == 1:
-                pred_tokens = [pred_tokens]
-            for i, (input_token_add, pred_token) in enumerate(zip(input_tokens_add, pred_tokens)):
+            pred_tensor = pred_tensor.view(cur_span_input_tokens.size())
+            wrong_pos_tensor = find_wrong_pos(cur_span_input_tokens, pred_tensor, torch.tensor(start_list).to(device))
+            # a single transfer of the predictions and the first wrong positions
+            pred_tokens = torch.cat([pred_tensor, wrong_pos_tensor[:, None]], dim=1).cpu().tolist()
+            for i, pred_token in enumerate(pred_tokens):
                 if i not in finish_list:
-                    # wrong pos is based on the src sent
-                    wrong_pos = len(batch_src_lines[i][src_pos_list[i]:])
-                    for j, (inp, pred) in enumerate(zip(input_token_add[start_list[i]:], pred_token[start_list[i]:])):
-                        if inp != pred:
-                            wrong_pos = j
-                            break
+                    wrong_pos = pred_token.pop()
+                    if wrong_pos == -1:
+                        # wrong pos is based on the src sent
+                        wrong_pos = len(batch_src_lines[i][src_pos_list[i]:])
                     if step == 0:
                         src_pos_list[i] += wrong_pos
                         batch_tokens[i].extend(pred_token[start_list[i]: start_list[i] + wrong_pos])
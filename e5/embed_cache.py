@@ -0,0 +1,122 @@
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+
+from typing import List, Callable, Dict
+from transformers import AutoConfig
+
+from utils import logger
+
+
+def _resolve_hub_weights(model_name_or_path: str) -> List[str]:
+    # for transformers versions without `_commit_hash`, such as 4.15.0
+    from transformers.file_utils import WEIGHTS_NAME, cached_path, hf_bucket_url
+    return [cached_path(hf_bucket_url(model_name_or_path, filename=WEIGHTS_NAME))]
+
+
+def get_checkpoint_hash(model_name_or_path: str) -> str:
+    # hash the weights of a local checkpoint, the full name and resolved revision of hub models
+    if os.path.isdir(model_name_or_path):
+        hasher = hashlib.sha1(os.path.basename(model_name_or_path.rstrip('/')).encode('utf-8'))
+        weight_paths = sorted(glob.glob(os.path.join(model_name_or_path, '*.bin'))
+                              + glob.glob(os.path.join(model_name_or_path, '*.safetensors')))
+    else:
+        revision = getattr(AutoConfig.from_pretrained(model_name_or_path), '_commit_hash', None)
+        if revision:
+            return hashlib.sha1('{}@{}'.format(model_name_or_path, revision).encode('utf-8')).hexdigest()
+        # no revision available, hash the weights as resolved in the local cache instead
+        hasher = hashlib.sha1(model_name_or_path.encode('utf-8'))
+        weight_paths = _resolve_hub_weights(model_name_or_path)
+
+    for path in weight_paths:
+        with open(path, 'rb') as reader:
+            for chunk in iter(lambda: reader.read(1 << 24), b''):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _text_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+class EmbeddingCache:
+    """ Content-addressed cache of text embeddings, one directory per (checkpoint, pool_type, max_length).
+    Texts are hashed after the prompt is prepended, so different prompts never collide.
+
+    Layout: keys.bin (16-byte text hashes), vectors.bin (raw row-major matrix) and
+    header.json, which is rewritten after the data of each append is on disk.
+    """
+
+    def __init__(self, cache_dir: str, model_name_or_path: str, pool_type: str, max_length: int = 512):
+        key = hashlib.sha1('{}_{}_{}'.format(get_checkpoint_hash(model_name_or_path),
+                                             pool_type, max_length).encode('utf-8')).hexdigest()[:16]
+        self.cache_dir = os.path.join(cache_dir, key)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        header_path = os.path.join(self.cache_dir, 'header.json')
+        self.header = json.load(open(header_path, 'r', encoding='utf-8')) if os.path.exists(header_path) else {}
+        num_rows = self.header.get('num_rows', 0)
+
+        self.hash_to_row: Dict[bytes, int] = {}
+        if num_rows > 0:
+            with open(os.path.join(self.cache_dir, 'keys.bin'), 'rb') as reader:
+                keys = reader.read(num_rows * 16)
+            self.hash_to_row = {keys[idx * 16:(idx + 1) * 16]: idx for idx in range(num_rows)}
+        # drop rows of an interrupted append
+        for name, row_bytes in [('keys.bin', 16), ('vectors.bin', self._row_bytes())]:
+            path = os.path.join(self.cache_dir, name)
+            if os.path.exists(path):
+                os.truncate(path, num_rows * row_bytes)
+
+        logger.info('Embedding cache {} has {} entries'.format(self.cache_dir, num_rows))
+
+    def _row_bytes(self) -> int:
+        if not self.header:
+            return 0
+        return self.header['dim'] * np.dtype(self.header['dtype']).itemsize
+
+    def __len__(self):
+        return len(self.hash_to_row)
+
+    def _vectors(self) -> np.ndarray:
+        return np.memmap(os.path.join(self.cache_dir, 'vectors.bin'), dtype=self.header['dtype'],
+                         mode='r', shape=(self.header['num_rows'], self.header['dim']))
+
+    def _append(self, hashes: List[bytes], embeds: np.ndarray):
+        if not self.header:
+            self.header = {'dim': embeds.shape[1], 'dtype': embeds.dtype.name, 'num_rows': 0}
+        embeds = np.ascontiguousarray(embeds, dtype=self.header['dtype'])
+
+        for name, data in [('keys.bin', b''.join(hashes)), ('vectors.bin', embeds.tobytes())]:
+            with open(os.path.join(self.cache_dir, name), 'ab') as writer:
+                writer.write(data)
+                writer.flush()
+                os.fsync(writer.fileno())
+
+        for text_hash in hashes:
+            self.hash_to_row[text_hash] = len(self.hash_to_row)
+        self.header['num_rows'] = len(self.hash_to_row)
+        tmp_path = os.path.join(self.cache_dir, 'header.json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as writer:
+            json.dump(self.header, writer)
+        os.replace(tmp_path, os.path.join(self.cache_dir, 'header.json'))
+
+    def encode(self, input_texts: List[str], encode_func: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """ Returns embeddings for `input_texts`, only texts not in the cache are passed to `encode_func`. """
+        hashes = [_text_hash(text) for text in input_texts]
+
+        miss_hash_to_idx: Dict[bytes, int] = {}
+        for idx, text_hash in enumerate(hashes):
+            if text_hash not in self.hash_to_row and text_hash not in miss_hash_to_idx:
+                miss_hash_to_idx[text_hash] = idx
+        logger.info('Embedding cache: {} hits, {} misses'.format(
+            len(input_texts) - len(miss_hash_to_idx), len(miss_hash_to_idx)))
+
+        if miss_hash_to_idx:
+            miss_embeds = encode_func([input_texts[idx] for idx in miss_hash_to_idx.values()])
+            self._append(list(miss_hash_to_idx.keys()), miss_embeds)
+
+        rows = np.array([self.hash_to_row[text_hash] for text_hash in hashes], dtype=np.int64)
+        return np.asarray(self._vectors()[rows])
@@ -1,19 +1,15 @@
 import os
 import json
-import tqdm
 import numpy as np
 import torch
 import argparse
 
-from datasets import Dataset
 from typing import List, Dict
-from functools import partial
-from transformers import AutoModel, AutoTokenizer, PreTrainedTokenizerFast, BatchEncoding, DataCollatorWithPadding
-from transformers.modeling_outputs import BaseModelOutput
-from torch.utils.data import DataLoader
+from transformers import AutoModel, AutoTokenizer
 from mteb import MTEB, AbsTaskRetrieval, DRESModel
 
-from utils import pool, logger, move_to_cuda
+from utils import logger, encode_sorted_by_length
+from embed_cache import EmbeddingCache
 
 parser = argparse.ArgumentParser(description='evaluation for BEIR benchmark')
 parser.add_argument('--model-name-or-path', default='bert-base-uncased',
@@ -22,6 +18,8 @@ parser.add_argument('--output-dir', default='tmp-outputs/',
                     type=str, metavar='N', help='output directory')
 parser.add_argument('--doc-as-query', action='store_true', help='use query prefix for passages')
 parser.add_argument('--pool-type', default='avg', help='pool type')
+parser.add_argument('--max-tokens', default=65536, type=int, help='max number of padded tokens per batch per gpu')
+parser.add_argument('--cache-dir', default='', type=str, help='directory to cache embeddings across runs')
 
 
 args = parser.parse_args()
@@ -31,15 +29,6 @@ assert args.output_dir, 'output_dir should be set'
 os.makedirs(args.output_dir, exist_ok=True)
 
 
-def _transform_func(tokenizer: PreTrainedTokenizerFast,
-                    examples: Dict[str, List]) -> BatchEncoding:
-    return tokenizer(examples['contents'],
-                     max_length=512,
-                     padding=True,
-                     return_token_type_ids=False,
-                     truncation=True)
-
-
 class RetrievalModel(DRESModel):
     # Refer to the code of DRESModel for the methods to overwrite
     def __init__(self, **kwargs):
@@ -52,6 +41,8 @@ class RetrievalModel(DRESModel):
         self.encoder.cuda()
         self.encoder.eval()
 
+        self.cache = EmbeddingCache(args.cache_dir, args.model_name_or_path, args.pool_type) if args.cache_dir else None
+
     def encode_queries(self, queries: List[str], **kwargs) -> np.ndarray:
         input_texts = ['query: {}'.format(q) for q in queries]
         return self._do_encode(input_texts)
@@ -64,31 +55,17 @@ class RetrievalModel(DRESModel):
         input_texts = ['passage: {}'.format(t) for t in input_texts]
         return self._do_encode(input_texts)
 
-    @torch.no_grad()
     def _do_encode(self, input_texts: List[str]) -> np.ndarray:
-        dataset: Dataset = Dataset.from_dict({'contents': input_texts})
-        dataset.set_transform(partial(_transform_func, self.tokenizer))
-
-        data_collator = DataCollatorWithPadding(self.tokenizer, pad_to_multiple_of=8)
-        data_loader = DataLoader(
-            dataset,
-            batch_size=128 * self.gpu_count,
-            shuffle=False,
-            drop_last=False,
-            num_workers=4,
-            collate_fn=data_collator,
-            pin_memory=True)
-
-        encoded_embeds = []
-        for batch_dict in tqdm.tqdm(data_loader, desc='encoding', mininterval=10):
-            batch_dict = move_to_cuda(batch_dict)
-
-            with torch.cuda.amp.autocast():
-                outputs: BaseModelOutput = self.encoder(**batch_dict)
-                embeds = pool(outputs.last_hidden_state, batch_dict['attention_mask'], args.pool_type)
-                encoded_embeds.append(embeds.cpu().numpy())
-
-        return np.concatenate(encoded_embeds, axis=0)
+        if self.cache is not None:
+            return self.cache.encode(input_texts, self._encode_uncached)
+        return self._encode_uncached(input_texts)
+
+    def _encode_uncached(self, input_texts: List[str]) -> np.ndarray:
+        return encode_sorted_by_length(self.encoder, self.tokenizer, input_texts,
+                                       pool_type=args.pool_type,
+                                       max_tokens=args.max_tokens * max(1, self.gpu_count),
+                                       num_workers=4,
+                                       return_token_type_ids=False)
 
 
 def main():
@@ -1,20 +1,15 @@
 import os
 import torch
-import torch.nn.functional as F
-import tqdm
 import json
 import numpy as np
 import argparse
 
-from functools import partial
-from torch.utils.data import DataLoader
-from datasets import Dataset
-from transformers import AutoModel, AutoTokenizer, DataCollatorWithPadding, PreTrainedTokenizerFast, BatchEncoding
-from transformers.modeling_outputs import BaseModelOutput
-from typing import List, Dict
+from transformers import AutoModel, AutoTokenizer
+from typing import List
 from mteb import MTEB
 
-from utils import logger, pool, move_to_cuda
+from utils import logger, encode_sorted_by_length, l2_normalize
+from embed_cache import EmbeddingCache
 
 parser = argparse.ArgumentParser(description='evaluation for MTEB benchmark except its Retrieval category')
 parser.add_argument('--task-types', nargs='+', default=[], help='task types to evaluate')
@@ -26,6 +21,8 @@ parser.add_argument('--l2-normalize', action='store_true', help='whether to l2 n
 parser.add_argument('--pool-type', default='avg', help='pool type')
 parser.add_argument('--prompt', default='query: ', help='prompt')
 parser.add_argument('--multilingual', action='store_true', help='whether to use multilingual model')
+parser.add_argument('--max-tokens', default=65536, type=int, help='max number of padded tokens per batch per gpu')
+parser.add_argument('--cache-dir', default='', type=str, help='directory to cache embeddings across runs')
 
 args = parser.parse_args()
 logger.info('Args: {}'.format(json.dumps(args.__dict__, ensure_ascii=False, indent=4)))
@@ -34,18 +31,6 @@ assert args.output_dir, 'output_dir should be specified'
 os.makedirs(args.output_dir, exist_ok=True)
 
 
-def _transform_func(tokenizer: PreTrainedTokenizerFast,
-                    examples: Dict[str, List]) -> BatchEncoding:
-    if args.prompt:
-        examples['input_texts'] = [args.prompt + t for t in examples['input_texts']]
-    batch_dict = tokenizer(examples['input_texts'],
-                           max_length=512,
-                           padding=True,
-                           truncation=True)
-
-    return batch_dict
-
-
 class DenseEncoder(torch.nn.Module):
     def __init__(self, **kwargs):
         super().__init__()
@@ -59,6 +44,8 @@ class DenseEncoder(torch.nn.Module):
         if self.gpu_count > 1:
             self.encoder = torch.nn.DataParallel(self.encoder)
 
+        self.cache = EmbeddingCache(args.cache_dir, args.model_name_or_path, args.pool_type) if args.cache_dir else None
+
     @torch.no_grad()
     def encode(self, sentences, **kwargs) -> np.ndarray:
         """ Returns a list of embeddings for the given sentences.
@@ -70,31 +57,21 @@ class DenseEncoder(torch.nn.Module):
             `List[np.ndarray]` or `List[tensor]`: List of embeddings for the given sentences
         """
 
-        dataset: Dataset = Dataset.from_dict({'input_texts': sentences})
-        dataset.set_transform(partial(_transform_func, self.tokenizer))
-
-        data_collator = DataCollatorWithPadding(self.tokenizer, pad_to_multiple_of=8)
-        data_loader = DataLoader(
-            dataset,
-            batch_size=128 * self.gpu_count,
-            shuffle=False,
-            drop_last=False,
-            num_workers=2,
-            collate_fn=data_collator,
-            pin_memory=True)
-
-        encoded_embeds = []
-        for batch_dict in tqdm.tqdm(data_loader, desc='encoding', mininterval=10, disable=len(sentences) < 128):
-            batch_dict = move_to_cuda(batch_dict)
-
-            with torch.cuda.amp.autocast():
-                outputs: BaseModelOutput = self.encoder(**batch_dict)
-                embeds = pool(outputs.last_hidden_state, batch_dict['attention_mask'], args.pool_type)
-                if args.l2_normalize:
-                    embeds = F.normalize(embeds, p=2, dim=-1)
-                encoded_embeds.append(embeds.cpu().numpy())
-
-        return np.concatenate(encoded_embeds, axis=0)
+        input_texts = [args.prompt + t for t in sentences] if args.prompt else list(sentences)
+        if self.cache is not None:
+            embeds = self.cache.encode(input_texts, self._do_encode)
+        else:
+            embeds = self._do_encode(input_texts)
+
+        # applied after caching, so that sweeping --l2-normalize reuses the cache
+        if args.l2_normalize:
+            embeds = l2_normalize(embeds)
+        return embeds
+
+    def _do_encode(self, input_texts: List[str]) -> np.ndarray:
+        return encode_sorted_by_length(self.encoder, self.tokenizer, input_texts,
+                                       pool_type=args.pool_type,
+                                       max_tokens=args.max_tokens * max(1, self.gpu_count))
 
 
 def main():
@@ -1,8 +1,13 @@
+import tqdm
 import torch
 import logging
+import numpy as np
 
 from torch import Tensor
-from typing import Mapping
+from functools import partial
+from torch.utils.data import DataLoader
+from transformers import PreTrainedTokenizerFast, BatchEncoding
+from typing import Mapping, List, Tuple
 
 
 def _setup_logger():
@@ -54,3 +59,119 @@ def pool(last_hidden_states: Tensor,
         raise ValueError(f"pool_type {pool_type} not supported")
 
     return emb
+
+
+def l2_normalize(embeds: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeds.astype(np.float32), axis=-1, keepdims=True)
+    return (embeds.astype(np.float32) / np.maximum(norms, 1e-12)).astype(embeds.dtype)
+
+
+def tokenize_to_flat_ids(tokenizer: PreTrainedTokenizerFast,
+                         input_texts: List[str],
+                         max_length: int = 512,
+                         chunk_size: int = 10000,
+                         **tokenizer_kwargs) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """ Tokenizes without padding. Returns the input ids of all texts concatenated, the offsets of each text
+    into them (len(input_texts) + 1 entries) and the names of the inputs the tokenizer produced.
+    """
+    flat_ids, offsets, input_names = [], [0], []
+    for start in range(0, len(input_texts), chunk_size):
+        batch_dict = tokenizer(input_texts[start:(start + chunk_size)],
+                               max_length=max_length,
+                               truncation=True,
+                               **tokenizer_kwargs)
+        input_names = list(batch_dict.keys())
+        for ids in batch_dict['input_ids']:
+            flat_ids.append(np.array(ids, dtype=np.int32))
+            offsets.append(offsets[-1] + len(ids))
+    flat_ids = np.concatenate(flat_ids) if flat_ids else np.zeros(0, dtype=np.int32)
+    return flat_ids, np.array(offsets, dtype=np.int64), input_names
+
+
+def create_length_sorted_batches(lengths: List[int], max_tokens: int, pad_to_multiple_of: int = 8) -> List[List[int]]:
+    # longest first, so that an out-of-memory error shows up on the first batch
+    sorted_indices = sorted(range(len(lengths)), key=lambda idx: -lengths[idx])
+
+    batches, cur_batch, cur_max_len = [], [], 0
+    for idx in sorted_indices:
+        padded_len = -(-lengths[idx] // pad_to_multiple_of) * pad_to_multiple_of
+        cur_max_len = max(cur_max_len, padded_len)
+        if cur_batch and (len(cur_batch) + 1) * cur_max_len > max_tokens:
+            batches.append(cur_batch)
+            cur_batch, cur_max_len = [], padded_len
+        cur_batch.append(idx)
+    if cur_batch:
+        batches.append(cur_batch)
+
+    return batches
+
+
+def _pad_batch(tokenizer: PreTrainedTokenizerFast,
+               flat_ids: np.ndarray,
+               offsets: np.ndarray,
+               input_names: List[str],
+               batch_indices: List[int],
+               pad_to_multiple_of: int = 8) -> Tuple[List[int], BatchEncoding]:
+    lengths = [int(offsets[idx + 1] - offsets[idx]) for idx in batch_indices]
+    max_len = -(-max(lengths) // pad_to_multiple_of) * pad_to_multiple_of
+    input_ids = torch.full((len(batch_indices), max_len), tokenizer.pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch_indices), max_len), dtype=torch.long)
+    for row, (idx, length) in enumerate(zip(batch_indices, lengths)):
+        cols = slice(0, length) if tokenizer.padding_side == 'right' else slice(max_len - length, max_len)
+        input_ids[row, cols] = torch.from_numpy(flat_ids[offsets[idx]:offsets[idx + 1]].astype(np.int64))
+        attention_mask[row, cols] = 1
+
+    batch_dict = {'input_ids': input_ids, 'attention_mask': attention_mask}
+    # single texts only, so token type ids are all zeros
+    if 'token_type_ids' in input_names:
+        batch_dict['token_type_ids'] = torch.zeros_like(input_ids)
+    return batch_indices, BatchEncoding(batch_dict)
+
+
+@torch.no_grad()
+def encode_sorted_by_length(encoder: torch.nn.Module,
+                            tokenizer: PreTrainedTokenizerFast,
+                            input_texts: List[str],
+                            pool_type: str,
+                            max_tokens: int,
+                            max_length: int = 512,
+                            num_workers: int = 2,
+                            **tokenizer_kwargs) -> np.ndarray:
+    """ Encodes texts in batches of similar length under a token budget,
+    the returned embeddings follow the order of `input_texts`.
+    """
+    # float32 whatever the autocast dtype, the same for empty and non-empty inputs
+    encoded_embeds = np.zeros((len(input_texts), getattr(encoder, 'module', encoder).config.hidden_size),
+                              dtype=np.float32)
+    if not input_texts:
+        return encoded_embeds
+
+    # texts are tokenized once, batches are padded from the ids in the DataLoader workers
+    flat_ids, offsets, input_names = tokenize_to_flat_ids(tokenizer, input_texts, max_length=max_length,
+                                                          **tokenizer_kwargs)
+    batches = create_length_sorted_batches(np.diff(offsets).tolist(), max_tokens=max_tokens)
+
+    data_loader = DataLoader(
+        batches,
+        batch_size=None,
+        shuffle=False,
+        num_workers=num_workers,
+        collate_fn=partial(_pad_batch, tokenizer, flat_ids, offsets, input_names),
+        pin_memory=True)
+
+    num_tokens, num_padded_tokens = 0, 0
+    for batch_indices, batch_dict in tqdm.tqdm(data_loader, desc='encoding', mininterval=10, disable=len(input_texts) < 128):
+        num_tokens += int(batch_dict['attention_mask'].sum())
+        num_padded_tokens += batch_dict['attention_mask'].numel()
+        batch_dict = move_to_cuda(batch_dict)
+
+        with torch.cuda.amp.autocast():
+            outputs = encoder(**batch_dict)
+            embeds = pool(outputs.last_hidden_state, batch_dict['attention_mask'], pool_type)
+
+        # scatter back to the original order
+        encoded_embeds[batch_indices] = embeds.float().cpu().numpy()
+
+    logger.info('Encode {} texts in {} batches, padding efficiency: {:.3f}'.format(
+        len(input_texts), len(batches), num_tokens / max(1, num_padded_tokens)))
+    return encoded_embeds
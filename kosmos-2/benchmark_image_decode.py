@@ -0,0 +1,96 @@
+"""Images per second of the laion image decode, inline at full resolution vs. ImageDecoder on a process pool."""
+
+import io
+import os
+import time
+import base64
+import argparse
+import tempfile
+import numpy as np
+
+from PIL import Image
+
+from infinibatch import iterators
+from unilm.data.vl.image_decode import ImageDecoder, CLIP_MEAN, CLIP_STD
+from unilm.data.vl.image_text_shard import ImageTextShard, convert_tsv_to_shard
+
+
+def build_shard(args, prefix):
+    # synthetic JPEGs of web-image size: smooth gradients plus noise, so they compress like photos
+    rng = np.random.RandomState(args.seed)
+    with open(prefix + '.tsv', 'w', encoding='utf8') as writer:
+        for i in range(args.num_images):
+            width, height = rng.randint(args.min_size, args.max_size + 1, size=2)
+            y, x = np.mgrid[0:height, 0:width]
+            channels = [np.sin(x / rng.uniform(20, 200) + rng.uniform(0, 6)) + np.cos(y / rng.uniform(20, 200)) for _ in range(3)]
+            pixels = np.stack(channels, axis=-1) * 60 + 128 + rng.normal(0, 8, size=(height, width, 3))
+            buffer = io.BytesIO()
+            Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, format='JPEG', quality=args.quality)
+            encoded = base64.b64encode(buffer.getvalue()).decode('ascii')
+            writer.write('{}\tcaption {}\t{}\t{}\t{}\n'.format(i, i, encoded, width, height))
+    convert_tsv_to_shard(prefix + '.tsv', prefix)
+    return [item[2] for item in ImageTextShard(prefix + '.bin')]
+
+
+def decode_full_resolution(image, resolution):
+    # what the loader does inline: full decode, Resize(resolution, BICUBIC), CenterCrop(resolution), NumpyNormalize
+    pil_img = Image.open(io.BytesIO(image)).convert('RGB')
+    width, height = pil_img.size
+    if width < height:
+        size = (resolution, int(resolution * height / width))
+    else:
+        size = (int(resolution * width / height), resolution)
+    pil_img = pil_img.resize(size, Image.BICUBIC)
+    left, top = int(round((size[0] - resolution) / 2.)), int(round((size[1] - resolution) / 2.))
+    pil_img = pil_img.crop((left, top, left + resolution, top + resolution))
+    image_array = np.array(pil_img).transpose(2, 0, 1) / 255.0
+    image_array -= np.array(CLIP_MEAN).reshape(-1, 1, 1)
+    image_array /= np.array(CLIP_STD).reshape(-1, 1, 1)
+    return image_array
+
+
+def decode_parallel(images, decoder, num_processes):
+    it = iterators.PipelinedParallelMapIterator(
+        iterators.NativeCheckpointableIterator(images), decoder, num_processes, num_items_per_process=8)
+    next(it)  # start up the pool
+    start_time = time.time()
+    num_decoded = 1 + sum(1 for _ in it)
+    elapsed = time.time() - start_time
+    it.close()
+    return (num_decoded - 1) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_images', type=int, default=512)
+    parser.add_argument('--min_size', type=int, default=400)
+    parser.add_argument('--max_size', type=int, default=1200)
+    parser.add_argument('--quality', type=int, default=90)
+    parser.add_argument('--resolution', type=int, default=224)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        images = build_shard(args, os.path.join(tmp_dir, 'synthetic'))
+    decoder = ImageDecoder(args.resolution)
+
+    start_time = time.time()
+    full = [decode_full_resolution(image, args.resolution) for image in images]
+    full_rate = len(images) / (time.time() - start_time)
+    start_time = time.time()
+    reduced = [decoder(image) for image in images]
+    reduced_rate = len(images) / (time.time() - start_time)
+
+    # DCT scaling and the fused crop change the pixels slightly, in units of the normalized image
+    diff = np.mean([np.abs(x - y).mean() for x, y in zip(full, reduced)])
+    print('inline, full resolution: {:.1f} images/s'.format(full_rate))
+    print('inline, ImageDecoder:    {:.1f} images/s, mean abs diff {:.4f}'.format(reduced_rate, diff))
+    for num_processes in args.workers:
+        rate = decode_parallel(images, decoder, num_processes)
+        print('{} processes, ImageDecoder: {:.1f} images/s, {:.1f} images/s per process'.format(
+            num_processes, rate, rate / num_processes))
+
+
+if __name__ == '__main__':
+    main()
@@ -182,7 +182,7 @@ It is mainly intended for demonstration and debugging purposes.
 
 ### Mapping
 
-.. todo:: Describe `MapIterator`, `ParallelMapIterator`, `RecurrentIterator`, and `SamplingRandomMapIterator`.
+.. todo:: Describe `MapIterator`, `ParallelMapIterator`, `PipelinedParallelMapIterator`, `RecurrentIterator`, and `SamplingRandomMapIterator`.
 
 
 ### Other Iterators
@@ -220,6 +220,7 @@ import queue
 from random import Random
 import threading
 import time
+import weakref
 from typing import Any, Callable, Dict, Generator, Iterable, Iterator, List, Optional, Tuple, Union, cast
 
 logger = logging.getLogger(__name__)
@@ -680,6 +681,95 @@ def ParallelMapIterator(source_iterator: CheckpointableIterator, transform: Call
     return transformed_samples
 
 
+class PipelinedParallelMapIterator(CheckpointableIterator):
+    """
+    Applies given transform to each data item
+
+    Behaves the same as ParallelMapIterator, but keeps up to num_chunks_in_flight chunks of
+    num_processes * num_items_per_process data items in the process pool while the results of the oldest chunk
+    are being consumed. Results are returned in source order, each as soon as it and all items before it are done,
+    so neither the consumer waits for the slowest item of a chunk nor the workers wait for the consumer.
+
+    The checkpoint is the source state at the start of the chunk of the oldest unconsumed item
+    and the offset of that item in the chunk.
+
+    Warning:
+    The transform function has to be pickleable because it is sent across process boundaries.
+    To achieve this, transform should be a top-level function.
+    The process pool is only released by calling close().
+    """
+    def __init__(self, source_iterator: CheckpointableIterator, transform: Callable[[str],Any], num_processes: int, num_items_per_process: int, num_chunks_in_flight: int=2):
+        """
+        Args:
+            source_iterator: checkpointable iterator
+            transform: function to be applied to each data item, has to be pickleable, see above
+            num_processes: number of processes to use for parallel map
+            num_items_per_process: number of data items each process operates on at a time
+            num_chunks_in_flight: number of chunks submitted to the process pool ahead of the consumer
+        """
+        if not isinstance(source_iterator, CheckpointableIterator):
+            raise ValueError('source_iterator has to be a CheckpointableIterator')
+        if num_chunks_in_flight <= 0:
+            raise ValueError('num_chunks_in_flight must be positive')
+        self._source_iterator = source_iterator           # type: CheckpointableIterator
+        self._transform = transform
+        self._num_processes = num_processes               # type: int
+        self._num_items_per_process = num_items_per_process  # type: int
+        self._chunk_size = num_processes * num_items_per_process  # type: int
+        self._num_chunks_in_flight = num_chunks_in_flight  # type: int
+        self._pool = None                                 # type: Optional[multiprocessing.pool.Pool]
+        self.setstate(None)
+
+    def getstate(self) -> Dict:
+        return {'source_state': self._source_state,
+                'item_offset' : self._item_offset  }
+
+    def setstate(self, checkpoint: Optional[Dict]):
+        self._source_state = checkpoint['source_state'] if checkpoint is not None else None
+        self._item_offset  = checkpoint['item_offset' ] if checkpoint is not None else 0
+        self._source_iterator.setstate(self._source_state)
+        # results of chunks submitted before are dropped
+        self._chunks = collections.deque()  # (source_state, item_offset, result iterator) of each chunk in the pool
+        self._results = iter(())            # results of the chunk being consumed
+        self._skip_items = self._item_offset  # the first chunk read resumes in the middle
+        self._source_exhausted = False
+
+    def _submit_chunks(self):
+        while len(self._chunks) < self._num_chunks_in_flight and not self._source_exhausted:
+            source_state = self._source_iterator.getstate()
+            chunk = list(islice(self._source_iterator, self._chunk_size))
+            if len(chunk) < self._chunk_size:
+                self._source_exhausted = True
+            if not chunk:
+                break
+            item_offset, self._skip_items = self._skip_items, 0
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self._num_processes)
+            results = self._pool.imap(self._transform, chunk[item_offset:], chunksize=self._num_items_per_process)
+            self._chunks.append((source_state, item_offset, results))
+
+    def __next__(self):
+        self._submit_chunks()
+        while True:
+            try:
+                item = next(self._results)
+                break
+            except StopIteration:
+                if not self._chunks:
+                    raise
+                self._source_state, self._item_offset, self._results = self._chunks.popleft()
+                self._submit_chunks()
+        self._item_offset += 1
+        return item
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        self._source_iterator.close()
+
+
 class ZipIterator(CheckpointableIterator):
     """
     Zips items from all given iterators, like the Python standard function zip().
@@ -942,7 +1032,127 @@ def BlockwiseShuffleIterator(source_iterator: CheckpointableIterator, block_size
     return samples
 
 
-def PrefetchIterator(source_iterator: CheckpointableIterator, buffer_size: int, buffer_in_main_process:bool=False, log_empty_buffer_warning: bool=False):
+_SharedMemoryArray = collections.namedtuple('_SharedMemoryArray', ['offset', 'shape', 'dtype'])
+_SharedMemoryItem = collections.namedtuple('_SharedMemoryItem', ['slab', 'item'])
+_shared_memory_slabs_in_use = []  # slabs closed while arrays were still alive, these must never be garbage collected
+
+
+def _map_arrays(obj, array_type, fn):
+    """ Applies fn to all objects of type array_type in nested lists, tuples and dicts """
+    if type(obj) is array_type:
+        return fn(obj)
+    if type(obj) in (list, tuple):
+        return type(obj)(_map_arrays(x, array_type, fn) for x in obj)
+    if type(obj) is dict:
+        return {k: _map_arrays(v, array_type, fn) for k, v in obj.items()}
+    return obj
+
+
+class _SharedMemoryRing:
+    """
+    Ring of shared-memory slabs through which a PrefetchIterator sends the NumPy arrays of its items
+
+    The prefetch process copies all NumPy arrays of an item into a free slab and only sends small descriptors
+    through the queue. The consumer gets the arrays as views into the slab,
+    which is recycled once all of these views have been garbage collected.
+    Items whose arrays do not fit into a slab, or that arrive while all slabs are in use, are sent as they are.
+
+    The slabs are attached by name, so the ring can be passed to processes started with spawn as well as fork,
+    as long as they are created from the given multiprocessing context.
+    """
+    _alignment = 64
+
+    def __init__(self, num_slabs: int, slab_size: int, context: Optional[multiprocessing.context.BaseContext]=None):
+        from multiprocessing import shared_memory
+        self._context = context if context is not None else multiprocessing.get_context()
+        self._slab_size = slab_size
+        self._slabs = [shared_memory.SharedMemory(create=True, size=slab_size) for _ in range(num_slabs)]
+        self._slab_names = [slab.name for slab in self._slabs]
+        self._owner_pid = os.getpid()
+        self._held_slabs = set()  # slabs with arrays alive in the consumer
+        self.reset()
+
+    def __getstate__(self):
+        return {'slab_size': self._slab_size, 'slab_names': self._slab_names, 'free_slabs': self._free_slabs}
+
+    def __setstate__(self, state):
+        self._slab_size = state['slab_size']
+        self._slab_names = state['slab_names']
+        self._free_slabs = state['free_slabs']
+        self._slabs = [None] * len(self._slab_names)  # attached on first use
+        self._context = None
+        self._owner_pid = None
+        self._held_slabs = set()
+
+    def _get_slab(self, index: int):
+        if self._slabs[index] is None:
+            from multiprocessing import resource_tracker, shared_memory
+            self._slabs[index] = shared_memory.SharedMemory(name=self._slab_names[index])
+            # the slab is owned by the consumer, do not let this process unlink it on exit
+            resource_tracker.unregister(self._slabs[index]._name, 'shared_memory')
+        return self._slabs[index]
+
+    def reset(self):
+        """ Marks all slabs not held by the consumer as free, called in the consumer when no prefetch process is running """
+        self._free_slabs = self._context.Queue()
+        for index in range(len(self._slab_names)):
+            if index not in self._held_slabs:
+                self._free_slabs.put(index)
+
+    def encode(self, item):
+        """ Called in the prefetch process, returns the message to send instead of item """
+        import numpy as np
+        arrays = []
+        _map_arrays(item, np.ndarray, lambda array: arrays.append(array) if not array.dtype.hasobject else None)
+        total_size = sum(-(-array.nbytes // self._alignment) * self._alignment for array in arrays)
+        if not arrays or total_size > self._slab_size:
+            return item
+        try:
+            index = self._free_slabs.get_nowait()
+        except queue.Empty:
+            return item
+        buffer = self._get_slab(index).buf
+        offset = 0
+        def write(array):
+            nonlocal offset
+            if array.dtype.hasobject:
+                return array
+            np.ndarray(array.shape, array.dtype, buffer=buffer, offset=offset)[...] = array
+            descriptor = _SharedMemoryArray(offset, array.shape, array.dtype)
+            offset += -(-array.nbytes // self._alignment) * self._alignment
+            return descriptor
+        return _SharedMemoryItem(index, _map_arrays(item, np.ndarray, write))
+
+    def decode(self, msg):
+        """ Called in the consumer, returns the item sent by encode """
+        if not isinstance(msg, _SharedMemoryItem):
+            return msg
+        import numpy as np
+        # all arrays of the item are views of base, the slab is released when base is garbage collected
+        base = np.frombuffer(self._get_slab(msg.slab).buf, dtype=np.uint8)
+        self._held_slabs.add(msg.slab)
+        weakref.finalize(base, self._release, msg.slab)
+        return _map_arrays(msg.item, _SharedMemoryArray,
+                           lambda d: np.ndarray(d.shape, d.dtype, buffer=base, offset=d.offset))
+
+    def _release(self, index: int):
+        self._held_slabs.discard(index)
+        self._free_slabs.put(index)
+
+    def close(self):
+        for slab in self._slabs:
+            if slab is None:
+                continue
+            try:
+                slab.close()
+            except BufferError:  # arrays are still alive in the consumer, SharedMemory.__del__ would raise the same
+                _shared_memory_slabs_in_use.append(slab)
+            if self._owner_pid == os.getpid():
+                slab.unlink()
+        self._owner_pid = None
+
+
+def PrefetchIterator(source_iterator: CheckpointableIterator, buffer_size: int, buffer_in_main_process:bool=False, log_empty_buffer_warning: bool=False, shared_memory_slab_size: int=0):
     """
     An iterator prefetching data into a buffer on a seperate process.
 
@@ -951,11 +1161,15 @@ def PrefetchIterator(source_iterator: CheckpointableIterator, buffer_size: int,
         buffer_size: number of items to prefetch; this is the maximum number of items held in the prefetch queue
         buffer_in_main_process: use experimental version of PrefetchBuffer that has buffer in main process instead of prefetch process
         log_empty_buffer_warning: log warning message if prefetch buffer is empty, only supported if buffer_in_main_process=True
+        shared_memory_slab_size: if positive, the NumPy arrays of each item are sent through a ring of shared-memory slabs
+                                 of this many bytes instead of being pickled through the prefetch queue
     """
     if not isinstance(source_iterator, CheckpointableIterator):
         raise ValueError('source_iterator has to be a CheckpointableIterator')
     if buffer_size <= 0:
         raise ValueError('buffer_size must be positive')
+    if shared_memory_slab_size < 0:
+        raise ValueError('shared_memory_slab_size must not be negative')
 
     if multiprocessing.get_start_method() != 'fork':
         print('WARNING: \
@@ -965,10 +1179,12 @@ def PrefetchIterator(source_iterator: CheckpointableIterator, buffer_size: int,
                This also means that checkpoints of this iterator pipeline cannot be ported to a system that uses fork.')
         return source_iterator
     else:
+        # items in the queues, in transit and the one last returned each hold a slab
+        shared_memory_ring = _SharedMemoryRing(buffer_size + 3, shared_memory_slab_size) if shared_memory_slab_size > 0 else None
         if buffer_in_main_process:
-            return _ForkPrefetchIteratorExperimental(source_iterator, buffer_size, log_empty_buffer_warning)
+            return _ForkPrefetchIteratorExperimental(source_iterator, buffer_size, log_empty_buffer_warning, shared_memory_ring)
         else:
-            return _ForkPrefetchIterator(source_iterator, buffer_size)
+            return _ForkPrefetchIterator(source_iterator, buffer_size, shared_memory_ring)
 
 
 class _ForkPrefetchIterator(CheckpointableIterator):
@@ -977,11 +1193,15 @@ class _ForkPrefetchIterator(CheckpointableIterator):
     Args:
         source_iterator: checkpointable iterator to recur over
         buffer_size: number of items to prefetch; this is the maximum number of items held in the prefetch queue
+        shared_memory_ring: optional ring of shared-memory slabs to send the NumPy arrays of the items through
     """
-    def __init__(self, source_iterator: CheckpointableIterator, buffer_size: int):
+    def __init__(self, source_iterator: CheckpointableIterator, buffer_size: int, shared_memory_ring: Optional[_SharedMemoryRing]=None):
         self._source_iterator = source_iterator  # type:CheckpointableIterator
         self._buffer_size = buffer_size          # type: int
         self._prefetch_process = None            # type: Optional[multiprocessing.Process]
+        self._shared_memory_ring = shared_memory_ring
+        if shared_memory_ring is not None:
+            weakref.finalize(self, shared_memory_ring.close)
         self.setstate(None)
 
     def getstate(self) -> Dict:
@@ -994,12 +1214,15 @@ class _ForkPrefetchIterator(CheckpointableIterator):
         self._source_state = checkpoint['source_state'] if checkpoint is not None else None
         self._item_offset  = checkpoint['item_offset' ] if checkpoint is not None else 0
         self._source_iterator.setstate(self._source_state)
+        if self._shared_memory_ring is not None:
+            self._shared_memory_ring.reset()  # slabs taken by the terminated process are free again
         self._queue = multiprocessing.Queue(maxsize=self._buffer_size)
         _prefetch_process = multiprocessing.Process(target=self._prefetch_process_fn,
                                                            args=(self._source_iterator,
                                                                  self._item_offset,  # @TODO: why pass all these parameters? They are forked anyways. Seems a left-over from thread days.
                                                                  self._buffer_size,
-                                                                 self._queue))
+                                                                 self._queue,
+                                                                 self._shared_memory_ring))
         _prefetch_process.start()  # this invokes fork()
         self._prefetch_process = _prefetch_process
         # make sure that in case of an unexpected shutdown, we still get rid of any active child process
@@ -1007,7 +1230,7 @@ class _ForkPrefetchIterator(CheckpointableIterator):
         atexit.register(_ForkPrefetchIterator._join_process, self._prefetch_process)
 
     @staticmethod
-    def _prefetch_process_fn(source, item_offset, buffer_size, queue):  # behavior of the prefetching process, only to be called from that process!        
+    def _prefetch_process_fn(source, item_offset, buffer_size, queue, shared_memory_ring=None):  # behavior of the prefetching process, only to be called from that process!        
         _advance_iterator(source, item_offset)  # skip to checkpoint
         while True:
             try:
@@ -1026,6 +1249,8 @@ class _ForkPrefetchIterator(CheckpointableIterator):
             else:
                 source_state = None
                 item_offset += 1
+            if shared_memory_ring is not None:
+                item = shared_memory_ring.encode(item)
             msg = (item, source_state)
             queue.put(msg)
 
@@ -1037,6 +1262,8 @@ class _ForkPrefetchIterator(CheckpointableIterator):
             self._queue = None
             raise StopIteration()
         item, prefetch_source_state = msg  # for efficiency, the prefetch_source_state is only transmitted at the end of each window of length _buffer_size
+        if self._shared_memory_ring is not None:
+            item = self._shared_memory_ring.decode(item)
         if prefetch_source_state is not None:
             assert self._item_offset == self._buffer_size - 1  # we expect a new source state at then END of each window of length _buffer_size
             self._source_state = prefetch_source_state
@@ -1104,6 +1331,7 @@ class _ForkPrefetchIteratorExperimental(CheckpointableIterator):
         source_iterator: checkpointable iterator to recur over
         buffer_size: number of items to prefetch; this is the maximum number of items held in the prefetch queue
         log_empty_buffer_warning: log warning message if prefetch buffer is empty
+        shared_memory_ring: optional ring of shared-memory slabs to send the NumPy arrays of the items through
     """
 
     # HOW THIS ITERATOR WORKS, AND WHY:
@@ -1164,11 +1392,19 @@ class _ForkPrefetchIteratorExperimental(CheckpointableIterator):
     # https://in.pycon.org/2011/static/files/talks/41/Python-threads_v1.0.pdf
 
     def __init__(
-        self, source_iterator: CheckpointableIterator, buffer_size: int, log_empty_buffer_warning: bool = False
+        self,
+        source_iterator: CheckpointableIterator,
+        buffer_size: int,
+        log_empty_buffer_warning: bool = False,
+        shared_memory_ring: Optional[_SharedMemoryRing] = None,
     ):
         self._source_iterator = source_iterator  # type: CheckpointableIterator
         self._buffer_size = buffer_size  # type: int
         self._log_empty_buffer_warning = log_empty_buffer_warning
+        self._shared_memory_ring = shared_memory_ring
+        self._close_shared_memory_ring = (
+            weakref.finalize(self, shared_memory_ring.close) if shared_memory_ring is not None else None
+        )
         self._is_closed = False
         self.setstate(None)
 
@@ -1229,6 +1465,8 @@ class _ForkPrefetchIteratorExperimental(CheckpointableIterator):
             raise StopIteration()
         # for efficiency, the prefetch_source_state is only transmitted at the end of each window of length _buffer_size
         item, prefetch_source_state = msg
+        if self._shared_memory_ring is not None:
+            item = self._shared_memory_ring.decode(item)
         if prefetch_source_state is not None:
             # we expect a new source state at then END of each window of length _buffer_size
             assert self._item_offset == self._buffer_size - 1
@@ -1255,10 +1493,15 @@ class _ForkPrefetchIteratorExperimental(CheckpointableIterator):
         if not self._is_closed:
             self._is_closed = True
             self._shutdown()
+            if self._close_shared_memory_ring is not None:
+                self._close_shared_memory_ring()
         self._source_iterator.close()
 
     def _startup(self):
         # set up prefetch process and associated queue
+        if self._shared_memory_ring is not None:
+            # slabs of items dropped by the last _shutdown() are free again
+            self._shared_memory_ring.reset()
         self._inter_process_queue = multiprocessing.Queue(maxsize=1)
         # Because of the way PyTorch transfers tensors through shared memory (see comment at top of this class)
         # we have to keep the prefetch process alive until we are sure that
@@ -1273,6 +1516,7 @@ class _ForkPrefetchIteratorExperimental(CheckpointableIterator):
                 self._buffer_size,
                 self._inter_process_queue,
                 self._prefetch_process_should_terminate,
+                self._shared_memory_ring,
             ),
         )
         _prefetch_process.start()  # this invokes fork()
@@ -1305,7 +1549,7 @@ class _ForkPrefetchIteratorExperimental(CheckpointableIterator):
 
     @staticmethod
     def _prefetch_process_fn(
-        source_iterator, item_offset, buffer_size, inter_process_queue, should_terminate_event
+        source_iterator, item_offset, buffer_size, inter_process_queue, should_terminate_event, shared_memory_ring=None
     ):  # behavior of the prefetching process, only to be called from that process!
         _advance_iterator(source_iterator, item_offset)  # skip to checkpoint
         while True:
@@ -1327,6 +1571,8 @@ class _ForkPrefetchIteratorExperimental(CheckpointableIterator):
             else:
                 source_state = None
                 item_offset += 1
+            if shared_memory_ring is not None:
+                item = shared_memory_ring.encode(item)
             msg = (item, source_state)
             should_terminate = _ForkPrefetchIteratorExperimental._try_put(
                 inter_process_queue, msg, should_terminate_event
@@ -1387,6 +1633,9 @@ class BucketedReadaheadBatchIterator(CheckpointableIterator):
     that prior randomization is not undone (except for the length grouping). The batch size
     is dynamic, and determined by a user-provided callback.
 
+    Checkpoints hold the item positions of the batches not yet served, so restoring one only
+    reads the source up to the last of these items and neither recreates nor reshuffles the batches.
+
     This is based on Marian NMT's BatchGenerator.
     """
 
@@ -1417,14 +1666,27 @@ class BucketedReadaheadBatchIterator(CheckpointableIterator):
         self.setstate(None)
 
     def getstate(self):
-        return {'source_state': self._source_state,
-                'random_state': self._random_state,
-                'num_served':   self._num_batches_yielded}
+        return {'source_state':      self._source_state,
+                'random_state':      self._random_state,
+                'num_served':        self._num_batches_yielded,
+                'pending_batches':   self._batches[self._num_batches_yielded - self._num_batches_skipped:] if self._batches is not None else None,
+                'next_source_state': self._next_source_state,
+                'next_random_state': self._next_random_state,
+                'source_exhausted':  self._source_exhausted}
 
     def setstate(self, checkpoint: Optional[Dict]):
         self._source_state        = checkpoint['source_state'] if checkpoint else None  # type: Dict  # state of input before reading the current set of batches
         self._random_state        = checkpoint['random_state'] if checkpoint else None  # type: Any   # state of random generator at _source_state
         self._num_batches_yielded = checkpoint['num_served']   if checkpoint else 0     # type: int   # number of batches served from the current set of batches
+        # Checkpoints taken after the current set of batches was created also hold the item positions of the batches
+        # not served yet, as well as the states needed for the next set of batches.
+        # This allows to resume without recreating and reshuffling the batches. Older checkpoints do not have these keys.
+        pending_batches           = checkpoint.get('pending_batches')   if checkpoint else None  # type: Optional[List[List[int]]]
+        self._next_source_state   = checkpoint.get('next_source_state') if checkpoint else None  # type: Dict  # state of input after reading the current set of batches
+        self._next_random_state   = checkpoint.get('next_random_state') if checkpoint else None  # type: Any   # state of random generator after shuffling the current set of batches
+        self._source_exhausted    = checkpoint.get('source_exhausted', False) if checkpoint else False  # type: bool  # set to True once we hit StopIteration on source
+        self._batches             = pending_batches           # type: Optional[List[List[int]]]  # item positions of the batches of the current set, starting at _num_batches_skipped
+        self._num_batches_skipped = self._num_batches_yielded # type: int  # number of batches of the current set that are not in _batches
         # checkpointing: restore to start of current set of batches
         self._source_iterator.setstate(self._source_state)
         if self._random:
@@ -1432,21 +1694,37 @@ class BucketedReadaheadBatchIterator(CheckpointableIterator):
                 self._random.setstate(self._random_state)
             else:
                 self._random.seed(self._seed)
-        self._source_exhausted = False  # type: bool  # set to True once we hit StopIteration on source
         def _generate():
-            skip_to_checkpoint = self._num_batches_yielded
-            source_exhausted = False
-            while not source_exhausted:
+            if pending_batches is not None:
+                # resume inside the current set of batches: only keep the items of the batches not served yet,
+                # and stop reading after the last of them
+                positions = set(pos for batch in pending_batches for pos in batch)
+                num_items = max(positions) + 1 if positions else 0
+                items = {pos: item for pos, item in enumerate(islice(self._source_iterator, num_items)) if pos in positions}
+                self._source_iterator.setstate(self._next_source_state)
+                if self._random:
+                    self._random.setstate(self._next_random_state)
+                for batch in pending_batches:
+                    self._num_batches_yielded += 1
+                    yield [items[pos] for pos in batch]
+                del items
+            skip_to_checkpoint = self._num_batches_yielded if pending_batches is None else 0
+            while not self._source_exhausted:
                 # prefetch the readahead buffer
                 self._source_state = self._source_iterator.getstate()
                 self._random_state = self._random.getstate() if self._random else None
+                self._batches = None
                 items = list(islice(self._source_iterator, self._read_ahead))
-                source_exhausted = (len(items) < self._read_ahead)
+                self._source_exhausted = (len(items) < self._read_ahead)
                 # create batches
-                batches = self._create_batches(items)
+                batches = self._create_batch_positions(items)
                 # shuffle the batches
                 if self._random:
                     self._random.shuffle(batches)
+                self._next_source_state = self._source_iterator.getstate()
+                self._next_random_state = self._random.getstate() if self._random else None
+                self._batches = batches
+                self._num_batches_skipped = 0
                 # on first loop iteration, restore iterator inside batches from checkpoint
                 batches = iter(batches)
                 self._num_batches_yielded = _advance_iterator(batches, skip_to_checkpoint)
@@ -1454,18 +1732,20 @@ class BucketedReadaheadBatchIterator(CheckpointableIterator):
                 # main loop over batches in current read-ahead section
                 for batch in batches:
                     self._num_batches_yielded += 1
-                    yield batch
+                    yield [items[pos] for pos in batch]
         self._iterator = _generate()  # type: Iterator  # iterator into current set of batches
 
-    def _create_batches(self, items: List[Any]) -> List[List[Any]]:  # helper to form batches from a list of items
+    def _create_batch_positions(self, items: List[Any]) -> List[List[int]]:  # helper to form batches of positions into a list of items
+            positions = list(range(len(items)))
             # sort by length, longest first
             if self._key:
-                items.sort(key=self._key, reverse=True)  # note: sort() is stable, so we won't undo any randomization besides the bucketing
+                positions.sort(key=lambda pos: self._key(items[pos]), reverse=True)  # note: sort() is stable, so we won't undo any randomization besides the bucketing
             # group into batches
-            cur_batch = None  # type: Optional[List[Any]]
+            cur_batch = None  # type: Optional[List[int]]
             prev_val = None
-            batches = []      # type: List[Any]
-            for item in items:
+            batches = []      # type: List[List[int]]
+            for pos in positions:
+                item = items[pos]
                 if self._boundary_key and self._boundary_key(item) != prev_val:
                     if cur_batch:
                         batches.append(cur_batch)
@@ -1475,7 +1755,7 @@ class BucketedReadaheadBatchIterator(CheckpointableIterator):
                     batch_size = self._batch_size if isinstance(self._batch_size, int) else \
                                  self._batch_size(item)
                     cur_batch = []
-                cur_batch.append(item)
+                cur_batch.append(pos)
                 if self._boundary_key:
                    prev_val = self._boundary_key(item)
                    assert prev_val is not None
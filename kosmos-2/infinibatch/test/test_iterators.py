@@ -4,14 +4,30 @@ import multiprocessing
 from random import Random
 import unittest
 
+import numpy as np
 import torch
 
 from infinibatch.iterators import *
+from infinibatch.iterators import _SharedMemoryItem, _SharedMemoryRing
 
 if __name__ == "__main__":
     unittest.main()
 
 
+def _shared_memory_producer(ring, items_queue, acks_queue, n):  # runs in a spawned process
+    for i in range(n):
+        items_queue.put(ring.encode({"a": np.full(100, i, dtype=np.int64), "b": (np.arange(i, dtype=np.float32), i)}))
+        acks_queue.get()
+
+
+def _numpy_items(n):
+    return [{"a": np.arange(i, dtype=np.int64), "b": (np.full((2, i), i, dtype=np.float32), i)} for i in range(n)]
+
+
+def _numpy_items_to_lists(items):
+    return [{"a": item["a"].tolist(), "b": (item["b"][0].tolist(), item["b"][1])} for item in items]
+
+
 class TestBase(unittest.TestCase):
     def setUp(self):
         self.lengths = [1, 2, 3, 42, 57]
@@ -461,6 +477,32 @@ class TestMapIterator(TestBase, TestFiniteIteratorMixin, TestFiniteIteratorCheck
             self.test_cases.append(("n={}".format(n), expected_result, it))
 
 
+class TestPipelinedParallelMapIterator(TestBase, TestFiniteIteratorMixin, TestFiniteIteratorCheckpointingMixin):
+    @staticmethod
+    def transform(item):
+        return 2 * item
+
+    def setUp(self):
+        super().setUp()
+        self.test_cases = []
+        for n in self.lengths:
+            for num_processes, num_items_per_process, num_chunks_in_flight in [(1, 1, 1), (2, 3, 2), (3, 5, 4)]:
+                data = list(range(n))
+                expected_result = [self.transform(item) for item in data]
+                it = PipelinedParallelMapIterator(NativeCheckpointableIterator(data), self.transform,
+                                                  num_processes, num_items_per_process, num_chunks_in_flight)
+                self.test_cases.append(("n={}, num_processes={}, num_items_per_process={}, num_chunks_in_flight={}".format(
+                    n, num_processes, num_items_per_process, num_chunks_in_flight), expected_result, it))
+
+    def tearDown(self):
+        for _, _, it in self.test_cases:
+            it.close()
+
+    def test_zero_chunks_in_flight(self):
+        f = lambda: PipelinedParallelMapIterator(NativeCheckpointableIterator([0]), self.transform, 1, 1, num_chunks_in_flight=0)
+        self.assertRaises(ValueError, f)
+
+
 class TestZipIterator(TestBase, TestFiniteIteratorMixin, TestFiniteIteratorCheckpointingMixin):
     def setUp(self):
         super().setUp()
@@ -521,6 +563,24 @@ class TestPrefetchIterator(TestBase, TestFiniteIteratorMixin, TestFiniteIterator
                     result = list(it)
                     self.assertEqual(result, data)
 
+    def test_shared_memory(self):
+        for n in self.lengths:
+            for buffer_size in self.lengths:
+                for slab_size in [512, 1024]:  # items with more than 512 bytes of arrays are sent through the queue
+                    with self.subTest("n={}, buffer_size={}, slab_size={}".format(n, buffer_size, slab_size)):
+                        data = _numpy_items(n)
+                        it = PrefetchIterator(
+                            NativeCheckpointableIterator(copy.deepcopy(data)), buffer_size, shared_memory_slab_size=slab_size
+                        )
+                        for _ in range(n // 3):
+                            next(it)
+                        checkpoint = it.getstate()
+                        result = list(it)
+                        self.assertEqual(_numpy_items_to_lists(result), _numpy_items_to_lists(data[n // 3:]))
+                        it.setstate(checkpoint)
+                        result = list(it)
+                        self.assertEqual(_numpy_items_to_lists(result), _numpy_items_to_lists(data[n // 3:]))
+
 
 class TestPrefetchIteratorExperimental(TestBase, TestFiniteIteratorMixin, TestFiniteIteratorCheckpointingMixin):
     def setUp(self):
@@ -571,12 +631,62 @@ class TestPrefetchIteratorExperimental(TestBase, TestFiniteIteratorMixin, TestFi
                     self.assertEqual(result, data)
                     it.close()
 
+    def test_shared_memory(self):
+        for n in self.lengths:
+            for buffer_size in self.lengths:
+                for slab_size in [512, 1024]:  # items with more than 512 bytes of arrays are sent through the queue
+                    with self.subTest("n={}, buffer_size={}, slab_size={}".format(n, buffer_size, slab_size)):
+                        data = _numpy_items(n)
+                        it = PrefetchIterator(
+                            NativeCheckpointableIterator(copy.deepcopy(data)), buffer_size, buffer_in_main_process=True, shared_memory_slab_size=slab_size
+                        )
+                        for _ in range(n // 3):
+                            next(it)
+                        checkpoint = it.getstate()
+                        result = list(it)
+                        self.assertEqual(_numpy_items_to_lists(result), _numpy_items_to_lists(data[n // 3:]))
+                        it.setstate(checkpoint)
+                        result = list(it)
+                        self.assertEqual(_numpy_items_to_lists(result), _numpy_items_to_lists(data[n // 3:]))
+                        it.close()
+
     def tearDown(self):
         if hasattr(self, "test_cases"):
             for _, _, it in self.test_cases:
                 it.close()
 
 
+class TestSharedMemoryRing(unittest.TestCase):
+    def test_spawn(self):
+        context = multiprocessing.get_context("spawn")
+        ring = _SharedMemoryRing(num_slabs=2, slab_size=1024, context=context)
+        items_queue, acks_queue = context.Queue(), context.Queue()
+        n = 10  # more items than slabs, so slabs have to be recycled
+        process = context.Process(target=_shared_memory_producer, args=(ring, items_queue, acks_queue, n))
+        process.start()
+        for i in range(n):
+            msg = items_queue.get()
+            self.assertIsInstance(msg, _SharedMemoryItem)
+            item = ring.decode(msg)
+            self.assertEqual(item["a"].tolist(), [i] * 100)
+            self.assertEqual(item["b"][0].tolist(), list(range(i)))
+            self.assertEqual(item["b"][1], i)
+            del item  # releases the slab
+            acks_queue.put(None)
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        ring.close()
+
+    def test_fallback(self):
+        ring = _SharedMemoryRing(num_slabs=1, slab_size=64)
+        self.assertEqual(ring.encode([1, "a"]), [1, "a"])  # no arrays
+        self.assertIsInstance(ring.encode(np.zeros(100)), np.ndarray)  # does not fit into a slab
+        held = ring.decode(ring.encode(np.zeros(8)))
+        self.assertIsInstance(ring.encode(np.ones(8)), np.ndarray)  # no free slab
+        self.assertEqual(held.tolist(), [0.0] * 8)
+        ring.close()
+
+
 class TestMultiplexIterator(TestBase, TestFiniteIteratorMixin, TestFiniteIteratorCheckpointingMixin):
     # TODO: Add test cases for behavior when source iterators end but item is retrieved
     def setUp(self):
@@ -963,3 +1073,39 @@ class TestBucketedReadaheadBatchIterator(TestBase, TestFiniteIteratorCheckpointi
                     for batch in result:
                         boundary_keys = [self.boundary_key_fn(item) for item in batch]
                         self.assertTrue(all(boundary_keys) or not any(boundary_keys))
+
+    def test_checkpointing_without_pending_batches(self):  # checkpoints written before pending batches were stored
+        for case_name, _, it in self.test_cases:
+            with self.subTest(case_name):
+                expected_result = list(it)
+                it.setstate(None)
+                pos = len(expected_result) // 2
+                for _ in range(pos):
+                    next(it)
+                checkpoint = it.getstate()
+                it.setstate({key: checkpoint[key] for key in ["source_state", "random_state", "num_served"]})
+                self.assertEqual(list(it), expected_result[pos:])
+
+    def test_resume_reads_pending_items_only(self):
+        class CountingIterator(NativeCheckpointableIterator):
+            def __next__(self):
+                self.num_read += 1
+                return super().__next__()
+
+        data = list(range(20))
+        it = BucketedReadaheadBatchIterator(
+            NativeCheckpointableIterator(data), read_ahead=10, key=lambda x: x, batch_size=2, shuffle=False
+        )
+        expected_result = list(it)  # [[9, 8], [7, 6], ..., [19, 18], ...]
+        for pos, expected_num_read in [(2, 6), (5, 10), (7, 6)]:
+            with self.subTest("pos={}".format(pos)):
+                it.setstate(None)
+                for _ in range(pos):
+                    next(it)
+                source = CountingIterator(data)
+                source.num_read = 0
+                resumed = BucketedReadaheadBatchIterator(source, read_ahead=10, key=lambda x: x, batch_size=2, shuffle=False)
+                resumed.setstate(it.getstate())
+                self.assertEqual(next(resumed), expected_result[pos])
+                self.assertEqual(source.num_read, expected_num_read)
+                self.assertEqual(list(resumed), expected_result[pos + 1 :])
@@ -0,0 +1,54 @@
+import io
+import numpy as np
+
+from PIL import Image
+
+from unilm.data.vl.image_text_shard import decode_image_bytes
+
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+class ImageDecoder:
+    """ Decodes an encoded image to a normalized float32 array of shape (3, resolution, resolution).
+
+    Same result as Resize(resolution, BICUBIC), CenterCrop(resolution) and NumpyNormalize up to resampling
+    differences, but JPEGs are decoded with DCT scaling (Image.draft) close to the target size instead of at
+    full resolution, the crop is applied within the resize, and normalization is a per-channel lookup table
+    from uint8 to float32. Instances are pickleable, so they can be used as the transform of a process pool.
+    """
+
+    def __init__(self, resolution, mean=CLIP_MEAN, std=CLIP_STD, center_crop=True):
+        self.resolution = resolution
+        # without center_crop the whole image is resized to resolution x resolution, as Resize((resolution, resolution))
+        self.center_crop = center_crop
+        values = np.arange(256, dtype=np.float64) / 255.0
+        self.lut = ((values[None, :] - np.array(mean)[:, None]) / np.array(std)[:, None]).astype(np.float32)
+
+    def open(self, image):
+        # image is the raw bytes of binary shards or the base64 string of TSV shards
+        pil_img = Image.open(io.BytesIO(decode_image_bytes(image)))
+        width, height = pil_img.size
+        if self.center_crop:
+            scale = self.resolution / min(width, height)
+            size = (int(np.ceil(width * scale)), int(np.ceil(height * scale)))
+        else:
+            size = (self.resolution, self.resolution)
+        # JPEGs are decoded at the smallest 1/2, 1/4 or 1/8 scale that is still at least size, no-op for other formats
+        pil_img.draft('RGB', size)
+        return pil_img.convert('RGB')
+
+    def __call__(self, image):
+        pil_img = self.open(image)
+        width, height = pil_img.size
+        if self.center_crop:
+            side = min(width, height)
+            box = ((width - side) / 2, (height - side) / 2, (width + side) / 2, (height + side) / 2)
+        else:
+            box = (0, 0, width, height)
+        pil_img = pil_img.resize((self.resolution, self.resolution), Image.BICUBIC, box=box)
+        pixels = np.asarray(pil_img)
+        image_array = np.empty((3, self.resolution, self.resolution), dtype=np.float32)
+        for channel in range(3):
+            np.take(self.lut[channel], pixels[:, :, channel], out=image_array[channel])
+        return image_array
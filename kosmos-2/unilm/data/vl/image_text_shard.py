@@ -0,0 +1,150 @@
+import os
+import base64
+import binascii
+import struct
+import argparse
+import multiprocessing
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Binary image-text shards, converted from the TSV shards of the laion2b / coyo loaders:
+#   {prefix}.bin  records, each a fixed header followed by the key, caption, image and extra fields
+#   {prefix}.idx  int64 offsets of the records into {prefix}.bin, num_records + 1 entries
+# The image is stored as the raw (JPEG) bytes instead of base64, the extra field holds the
+# TSV columns after width and height (e.g. the bbox metadata of the obj shards), joined by tabs.
+# Convert with: python unilm/data/vl/image_text_shard.py dir/*.tsv --output-dir out_dir --workers 8
+# and list the .bin shards in the json of the data dir instead of the .tsv shards.
+SHARD_SUFFIX = '.bin'
+INDEX_SUFFIX = '.idx'
+
+# key, caption, image and extra lengths in bytes, width, height (0 if unknown)
+_HEADER = struct.Struct('<IIIIII')
+
+
+def is_image_text_shard(file_path):
+    return file_path.endswith(SHARD_SUFFIX)
+
+
+def decode_image_bytes(image):
+    # items of binary shards hold the raw bytes, items of TSV shards the base64 string
+    if isinstance(image, bytes):
+        return image
+    return base64.b64decode(image)
+
+
+def _pack_record(item):
+    key, caption, image = item[0].encode('utf8'), item[1].encode('utf8'), base64.b64decode(item[2])
+    width = int(item[3]) if item[3].isdigit() else 0
+    height = int(item[4]) if item[4].isdigit() else 0
+    extra = '\t'.join(item[5:]).encode('utf8')
+    header = _HEADER.pack(len(key), len(caption), len(image), len(extra), width, height)
+    return b''.join([header, key, caption, image, extra])
+
+
+def _unpack_record(record):
+    key_len, caption_len, image_len, extra_len, width, height = _HEADER.unpack_from(record)
+    offset = _HEADER.size
+    key = record[offset:offset + key_len].decode('utf8')
+    offset += key_len
+    caption = record[offset:offset + caption_len].decode('utf8')
+    offset += caption_len
+    image = record[offset:offset + image_len]
+    offset += image_len
+    extra = record[offset:offset + extra_len].decode('utf8')
+    # same columns as the TSV shards, width and height stay strings so the loaders' filters apply as is
+    item = [key, caption, image, str(width), str(height)]
+    if extra_len > 0:
+        item.extend(extra.split('\t'))
+    return item
+
+
+def convert_tsv_to_shard(tsv_path, prefix):
+    """ Converts a TSV shard (key, caption, base64 image, width, height, ...) to {prefix}.bin and {prefix}.idx. """
+    offsets = [0]
+    num_skipped = 0
+    with open(tsv_path, 'r', encoding='utf8') as reader, open(prefix + SHARD_SUFFIX + '.tmp', 'wb') as writer:
+        for line in reader:
+            item = line.strip().split('\t')
+            if len(item) < 5:
+                num_skipped += 1
+                continue
+            try:
+                record = _pack_record(item)
+            except (binascii.Error, ValueError, struct.error):
+                num_skipped += 1
+                continue
+            writer.write(record)
+            offsets.append(offsets[-1] + len(record))
+    np.array(offsets, dtype=np.int64).tofile(prefix + INDEX_SUFFIX)
+    os.replace(prefix + SHARD_SUFFIX + '.tmp', prefix + SHARD_SUFFIX)
+    logger.info('Convert {} to {}: {} records, {} lines skipped'.format(
+        tsv_path, prefix + SHARD_SUFFIX, len(offsets) - 1, num_skipped))
+    return len(offsets) - 1
+
+
+class ImageTextShard:
+    """ Random access to the records of a binary shard, images are returned as raw bytes and decoded by the caller. """
+
+    def __init__(self, file_path):
+        assert is_image_text_shard(file_path), file_path
+        self.file_path = file_path
+        self.offsets = np.fromfile(file_path[:-len(SHARD_SUFFIX)] + INDEX_SUFFIX, dtype=np.int64)
+        assert self.offsets[-1] == os.path.getsize(file_path), '{} does not match its index'.format(file_path)
+        self._file = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _read(self, start, end):
+        if self._file is None:
+            self._file = open(self.file_path, 'rb')
+        self._file.seek(start)
+        return self._file.read(end - start)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('record {} out of range for {}'.format(idx, self.file_path))
+        return _unpack_record(self._read(int(self.offsets[idx]), int(self.offsets[idx + 1])))
+
+    def __iter__(self):
+        # records are read one at a time, the shard is never loaded into memory as a whole
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _convert(args):
+    tsv_path, prefix = args
+    return convert_tsv_to_shard(tsv_path, prefix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert TSV image-text shards to binary shards.')
+    parser.add_argument('tsv_paths', nargs='+', help='TSV shards to convert')
+    parser.add_argument('--output-dir', required=True,
+                        help='directory of the binary shards, named as the TSV shards with .bin/.idx suffixes')
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    jobs = [(tsv_path, os.path.join(args.output_dir, os.path.splitext(os.path.basename(tsv_path))[0]))
+            for tsv_path in args.tsv_paths]
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers) as pool:
+            num_records = sum(pool.imap_unordered(_convert, jobs))
+    else:
+        num_records = sum(map(_convert, jobs))
+    logger.info('Converted {} shards with {} records'.format(len(jobs), num_records))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s', level=logging.INFO)
+    main()
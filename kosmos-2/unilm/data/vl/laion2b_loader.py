@@ -28,6 +28,8 @@ from infinibatch import iterators
 from unilm.data.basic_loader import BaseBatchGen
 from unilm.data.utils import NativeCheckpointableIterator, WeightIterator
 from unilm.data.vl.vl_base_loader import VLBaseLoader
+from unilm.data.vl.image_text_shard import ImageTextShard, decode_image_bytes, is_image_text_shard
+from unilm.data.vl.image_decode import ImageDecoder
 
 from PIL import Image
 import base64
@@ -68,6 +70,16 @@ class NumpyNormalize(torch.nn.Module):
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}(mean={self.mean}, std={self.std})"
 
+def decode_sample_image(decoder, sample):
+    # sample as returned by Laion2BLoader._prepare, with the encoded image in place of the image array
+    if not isinstance(sample[1], (bytes, str)):
+        return sample
+    try:
+        image = decoder(sample[1])
+    except:
+        return None # skip bad image
+    return sample[:1] + (image,) + sample[2:]
+
 class Laion2BLoader(VLBaseLoader):
     def _setup(self):
         self.max_image_num = self.args.max_image_num
@@ -91,6 +103,18 @@ class Laion2BLoader(VLBaseLoader):
             NumpyNormalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
         ])
         return preprocess_image
+
+    def _tokenize_foreach_lang(self, data):
+        tokenized_lines = super()._tokenize_foreach_lang(data)
+        image_decode_workers = getattr(self.args, 'image_decode_workers', 0)
+        if image_decode_workers > 0:
+            # images are decoded near the input resolution on a process pool instead of inline in _read_from_files
+            decoder = ImageDecoder(self.input_resolution, center_crop=not getattr(self, 'training_image_only_resize', False))
+            tokenized_lines = iterators.PipelinedParallelMapIterator(
+                tokenized_lines, partial(decode_sample_image, decoder), image_decode_workers, num_items_per_process=8)
+            tokenized_lines = iterators.SelectManyIterator(
+                tokenized_lines, lambda sample: [sample] if sample is not None else [])
+        return tokenized_lines
     
     def _build_text_transform(self):
         def text_transform(text):
@@ -203,15 +227,22 @@ class Laion2BLoader(VLBaseLoader):
         if not os.path.exists(file_path):
             print('| file {} not exists'.format(file_path), flush=True)
             return iter([]) # skip bad file
-        try:
-            with open(file_path, 'r', encoding='utf8') as f:
-                lines = f.read().strip().split('\n')
-        except:
-            return iter([]) # skip bad file
+        if is_image_text_shard(file_path):
+            # binary shard, records are read one at a time
+            try:
+                items = iter(ImageTextShard(file_path))
+            except:
+                return iter([]) # skip bad file
+        else:
+            try:
+                with open(file_path, 'r', encoding='utf8') as f:
+                    lines = f.read().strip().split('\n')
+            except:
+                return iter([]) # skip bad file
+            items = (doc_str.strip().split('\t') for doc_str in lines)
 
-        for doc_str in lines:
+        for item in items:
             json_obj = {}
-            item = doc_str.strip().split('\t')
 
             # tsv_str = "{}\t{}\t{}\t{}\t{}\n".format(meta_info["hash"], text_data, encoded_string, meta_info["width"], meta_info["height"])
           
@@ -227,9 +258,12 @@ class Laion2BLoader(VLBaseLoader):
             
             try:
                 json_obj[CAPTION_KEY] = self.text_transform(item[1])
-                pil_img = Image.open(io.BytesIO(base64.b64decode(item[2]))).convert("RGB")
-                torch_tensor = self.image_transform(pil_img)
-                json_obj[IMAGE_KEY] = torch_tensor
+                if getattr(self.args, 'image_decode_workers', 0) > 0:
+                    json_obj[IMAGE_KEY] = item[2] # decoded by decode_sample_image
+                else:
+                    pil_img = Image.open(io.BytesIO(decode_image_bytes(item[2]))).convert("RGB")
+                    torch_tensor = self.image_transform(pil_img)
+                    json_obj[IMAGE_KEY] = torch_tensor
                 yield json_obj
             except:
                 continue
@@ -32,6 +32,7 @@ from unilm.data.basic_loader import BaseBatchGen
 from unilm.data.utils import NativeCheckpointableIterator, WeightIterator
 from unilm.data.vl.vl_base_loader import VLBaseLoader
 from unilm.data.vl.laion2b_loader import Laion2BLoader, NumpyNormalize
+from unilm.data.vl.image_text_shard import ImageTextShard, decode_image_bytes, is_image_text_shard
 from unilm.data.vl.obj_utils import *
 
 from PIL import Image
@@ -249,16 +250,23 @@ class Laion2BObjLoader(Laion2BLoader):
         if not os.path.exists(file_path):
             print('| file {} not exists'.format(file_path), flush=True)
             return iter([]) # skip bad file
-        try:
-            with open(file_path, 'r', encoding='utf8') as f:
-                lines = f.read().strip().split('\n')
-        except:
-            return iter([]) # skip bad file
+        if is_image_text_shard(file_path):
+            # binary shard, records are read one at a time
+            try:
+                items = iter(ImageTextShard(file_path))
+            except:
+                return iter([]) # skip bad file
+        else:
+            try:
+                with open(file_path, 'r', encoding='utf8') as f:
+                    lines = f.read().strip().split('\n')
+            except:
+                return iter([]) # skip bad file
+            items = (doc_str.strip().split('\t') for doc_str in lines)
         print(file_path)
         
-        for doc_str in lines:
+        for item in items:
             json_obj = {}
-            item = doc_str.strip().split('\t')
                 
             # filter item based self.filter
             if 'laion2b' in source_file: # filter out bad image on laion dataset
@@ -278,10 +286,15 @@ class Laion2BObjLoader(Laion2BLoader):
                 caption = item[1]
                 
                 # read image and transform it
-                pil_img = Image.open(io.BytesIO(base64.b64decode(item[2]))).convert("RGB")
-                ori_img_w, ori_img_h = pil_img.size
-                torch_tensor = self.image_transform(pil_img)
-                json_obj[IMAGE_KEY] = torch_tensor
+                if getattr(self.args, 'image_decode_workers', 0) > 0:
+                    image = decode_image_bytes(item[2])
+                    ori_img_w, ori_img_h = Image.open(io.BytesIO(image)).size # only reads the header
+                    json_obj[IMAGE_KEY] = image # decoded by decode_sample_image
+                else:
+                    pil_img = Image.open(io.BytesIO(decode_image_bytes(item[2]))).convert("RGB")
+                    ori_img_w, ori_img_h = pil_img.size
+                    torch_tensor = self.image_transform(pil_img)
+                    json_obj[IMAGE_KEY] = torch_tensor
                 
                 # mix_no_object_prob is the hyper to control whether using data without bbox labels
                 if len(item) < 6 and random.random() < self.mix_no_object_prob:
@@ -37,6 +37,7 @@ class ImageGPTPretrainingConfig(GPTPretrainingConfig, WdsLoaderConfig):
     locate_special_token: int = field(default=1, metadata={"help": "used special token (grounding) reprsent need to ouput bbox"})
     phrase_mode: str = field(default="expression", metadata={"help": "mode in phrase,expression"})
     training_image_only_resize: int = field(default=0, metadata={"help": "only use resize transform during pretraining"})
+    image_decode_workers: int = field(default=0, metadata={"help": "number of processes decoding the laion images at reduced resolution, 0 decodes them inline"})
     
     # some parameters to filter the bounding box used for pretraining
     box_score_threshold: float = field(default=0.65, metadata={"help": "filter the box with low confidence"})
@@ -128,6 +128,8 @@ def main():
                         help="Sharing segment embeddings for the encoder of S2S (used with --s2s_add_segment).")
     parser.add_argument('--pos_shift', action='store_true',
                         help="Using position shift for fine-tuning.")
+    parser.add_argument('--permutation_decoding', action='store_true',
+                        help="Predict every source position exactly once, the output is always a valid reading order.")
     parser.add_argument("--cache_dir", default=None, type=str,
                         help="Where do you want to store the pre-trained models downloaded from s3")
 
@@ -213,6 +215,7 @@ def main():
             forbid_duplicate_ngrams=args.forbid_duplicate_ngrams, forbid_ignore_set=forbid_ignore_set,
             ngram_size=args.ngram_size, min_len=args.min_len, mode=args.mode,
             max_position_embeddings=args.max_seq_length, pos_shift=args.pos_shift,
+            permutation_decoding=args.permutation_decoding,
         )
 
         if args.fp16:
@@ -284,6 +287,8 @@ def main():
                         output_ids = traces.tolist()
                     for i in range(len(buf)):
                         w_ids = output_ids[i]
+                        if args.permutation_decoding:
+                            w_ids = w_ids[:len(buf[i])]
                         output_buf = get_tokens_from_src_and_index(src=buf[i], index=w_ids, modifier=lambda x: x-1)
                         output_tokens = []
                         for t in output_buf:
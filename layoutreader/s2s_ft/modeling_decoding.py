@@ -468,9 +468,14 @@ class BertSelfAttention(nn.Module):
 
     def forward(self, hidden_states, attention_mask, history_states=None,
                 mask_qkv=None, seg_ids=None, key_history=None, value_history=None,
-                key_cache=None, value_cache=None,
+                key_cache=None, value_cache=None, kv_cache=None,
                 ):
-        if history_states is None:
+        if kv_cache is not None:
+            # keys and values of the previous positions are read from the cache
+            mixed_query_layer = self.query(hidden_states)
+            mixed_key_layer = F.linear(hidden_states, self.key.weight)
+            mixed_value_layer = self.value(hidden_states)
+        elif history_states is None:
             mixed_query_layer = self.query(hidden_states)
             # possible issue: https://github.com/NVIDIA/apex/issues/131
             mixed_key_layer = F.linear(hidden_states, self.key.weight)
@@ -498,6 +503,9 @@ class BertSelfAttention(nn.Module):
             key_layer = torch.cat((key_history, key_layer), dim=-2)
             value_layer = torch.cat((value_history, value_layer), dim=-2)
 
+        if kv_cache is not None:
+            key_layer, value_layer = kv_cache.update(key_layer, value_layer)
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         # (batch, head, pos, pos)
         attention_scores = torch.matmul(
@@ -564,10 +572,11 @@ class BertAttention(nn.Module):
         self.output = BertSelfOutput(config)
 
     def forward(self, input_tensor, attention_mask, history_states=None,
-                mask_qkv=None, seg_ids=None, key_history=None, value_history=None):
+                mask_qkv=None, seg_ids=None, key_history=None, value_history=None, kv_cache=None):
         self_output = self.self(
             input_tensor, attention_mask, history_states=history_states,
-            mask_qkv=mask_qkv, seg_ids=seg_ids, key_history=key_history, value_history=value_history)
+            mask_qkv=mask_qkv, seg_ids=seg_ids, key_history=key_history, value_history=value_history,
+            kv_cache=kv_cache)
         attention_output = self.output(self_output, input_tensor)
         return attention_output
 
@@ -638,10 +647,11 @@ class BertLayer(nn.Module):
             self.output = BertOutput(config)
 
     def forward(self, hidden_states, attention_mask, history_states=None,
-                mask_qkv=None, seg_ids=None, key_history=None, value_history=None):
+                mask_qkv=None, seg_ids=None, key_history=None, value_history=None, kv_cache=None):
         attention_output = self.attention(
             hidden_states, attention_mask, history_states=history_states,
-            mask_qkv=mask_qkv, seg_ids=seg_ids, key_history=key_history, value_history=value_history)
+            mask_qkv=mask_qkv, seg_ids=seg_ids, key_history=key_history, value_history=value_history,
+            kv_cache=kv_cache)
         if self.ffn_type:
             layer_output = self.ffn(attention_output)
         else:
@@ -658,12 +668,19 @@ class BertEncoder(nn.Module):
                                     for _ in range(config.num_hidden_layers)])
 
     def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True, prev_embedding=None,
-                prev_encoded_layers=None, mask_qkv=None, seg_ids=None, key_history=None, value_history=None):
+                prev_encoded_layers=None, mask_qkv=None, seg_ids=None, key_history=None, value_history=None,
+                kv_caches=None):
         # history embedding and encoded layer must be simultanously given
         assert (prev_embedding is None) == (prev_encoded_layers is None)
 
         all_encoder_layers = []
-        if (prev_embedding is not None) and (prev_encoded_layers is not None):
+        if kv_caches is not None:
+            for i, layer_module in enumerate(self.layer):
+                hidden_states = layer_module(
+                    hidden_states, attention_mask, mask_qkv=mask_qkv, seg_ids=seg_ids, kv_cache=kv_caches[i])
+                if output_all_encoded_layers:
+                    all_encoder_layers.append(hidden_states)
+        elif (prev_embedding is not None) and (prev_encoded_layers is not None):
             history_states = prev_embedding
             for i, layer_module in enumerate(self.layer):
                 hidden_states = layer_module(
@@ -764,11 +781,11 @@ class LayoutlmSPLMPredictionHead(nn.Module):
 
             hidden_states = torch.einsum('btf,bsf->bts',
                                          self.type_converter(hidden_states), self.type_converter(src_emb)) + \
-                            self.type_converter(self.bias)
+                            self.type_converter(self.bias[:src_emb.size(1)])
             # hidden_states = F.linear(self.type_converter(hidden_states), self.type_converter(
             #     self.decoder.weight), self.type_converter(self.bias))
         else:
-            hidden_states = torch.einsum('btf,bsf->bts', hidden_states, src_emb) + self.bias
+            hidden_states = torch.einsum('btf,bsf->bts', hidden_states, src_emb) + self.bias[:src_emb.size(1)]
         return hidden_states
 
 
@@ -1081,7 +1098,7 @@ class BertModelIncr(BertModel):
         super(BertModelIncr, self).__init__(config)
 
     def forward(self, input_ids, token_type_ids, position_ids, attention_mask, output_all_encoded_layers=True,
-                prev_embedding=None, prev_encoded_layers=None, mask_qkv=None, task_idx=None):
+                prev_embedding=None, prev_encoded_layers=None, mask_qkv=None, task_idx=None, kv_caches=None):
         extended_attention_mask = self.get_extended_attention_mask(
             input_ids, token_type_ids, attention_mask)
 
@@ -1092,7 +1109,7 @@ class BertModelIncr(BertModel):
                                       output_all_encoded_layers=output_all_encoded_layers,
                                       prev_embedding=prev_embedding,
                                       prev_encoded_layers=prev_encoded_layers, mask_qkv=mask_qkv,
-                                      seg_ids=token_type_ids)
+                                      seg_ids=token_type_ids, kv_caches=kv_caches)
         sequence_output = encoded_layers[-1]
         pooled_output = self.pooler(sequence_output)
         if not output_all_encoded_layers:
@@ -1106,7 +1123,7 @@ class LayoutlmModelIncr(LayoutlmModel):
         super(LayoutlmModelIncr, self).__init__(config)
 
     def forward(self, input_ids, token_type_ids, position_ids, attention_mask, output_all_encoded_layers=True,
-                prev_embedding=None, prev_encoded_layers=None, mask_qkv=None, task_idx=None):
+                prev_embedding=None, prev_encoded_layers=None, mask_qkv=None, task_idx=None, kv_caches=None):
         extended_attention_mask = self.get_extended_attention_mask(
             input_ids[:, :, 0], token_type_ids, attention_mask)
 
@@ -1117,7 +1134,7 @@ class LayoutlmModelIncr(LayoutlmModel):
                                       output_all_encoded_layers=output_all_encoded_layers,
                                       prev_embedding=prev_embedding,
                                       prev_encoded_layers=prev_encoded_layers, mask_qkv=mask_qkv,
-                                      seg_ids=token_type_ids)
+                                      seg_ids=token_type_ids, kv_caches=kv_caches)
         sequence_output = encoded_layers[-1]
         pooled_output = self.pooler(sequence_output)
         if not output_all_encoded_layers:
@@ -1126,13 +1143,56 @@ class LayoutlmModelIncr(LayoutlmModel):
         return embedding_output, encoded_layers, pooled_output
 
 
+class KVCache(object):
+    """Preallocated keys and values of one attention layer for incremental decoding.
+
+    `update` writes the keys / values of the current positions after the committed ones and
+    returns views over all of them; only `commit`-ed positions are kept for the next step, so
+    the trailing [MASK] position of the s2s mode is simply overwritten.
+    """
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self.length = 0
+        self.key = None
+        self.value = None
+
+    def update(self, key_layer, value_layer):
+        # key_layer, value_layer: (batch, head, pos, head_hid)
+        if self.key is None:
+            batch_size, num_heads, _, head_size = key_layer.size()
+            self.key = key_layer.new_empty(batch_size, num_heads, self.max_length, head_size)
+            self.value = value_layer.new_empty(batch_size, num_heads, self.max_length, head_size)
+        end = self.length + key_layer.size(2)
+        self.key[:, :, self.length:end].copy_(key_layer)
+        self.value[:, :, self.length:end].copy_(value_layer)
+        return self.key[:, :, :end], self.value[:, :, :end]
+
+    def commit(self, num_positions):
+        self.length += num_positions
+
+    def reorder(self, index):
+        # index: (new_batch,) rows of the current cache, e.g. the flattened beam back-pointers
+        if self.key is None:
+            return
+        if index.size(0) == self.key.size(0):
+            self.key[:, :, :self.length] = self.key[index, :, :self.length]
+            self.value[:, :, :self.length] = self.value[index, :, :self.length]
+        else:
+            key, value = self.key, self.value
+            self.key = key.new_empty((index.size(0),) + key.size()[1:])
+            self.value = value.new_empty((index.size(0),) + value.size()[1:])
+            self.key[:, :, :self.length] = key[index, :, :self.length]
+            self.value[:, :, :self.length] = value[index, :, :self.length]
+
+
 class LayoutlmForSeq2SeqDecoder(PreTrainedBertModel):
     """refer to BertForPreTraining"""
 
     def __init__(self, config, mask_word_id=0, num_labels=2, num_rel=0,
                  search_beam_size=1, length_penalty=1.0, eos_id=0, sos_id=0,
                  forbid_duplicate_ngrams=False, forbid_ignore_set=None, ngram_size=3, min_len=0, mode="s2s",
-                 pos_shift=False):
+                 pos_shift=False, use_kv_cache=True, permutation_decoding=False):
         super(LayoutlmForSeq2SeqDecoder, self).__init__(config)
 
         self.layout_flag = config.base_model_type == 'layoutlm'
@@ -1164,6 +1224,27 @@ class LayoutlmForSeq2SeqDecoder(PreTrainedBertModel):
         assert mode in ("s2s", "l2r")
         self.mode = mode
         self.pos_shift = pos_shift
+        # per-position qkv selection and segment embeddings need the hidden states of the history
+        self.use_kv_cache = use_kv_cache and getattr(config, 'num_qkv', 0) <= 1 and not getattr(config, 'seg_emb', False)
+        # every source position is predicted exactly once
+        self.permutation_decoding = permutation_decoding
+
+    @staticmethod
+    def init_used_positions(attention_mask, input_length):
+        # index 0 ([CLS]) is the end of the sequence, 1..n point to the n source tokens;
+        # the last query attends to [CLS], the source tokens and [SEP] but not the source padding
+        num_src_tokens = attention_mask[:, -1, :input_length].sum(dim=-1) - 2
+        max_src_tokens = int(num_src_tokens.max())
+        index = torch.arange(max_src_tokens + 1, device=attention_mask.device).unsqueeze(0)
+        used = (index == 0) | (index > num_src_tokens.unsqueeze(1))
+        return used, max_src_tokens
+
+    @staticmethod
+    def mask_used_positions(prediction_scores, used):
+        # once all the source tokens are used, only the end index is left
+        allowed = ~used
+        allowed[:, 0] = used[:, 1:].all(dim=-1)
+        return prediction_scores.masked_fill(~allowed.unsqueeze(1), -10000.0)
 
     def forward(self, input_ids, token_type_ids, position_ids, attention_mask, task_idx=None, mask_qkv=None):
         if self.search_beam_size > 1:
@@ -1179,6 +1260,7 @@ class LayoutlmForSeq2SeqDecoder(PreTrainedBertModel):
         output_ids = []
         prev_embedding = None
         prev_encoded_layers = None
+        kv_caches = [KVCache(output_length) for _ in self.bert.encoder.layer] if self.use_kv_cache else None
         curr_ids = input_ids
 
         if not self.layout_flag:
@@ -1196,8 +1278,12 @@ class LayoutlmForSeq2SeqDecoder(PreTrainedBertModel):
                 sos_ids[:, :, 0] = self.sos_id
 
         src_embedding = None
+        end_pos = output_length
+        if self.permutation_decoding:
+            used, max_src_tokens = self.init_used_positions(attention_mask, input_length)
+            end_pos = min(output_length, input_length + max_src_tokens)
 
-        while next_pos < output_length:
+        while next_pos < end_pos:
             curr_length = list(curr_ids.size())[1]
 
             if self.pos_shift:
@@ -1220,20 +1306,31 @@ class LayoutlmForSeq2SeqDecoder(PreTrainedBertModel):
             new_embedding, new_encoded_layers, _ = \
                 self.bert(x_input_ids, curr_token_type_ids, curr_position_ids, curr_attention_mask,
                           output_all_encoded_layers=True, prev_embedding=prev_embedding,
-                          prev_encoded_layers=prev_encoded_layers, mask_qkv=mask_qkv)
+                          prev_encoded_layers=prev_encoded_layers, mask_qkv=mask_qkv, kv_caches=kv_caches)
 
             if src_embedding is None:
                 # note: cut three embedding: CLS (1st), ..., SEP (-2nd), next to pred (-1st)
                 # note: (NEW) the sep is kept for ignore index in loss func (for padding's index)
                 # NOTE: only remove the next to pred token
                 src_embedding = new_embedding[:, :-1, :]
+                if self.permutation_decoding:
+                    src_embedding = src_embedding[:, :used.size(1), :]
 
             last_hidden = new_encoded_layers[-1][:, -1:, :]
             prediction_scores, _ = self.cls(last_hidden, None, src_embedding, task_idx=task_idx)
+            if self.permutation_decoding:
+                prediction_scores = self.mask_used_positions(prediction_scores, used)
             _, max_ids = torch.max(prediction_scores, dim=-1)
             output_ids.append(max_ids)
-
-            if self.pos_shift:
+            if self.permutation_decoding:
+                used.scatter_(1, max_ids, True)
+
+            if kv_caches is not None:
+                # the trailing [MASK] of the s2s mode is not part of the history
+                num_new_positions = x_input_ids.size(1) if self.pos_shift else x_input_ids.size(1) - 1
+                for kv_cache in kv_caches:
+                    kv_cache.commit(num_new_positions)
+            elif self.pos_shift:
                 if prev_embedding is None:
                     prev_embedding = new_embedding
                 else:
@@ -1303,6 +1400,7 @@ class LayoutlmForSeq2SeqDecoder(PreTrainedBertModel):
         output_ids = []
         prev_embedding = None
         prev_encoded_layers = None
+        kv_caches = [KVCache(output_length) for _ in self.bert.encoder.layer] if self.use_kv_cache else None
         curr_ids = input_ids
         # mask_ids = input_ids.new(batch_size, 1).fill_(self.mask_word_id)
         if not self.layout_flag:
@@ -1330,8 +1428,12 @@ class LayoutlmForSeq2SeqDecoder(PreTrainedBertModel):
         buf_matrix = None
 
         src_embedding = None
+        end_pos = output_length
+        if self.permutation_decoding:
+            used, max_src_tokens = self.init_used_positions(attention_mask, input_length)
+            end_pos = min(output_length, input_length + max_src_tokens)
 
-        while next_pos < output_length:
+        while next_pos < end_pos:
             curr_length = list(curr_ids.size())[1]
 
             if self.pos_shift:
@@ -1352,7 +1454,7 @@ class LayoutlmForSeq2SeqDecoder(PreTrainedBertModel):
             new_embedding, new_encoded_layers, _ = \
                 self.bert(x_input_ids, curr_token_type_ids, curr_position_ids, curr_attention_mask,
                           output_all_encoded_layers=True, prev_embedding=prev_embedding,
-                          prev_encoded_layers=prev_encoded_layers, mask_qkv=mask_qkv)
+                          prev_encoded_layers=prev_encoded_layers, mask_qkv=mask_qkv, kv_caches=kv_caches)
 
             def first_expand(x):
                 input_shape = list(x.size())
@@ -1365,19 +1467,29 @@ class LayoutlmForSeq2SeqDecoder(PreTrainedBertModel):
 
             if src_embedding is None:
                 src_embedding = new_embedding[:, :-1, :]
+                if self.permutation_decoding:
+                    src_embedding = src_embedding[:, :used.size(1), :]
 
             if src_embedding.shape[0] != new_embedding.shape[0]:
                 src_embedding = first_expand(src_embedding)
 
             last_hidden = new_encoded_layers[-1][:, -1:, :]
             prediction_scores, _ = self.cls(last_hidden, None, src_embedding, task_idx=task_idx)
+            if self.permutation_decoding:
+                prediction_scores = self.mask_used_positions(prediction_scores, used)
             log_scores = torch.nn.functional.log_softmax(
                 prediction_scores, dim=-1)
             # if forbid_word_mask is not None:
             #     log_scores += (forbid_word_mask * -10000.0)
             # if self.min_len and (next_pos - input_length + 1 <= self.min_len):
             #     log_scores[:, :, self.eos_id].fill_(-10000.0)
-            kk_scores, kk_ids = torch.topk(log_scores, k=K)
+            num_candidates = min(K, log_scores.size(-1))
+            kk_scores, kk_ids = torch.topk(log_scores, k=num_candidates)
+            if num_candidates < K:
+                # fewer pointer candidates than beams (short sources with permutation decoding),
+                # the padding points to the end index with a score that never wins
+                kk_scores = F.pad(kk_scores, (0, K - num_candidates), value=-10000.0)
+                kk_ids = F.pad(kk_ids, (0, K - num_candidates), value=0)
             if len(total_scores) == 0:
                 k_ids = torch.reshape(kk_ids, [batch_size, K])
                 back_ptrs = torch.zeros(batch_size, K, dtype=torch.long)
@@ -1395,7 +1507,11 @@ class LayoutlmForSeq2SeqDecoder(PreTrainedBertModel):
                 k_ids = torch.gather(kk_ids, 1, k_ids)
             step_back_ptrs.append(back_ptrs)
             step_ids.append(k_ids)
-            beam_masks.append(torch.eq(k_ids, self.eos_id).type_as(kk_scores))
+            if self.permutation_decoding:
+                # a finished hypothesis only continues with the end index at no cost
+                beam_masks.append(torch.zeros_like(k_scores))
+            else:
+                beam_masks.append(torch.eq(k_ids, self.eos_id).type_as(kk_scores))
             total_scores.append(k_scores)
 
             # def first_expand(x):
@@ -1423,9 +1539,24 @@ class LayoutlmForSeq2SeqDecoder(PreTrainedBertModel):
                 y = torch.reshape(y, x_shape)
                 return y
 
-            is_first = (prev_embedding is None)
+            is_first = (next_pos == input_length)
 
-            if self.pos_shift:
+            if is_first:
+                beam_index = torch.arange(batch_size, device=input_ids.device).repeat_interleave(K)
+            else:
+                beam_offsets = torch.arange(batch_size, device=input_ids.device).unsqueeze(1) * K
+                beam_index = (back_ptrs + beam_offsets).view(-1)
+
+            if self.permutation_decoding:
+                used = used[beam_index]
+                used.scatter_(1, k_ids.view(-1, 1), True)
+
+            if kv_caches is not None:
+                num_new_positions = x_input_ids.size(1) if self.pos_shift else x_input_ids.size(1) - 1
+                for kv_cache in kv_caches:
+                    kv_cache.commit(num_new_positions)
+                    kv_cache.reorder(beam_index)
+            elif self.pos_shift:
                 if prev_embedding is None:
                     prev_embedding = first_expand(new_embedding)
                 else:
@@ -1556,8 +1687,10 @@ class LayoutlmForSeq2SeqDecoder(PreTrainedBertModel):
             # first we need to find the eos frame where all symbols are eos
             # any frames after the eos frame are invalid
             last_frame_id = len(scores) - 1
+            # with permutation decoding, the hypotheses are only complete at the last frame
+            eos_id = -1 if self.permutation_decoding else self.eos_id
             for i, wids in enumerate(wids_list):
-                if all(wid == self.eos_id for wid in wids):
+                if all(wid == eos_id for wid in wids):
                     last_frame_id = i
                     break
             max_score = -math.inf
@@ -1566,7 +1699,7 @@ class LayoutlmForSeq2SeqDecoder(PreTrainedBertModel):
 
             for fid in range(last_frame_id + 1):
                 for i, wid in enumerate(wids_list[fid]):
-                    if wid == self.eos_id or fid == last_frame_id:
+                    if wid == eos_id or fid == last_frame_id:
                         s = scores[fid][i]
                         if self.length_penalty > 0:
                             s /= math.pow((5 + fid + 1) / 6.0,
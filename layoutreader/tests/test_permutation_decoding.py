@@ -0,0 +1,80 @@
+import unittest
+
+import torch
+
+from s2s_ft.modeling_decoding import BertConfig, LayoutlmForSeq2SeqDecoder
+
+SRC_LEN, TGT_LEN, VOCAB_SIZE, MASK_ID = 8, 6, 32, 3
+
+
+def _build_model(beam_size, use_kv_cache=True, permutation_decoding=True):
+    torch.manual_seed(0)
+    config = BertConfig.from_dict({
+        'vocab_size': VOCAB_SIZE, 'hidden_size': 16, 'num_hidden_layers': 2, 'num_attention_heads': 2,
+        'intermediate_size': 32, 'max_position_embeddings': 64, 'hidden_dropout_prob': 0.0,
+        'attention_probs_dropout_prob': 0.0, 'base_model_type': 'bert', 'max_source_length': SRC_LEN})
+    model = LayoutlmForSeq2SeqDecoder(config, mask_word_id=MASK_ID, search_beam_size=beam_size,
+                                      use_kv_cache=use_kv_cache, permutation_decoding=permutation_decoding)
+    return model.eval()
+
+
+def _build_inputs(num_src_tokens):
+    # same layout as Preprocess4Seq2seqDecoder: [CLS] source [SEP] padding, then the target positions
+    batch_size, total_len = len(num_src_tokens), SRC_LEN + TGT_LEN
+    input_ids = torch.zeros(batch_size, SRC_LEN, dtype=torch.long)
+    token_type_ids = torch.cat([torch.zeros(batch_size, SRC_LEN, dtype=torch.long),
+                                torch.ones(batch_size, TGT_LEN, dtype=torch.long)], dim=1)
+    position_ids = torch.zeros(batch_size, total_len, dtype=torch.long)
+    attention_mask = torch.zeros(batch_size, total_len, total_len, dtype=torch.long)
+    for b, n in enumerate(num_src_tokens):
+        input_ids[b, :n + 2] = torch.tensor([1] + list(range(5, 5 + n)) + [2])
+        position_ids[b, :n + 2] = torch.arange(n + 2)
+        position_ids[b, SRC_LEN:] = torch.arange(n + 2, n + 2 + TGT_LEN)
+        attention_mask[b, :, :n + 2] = 1
+        attention_mask[b, SRC_LEN:, SRC_LEN:] = torch.tril(torch.ones(TGT_LEN, TGT_LEN, dtype=torch.long))
+    return input_ids, token_type_ids, position_ids, attention_mask
+
+
+class PermutationDecodingTest(unittest.TestCase):
+
+    def assert_permutations(self, output_ids, num_src_tokens):
+        for row, n in zip(output_ids.tolist(), num_src_tokens):
+            self.assertEqual(sorted(row[:n]), list(range(1, n + 1)))
+            self.assertTrue(all(idx == 0 for idx in row[n:]))
+
+    def test_greedy(self):
+        num_src_tokens = [4, 2]
+        with torch.no_grad():
+            output_ids = _build_model(beam_size=1)(*_build_inputs(num_src_tokens))
+        self.assertEqual(output_ids.size(1), max(num_src_tokens))
+        self.assert_permutations(output_ids, num_src_tokens)
+
+    def test_beam(self):
+        num_src_tokens = [5, 3]
+        for use_kv_cache in [True, False]:
+            with torch.no_grad():
+                traces = _build_model(beam_size=3, use_kv_cache=use_kv_cache)(*_build_inputs(num_src_tokens))
+            self.assert_permutations(traces['pred_seq'], num_src_tokens)
+
+    def test_beam_larger_than_sources(self):
+        # every source in the batch has fewer tokens than there are beams
+        num_src_tokens = [2, 1]
+        with torch.no_grad():
+            traces = _build_model(beam_size=5)(*_build_inputs(num_src_tokens))
+        self.assert_permutations(traces['pred_seq'], num_src_tokens)
+
+
+    def test_default_decoding_kv_cache(self):
+        # without permutation decoding, incremental decoding with the cache matches recomputing the history
+        num_src_tokens = [5, 3]
+        with torch.no_grad():
+            for beam_size in [1, 3]:
+                outputs = [_build_model(beam_size, use_kv_cache=use_kv_cache, permutation_decoding=False)(
+                    *_build_inputs(num_src_tokens)) for use_kv_cache in [True, False]]
+                if beam_size > 1:
+                    outputs = [output['pred_seq'] for output in outputs]
+                self.assertTrue(torch.equal(outputs[0], outputs[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
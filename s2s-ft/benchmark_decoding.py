@@ -0,0 +1,101 @@
+"""Decoding throughput of BertForSeq2SeqDecoder with and without the preallocated key/value cache."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import logging
+import argparse
+import random
+import torch
+
+from s2s_ft.modeling_decoding import BertForSeq2SeqDecoder, BertConfig
+import s2s_ft.s2s_loader as seq2seq_loader
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def build_batches(args, vocab_size):
+    # random sources in the format of decode_seq2seq.py, token ids are used as token strings
+    pipeline = seq2seq_loader.Preprocess4Seq2seqDecoder(
+        [str(i) for i in range(vocab_size)], lambda tokens: [int(tk) for tk in tokens], args.max_seq_length,
+        max_tgt_length=args.max_tgt_length, pos_shift=args.pos_shift,
+        cls_token='101', sep_token='102', pad_token='0')
+    max_src_length = args.max_seq_length - 2 - args.max_tgt_length
+    batches = []
+    for _ in range(args.num_batches):
+        instances = []
+        for _ in range(args.batch_size):
+            tokens = [str(random.randint(1000, vocab_size - 1)) for _ in range(max_src_length)]
+            instances.append(pipeline((tokens, max_src_length)))
+        batches.append(seq2seq_loader.batch_list_to_batch_tensors(instances))
+    return batches
+
+
+def decode(model, batches, device):
+    outputs = []
+    start_time = time.time()
+    with torch.no_grad():
+        for batch in batches:
+            input_ids, token_type_ids, position_ids, input_mask, mask_qkv, task_idx = \
+                [t.to(device) if t is not None else None for t in batch]
+            outputs.append(model(input_ids, token_type_ids, position_ids, input_mask,
+                                 task_idx=task_idx, mask_qkv=mask_qkv))
+    return outputs, time.time() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config_path", default=None, type=str,
+                        help="Model config, a randomly initialized BERT-base model is used if not given.")
+    parser.add_argument('--max_seq_length', type=int, default=512)
+    parser.add_argument('--max_tgt_length', type=int, default=48)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_batches', type=int, default=2)
+    parser.add_argument('--beam_size', type=int, default=1)
+    parser.add_argument('--pos_shift', action='store_true')
+    parser.add_argument('--no_cuda', action='store_true')
+    parser.add_argument('--seed', type=int, default=123)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    if args.config_path:
+        config = BertConfig.from_json_file(args.config_path)
+    else:
+        config = BertConfig(30522, max_position_embeddings=args.max_seq_length)
+    batches = build_batches(args, config.vocab_size)
+
+    state_dict = None
+    results = {}
+    for use_kv_cache in (False, True):
+        model = BertForSeq2SeqDecoder(
+            config, mask_word_id=103, search_beam_size=args.beam_size, eos_id=102, sos_id=102,
+            pos_shift=args.pos_shift, use_kv_cache=use_kv_cache)
+        if state_dict is None:
+            state_dict = model.state_dict()
+        model.load_state_dict(state_dict)
+        model.to(device)
+        model.eval()
+
+        outputs, elapsed = decode(model, batches, device)
+        num_tokens = args.num_batches * args.batch_size * args.max_tgt_length
+        results[use_kv_cache] = outputs
+        logger.info("use_kv_cache=%s: %.2f seconds, %.1f target tokens / second",
+                    use_kv_cache, elapsed, num_tokens / elapsed)
+
+    if args.beam_size > 1:
+        same = all(torch.equal(x['pred_seq'], y['pred_seq']) for x, y in zip(results[False], results[True]))
+    else:
+        same = all(torch.equal(x, y) for x, y in zip(results[False], results[True]))
+    logger.info("Same outputs: %s", same)
+
+
+if __name__ == "__main__":
+    main()
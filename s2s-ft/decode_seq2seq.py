@@ -9,12 +9,13 @@ import json
 import glob
 import logging
 import argparse
-import math
 from tqdm import tqdm
 import numpy as np
 import torch
 import random
-import pickle
+import queue
+import threading
+import torch.multiprocessing as mp
 
 from s2s_ft.modeling_decoding import BertForSeq2SeqDecoder, BertConfig
 from transformers.tokenization_bert import whitespace_tokenize
@@ -61,6 +62,208 @@ def ascii_print(text):
     print(text)
 
 
+def load_tokenizer(args):
+    tokenizer = TOKENIZER_CLASSES[args.model_type].from_pretrained(
+        args.tokenizer_name, do_lower_case=args.do_lower_case, 
+        cache_dir=args.cache_dir if args.cache_dir else None)
+
+    if args.model_type == "roberta":
+        vocab = tokenizer.encoder
+    elif args.model_type == "xlm-roberta":
+        vocab = {}
+        for tk_id in range(len(tokenizer)):
+            tk = tokenizer._convert_id_to_token(tk_id)
+            vocab[tk] = tk_id
+    else:
+        vocab = tokenizer.vocab
+
+    if hasattr(tokenizer, 'model_max_length'):
+        tokenizer.model_max_length = args.max_seq_length
+    elif hasattr(tokenizer, 'max_len'):
+        tokenizer.max_len = args.max_seq_length
+    return tokenizer, vocab
+
+
+def load_model(args, model_recover_path, tokenizer, vocab, device):
+    mask_word_id, eos_word_ids, sos_word_id = tokenizer.convert_tokens_to_ids(
+        [tokenizer.mask_token, tokenizer.sep_token, tokenizer.sep_token])
+    forbid_ignore_set = None
+    if args.forbid_ignore_word:
+        w_list = []
+        for w in args.forbid_ignore_word.split('|'):
+            if w.startswith('[') and w.endswith(']'):
+                w_list.append(w.upper())
+            else:
+                w_list.append(w)
+        forbid_ignore_set = set(tokenizer.convert_tokens_to_ids(w_list))
+
+    config_file = args.config_path if args.config_path else os.path.join(model_recover_path, "config.json")
+    logger.info("Read decoding config from: %s" % config_file)
+    config = BertConfig.from_json_file(config_file)
+
+    bi_uni_pipeline = []
+    bi_uni_pipeline.append(seq2seq_loader.Preprocess4Seq2seqDecoder(
+        list(vocab.keys()), tokenizer.convert_tokens_to_ids, args.max_seq_length,
+        max_tgt_length=args.max_tgt_length, pos_shift=args.pos_shift,
+        source_type_id=config.source_type_id, target_type_id=config.target_type_id, 
+        cls_token=tokenizer.cls_token, sep_token=tokenizer.sep_token, pad_token=tokenizer.pad_token))
+
+    model = BertForSeq2SeqDecoder.from_pretrained(
+        model_recover_path, config=config, mask_word_id=mask_word_id, search_beam_size=args.beam_size,
+        length_penalty=args.length_penalty, eos_id=eos_word_ids, sos_id=sos_word_id,
+        forbid_duplicate_ngrams=args.forbid_duplicate_ngrams, forbid_ignore_set=forbid_ignore_set,
+        ngram_size=args.ngram_size, min_len=args.min_len, mode=args.mode,
+        max_position_embeddings=args.max_seq_length, pos_shift=args.pos_shift, 
+    )
+
+    if args.fp16:
+        model.half()
+    model.to(device)
+    if device.type == "cuda" and device.index is None and torch.cuda.device_count() > 1:
+        model = torch.nn.DataParallel(model)
+
+    torch.cuda.empty_cache()
+    model.eval()
+    return model, bi_uni_pipeline
+
+
+def get_batches(args, input_lines):
+    # input_lines: [(index, tokens)] sorted by decreasing length, so the first example of a batch is the longest
+    delta = 1 if args.pos_shift else 2
+    batches = []
+    next_i = 0
+    while next_i < len(input_lines):
+        if args.max_tokens > 0:
+            seq_length = min(len(input_lines[next_i][1]) + delta + args.max_tgt_length, args.max_seq_length)
+            batch_size = max(1, args.max_tokens // (seq_length * max(1, args.beam_size)))
+        else:
+            batch_size = args.batch_size
+        batches.append(input_lines[next_i:next_i + batch_size])
+        next_i += batch_size
+    return batches
+
+
+def prefetch_batches(batches, bi_uni_pipeline, num_prefetch):
+    # builds the instances and tensors of the next batches in a background thread while the model decodes
+    batch_queue = queue.Queue(maxsize=max(1, num_prefetch))
+
+    def _worker():
+        # the sentinel is None at the end of the batches, or the exception that stopped the worker
+        sentinel = None
+        try:
+            for _chunk in batches:
+                buf_id = [x[0] for x in _chunk]
+                buf = [x[1] for x in _chunk]
+                max_a_len = max([len(x) for x in buf])
+                instances = []
+                for instance in [(x, max_a_len) for x in buf]:
+                    for proc in bi_uni_pipeline:
+                        instances.append(proc(instance))
+                batch_queue.put((buf_id, buf, seq2seq_loader.batch_list_to_batch_tensors(instances)))
+        except Exception as e:
+            sentinel = e
+        finally:
+            batch_queue.put(sentinel)
+
+    worker = threading.Thread(target=_worker, daemon=True)
+    worker.start()
+    while True:
+        item = batch_queue.get()
+        if isinstance(item, Exception):
+            raise item
+        if item is None:
+            break
+        yield item
+    worker.join()
+
+
+def get_shard_file(fn_out, rank):
+    return "{}.shard{}".format(fn_out, rank)
+
+
+def decode_shard(rank, args, model_recover_path, shard_batches, fn_out):
+    """Decodes the batches of one shard, outputs and score traces are streamed as json lines tagged
+    with the index of the example."""
+    if torch.cuda.is_available() and not args.no_cuda:
+        device = torch.device("cuda", rank % torch.cuda.device_count()) if args.num_shards > 1 \
+            else torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+        if args.num_shards > 1:
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.num_shards))
+
+    tokenizer, vocab = load_tokenizer(args)
+    model, bi_uni_pipeline = load_model(args, model_recover_path, tokenizer, vocab, device)
+
+    batches = shard_batches[rank]
+    shard_file = get_shard_file(fn_out, rank)
+    fout_trace = open(shard_file + ".trace.jsonl", "w", encoding="utf-8") if args.need_score_traces else None
+    with open(shard_file, "w", encoding="utf-8") as fout, tqdm(total=len(batches), disable=rank > 0) as pbar:
+        batch_count = 0
+        for buf_id, buf, batch in prefetch_batches(batches, bi_uni_pipeline, args.num_prefetch):
+            batch_count += 1
+            with torch.no_grad():
+                batch = [
+                    t.to(device) if t is not None else None for t in batch]
+                input_ids, token_type_ids, position_ids, input_mask, mask_qkv, task_idx = batch
+                traces = model(input_ids, token_type_ids,
+                               position_ids, input_mask, task_idx=task_idx, mask_qkv=mask_qkv)
+                if args.beam_size > 1:
+                    traces = {k: v.tolist() for k, v in traces.items()}
+                    output_ids = traces['pred_seq']
+                else:
+                    output_ids = traces.tolist()
+                for i in range(len(buf)):
+                    w_ids = output_ids[i]
+                    output_buf = tokenizer.convert_ids_to_tokens(w_ids)
+                    output_tokens = []
+                    for t in output_buf:
+                        if t in (tokenizer.sep_token, tokenizer.pad_token):
+                            break
+                        output_tokens.append(t)
+                    if args.model_type == "roberta" or args.model_type == "xlm-roberta":
+                        output_sequence = tokenizer.convert_tokens_to_string(output_tokens)
+                    else:
+                        output_sequence = ' '.join(detokenize(output_tokens))
+                    if '\n' in output_sequence:
+                        output_sequence = " [X_SEP] ".join(output_sequence.split('\n'))
+                    fout.write(json.dumps({"idx": buf_id[i], "text": output_sequence}, ensure_ascii=False) + "\n")
+                    if batch_count == 1 or batch_count % 50 == 0:
+                        logger.info("{} = {}".format(buf_id[i], output_sequence))
+                    if args.need_score_traces:
+                        fout_trace.write(json.dumps({
+                            "idx": buf_id[i], 'scores': traces['scores'][i],
+                            'wids': traces['wids'][i], 'ptrs': traces['ptrs'][i]}) + "\n")
+            pbar.update(1)
+    if fout_trace is not None:
+        fout_trace.close()
+
+
+def merge_shards(args, num_samples, fn_out):
+    output_lines = [""] * num_samples
+    for rank in range(args.num_shards):
+        shard_file = get_shard_file(fn_out, rank)
+        with open(shard_file, "r", encoding="utf-8") as reader:
+            for line in reader:
+                output = json.loads(line)
+                output_lines[output["idx"]] = output["text"]
+        os.remove(shard_file)
+    with open(fn_out, "w", encoding="utf-8") as fout:
+        for l in output_lines:
+            fout.write(l)
+            fout.write("\n")
+
+    if args.need_score_traces:
+        # one json line per example in decoding order, see gen_seq_from_trace.py
+        with open(fn_out + ".trace.jsonl", "w", encoding="utf-8") as fout_trace:
+            for rank in range(args.num_shards):
+                shard_trace_file = get_shard_file(fn_out, rank) + ".trace.jsonl"
+                with open(shard_trace_file, "r", encoding="utf-8") as reader:
+                    for line in reader:
+                        fout_trace.write(line)
+                os.remove(shard_trace_file)
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -99,6 +302,14 @@ def main():
                         help="Set this flag if you are using an uncased model.")
     parser.add_argument('--batch_size', type=int, default=4,
                         help="Batch size for decoding.")
+    parser.add_argument('--max_tokens', type=int, default=0,
+                        help="Maximum number of tokens (examples x padded length x beam size) in a batch, "
+                             "batches are formed with --batch_size if it is 0.")
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help="Number of decoding processes, each one uses a GPU (round robin) "
+                             "or an equal share of the CPU cores.")
+    parser.add_argument('--num_prefetch', type=int, default=2,
+                        help="Number of batches tensorized ahead of decoding in a background thread.")
     parser.add_argument('--beam_size', type=int, default=1,
                         help="Beam size for searching")
     parser.add_argument('--length_penalty', type=float, default=0,
@@ -133,8 +344,6 @@ def main():
     if args.max_tgt_length >= args.max_seq_length - 2:
         raise ValueError("Maximum tgt length exceeds max seq length - 2.")
 
-    device = torch.device(
-        "cuda" if torch.cuda.is_available() else "cpu")
     n_gpu = torch.cuda.device_count()
 
     if args.seed > 0:
@@ -152,36 +361,8 @@ def main():
         if n_gpu > 0:
             torch.cuda.manual_seed_all(args.seed)
     
-    tokenizer = TOKENIZER_CLASSES[args.model_type].from_pretrained(
-        args.tokenizer_name, do_lower_case=args.do_lower_case, 
-        cache_dir=args.cache_dir if args.cache_dir else None)
+    tokenizer, _ = load_tokenizer(args)
 
-    if args.model_type == "roberta":
-        vocab = tokenizer.encoder
-    elif args.model_type == "xlm-roberta":
-        vocab = {}
-        for tk_id in range(len(tokenizer)):
-            tk = tokenizer._convert_id_to_token(tk_id)
-            vocab[tk] = tk_id
-    else:
-        vocab = tokenizer.vocab
-
-    if hasattr(tokenizer, 'model_max_length'):
-        tokenizer.model_max_length = args.max_seq_length
-    elif hasattr(tokenizer, 'max_len'):
-        tokenizer.max_len = args.max_seq_length
-
-    mask_word_id, eos_word_ids, sos_word_id = tokenizer.convert_tokens_to_ids(
-        [tokenizer.mask_token, tokenizer.sep_token, tokenizer.sep_token])
-    forbid_ignore_set = None
-    if args.forbid_ignore_word:
-        w_list = []
-        for w in args.forbid_ignore_word.split('|'):
-            if w.startswith('[') and w.endswith(']'):
-                w_list.append(w.upper())
-            else:
-                w_list.append(w)
-        forbid_ignore_set = set(tokenizer.convert_tokens_to_ids(w_list))
     print(args.model_path)
     found_checkpoint_flag = False
     for model_recover_path in glob.glob(args.model_path):
@@ -189,36 +370,8 @@ def main():
             continue
 
         logger.info("***** Recover model: %s *****", model_recover_path)
-
-        config_file = args.config_path if args.config_path else os.path.join(model_recover_path, "config.json")
-        logger.info("Read decoding config from: %s" % config_file)
-        config = BertConfig.from_json_file(config_file)
-
-        bi_uni_pipeline = []
-        bi_uni_pipeline.append(seq2seq_loader.Preprocess4Seq2seqDecoder(
-            list(vocab.keys()), tokenizer.convert_tokens_to_ids, args.max_seq_length,
-            max_tgt_length=args.max_tgt_length, pos_shift=args.pos_shift,
-            source_type_id=config.source_type_id, target_type_id=config.target_type_id, 
-            cls_token=tokenizer.cls_token, sep_token=tokenizer.sep_token, pad_token=tokenizer.pad_token))
-
         found_checkpoint_flag = True
-        model = BertForSeq2SeqDecoder.from_pretrained(
-            model_recover_path, config=config, mask_word_id=mask_word_id, search_beam_size=args.beam_size,
-            length_penalty=args.length_penalty, eos_id=eos_word_ids, sos_id=sos_word_id,
-            forbid_duplicate_ngrams=args.forbid_duplicate_ngrams, forbid_ignore_set=forbid_ignore_set,
-            ngram_size=args.ngram_size, min_len=args.min_len, mode=args.mode,
-            max_position_embeddings=args.max_seq_length, pos_shift=args.pos_shift, 
-        )
-
-        if args.fp16:
-            model.half()
-        model.to(device)
-        if n_gpu > 1:
-            model = torch.nn.DataParallel(model)
-
-        torch.cuda.empty_cache()
-        model.eval()
-        next_i = 0
+
         max_src_length = args.max_seq_length - 2 - args.max_tgt_length
         if args.pos_shift:
             max_src_length += 1
@@ -236,74 +389,23 @@ def main():
 
         input_lines = sorted(list(enumerate(input_lines)),
                              key=lambda x: -len(x[1]))
-        output_lines = [""] * len(input_lines)
-        score_trace_list = [None] * len(input_lines)
-        total_batch = math.ceil(len(input_lines) / args.batch_size)
-
-        with tqdm(total=total_batch) as pbar:
-            batch_count = 0
-            first_batch = True
-            while next_i < len(input_lines):
-                _chunk = input_lines[next_i:next_i + args.batch_size]
-                buf_id = [x[0] for x in _chunk]
-                buf = [x[1] for x in _chunk]
-                next_i += args.batch_size
-                batch_count += 1
-                max_a_len = max([len(x) for x in buf])
-                instances = []
-                for instance in [(x, max_a_len) for x in buf]:
-                    for proc in bi_uni_pipeline:
-                        instances.append(proc(instance))
-                with torch.no_grad():
-                    batch = seq2seq_loader.batch_list_to_batch_tensors(
-                        instances)
-                    batch = [
-                        t.to(device) if t is not None else None for t in batch]
-                    input_ids, token_type_ids, position_ids, input_mask, mask_qkv, task_idx = batch
-                    traces = model(input_ids, token_type_ids,
-                                   position_ids, input_mask, task_idx=task_idx, mask_qkv=mask_qkv)
-                    if args.beam_size > 1:
-                        traces = {k: v.tolist() for k, v in traces.items()}
-                        output_ids = traces['pred_seq']
-                    else:
-                        output_ids = traces.tolist()
-                    for i in range(len(buf)):
-                        w_ids = output_ids[i]
-                        output_buf = tokenizer.convert_ids_to_tokens(w_ids)
-                        output_tokens = []
-                        for t in output_buf:
-                            if t in (tokenizer.sep_token, tokenizer.pad_token):
-                                break
-                            output_tokens.append(t)
-                        if args.model_type == "roberta" or args.model_type == "xlm-roberta":
-                            output_sequence = tokenizer.convert_tokens_to_string(output_tokens)
-                        else:
-                            output_sequence = ' '.join(detokenize(output_tokens))
-                        if '\n' in output_sequence:
-                            output_sequence = " [X_SEP] ".join(output_sequence.split('\n'))
-                        output_lines[buf_id[i]] = output_sequence
-                        if first_batch or batch_count % 50 == 0:
-                            logger.info("{} = {}".format(buf_id[i], output_sequence))
-                        if args.need_score_traces:
-                            score_trace_list[buf_id[i]] = {
-                                'scores': traces['scores'][i], 'wids': traces['wids'][i], 'ptrs': traces['ptrs'][i]}
-                pbar.update(1)
-                first_batch = False
+        batches = get_batches(args, input_lines)
+        logger.info("Decode %d examples in %d batches with %d process(es)",
+                    len(input_lines), len(batches), args.num_shards)
+        # round robin, so every shard gets batches of all lengths
+        shard_batches = [batches[rank::args.num_shards] for rank in range(args.num_shards)]
+
         if args.output_file:
             fn_out = args.output_file
         else:
             fn_out = model_recover_path+'.'+args.split
-        with open(fn_out, "w", encoding="utf-8") as fout:
-            for l in output_lines:
-                fout.write(l)
-                fout.write("\n")
-
-        if args.need_score_traces:
-            with open(fn_out + ".trace.pickle", "wb") as fout_trace:
-                pickle.dump(
-                    {"version": 0.0, "num_samples": len(input_lines)}, fout_trace)
-                for x in score_trace_list:
-                    pickle.dump(x, fout_trace)
+
+        if args.num_shards > 1:
+            mp.spawn(decode_shard, args=(args, model_recover_path, shard_batches, fn_out),
+                     nprocs=args.num_shards, join=True)
+        else:
+            decode_shard(0, args, model_recover_path, shard_batches, fn_out)
+        merge_shards(args, len(input_lines), fn_out)
 
     if not found_checkpoint_flag:
         logger.info("Not found the model checkpoint file!")
@@ -21,8 +21,7 @@ import time
 import tempfile
 import shutil
 
-# pip install pyrouge
-from evaluations.bs_pyrouge import Rouge155
+from evaluations import rouge_scorer
 
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
@@ -49,7 +48,9 @@ default_process_count = max(1, cpu_count() - 1)
 parser.add_argument("--processes", type=int, default=default_process_count,
                     help="Number of processes to use (default %(default)s)")
 parser.add_argument("--perl", action='store_true',
-                    help="Using the perl script.")
+                    help="Report the scores of the ROUGE-1.5.5 perl script, computed in-process unless --pyrouge is set.")
+parser.add_argument("--pyrouge", action='store_true',
+                    help="Run the perl script through pyrouge for --perl.")
 parser.add_argument('--lazy_eval', action='store_true',
                     help="Skip evaluation if the .rouge file exists.")
 args = parser.parse_args()
@@ -59,7 +60,16 @@ evaluator = rouge.Rouge(metrics=['rouge-n', 'rouge-l'], max_n=2,
                         limit_length=False, apply_avg=True, weight_factor=1.2)
 
 
-def test_rouge(cand, ref):
+def test_rouge(cand, ref, processes=1):
+    if args.pyrouge:
+        return test_pyrouge(cand, ref)
+    return rouge_scorer.evaluate(cand, ref, processes=processes)
+
+
+def test_pyrouge(cand, ref):
+    # pip install pyrouge
+    from evaluations.bs_pyrouge import Rouge155
+
     temp_dir = tempfile.mkdtemp()
     candidates = cand
     references = ref
@@ -288,7 +298,7 @@ def process_eval(eval_fn):
         gold_list = gold_list[:len(pred_list)]
     assert len(pred_list) == len(gold_list)
     if args.perl:
-        scores = test_rouge(pred_list, gold_list)
+        scores = test_rouge(pred_list, gold_list, processes=args.processes)
     else:
         scores = evaluator.get_scores(pred_list, [[it] for it in gold_list])
     return eval_fn, scores
@@ -321,9 +331,14 @@ def main():
         eval_fn_list = new_eval_fn_list
 
     logger.info("***** Evaluation: %s *****", ','.join(eval_fn_list))
-    num_pool = min(args.processes, len(eval_fn_list))
-    p = Pool(num_pool)
-    r_list = p.imap_unordered(process_eval, eval_fn_list)
+    if args.perl and not args.pyrouge:
+        # the in-process scorer uses the processes for the documents of each file
+        p = None
+        r_list = map(process_eval, eval_fn_list)
+    else:
+        num_pool = min(args.processes, len(eval_fn_list))
+        p = Pool(num_pool)
+        r_list = p.imap_unordered(process_eval, eval_fn_list)
     r_list = sorted([(fn, scores)
                      for fn, scores in r_list], key=lambda x: x[0])
     rg2_dict = {}
@@ -338,8 +353,9 @@ def main():
             with open(fn+".rouge", 'w') as f_out:
                 f_out.write(json.dumps(
                     {'rg1': scores['rouge-1']['f'], 'rg2': scores['rouge-2']['f']}))
-    p.close()
-    p.join()
+    if p is not None:
+        p.close()
+        p.join()
 
     if args.save_best:
         # find best results
@@ -0,0 +1,324 @@
+"""In-process ROUGE-1/2/L scorer matching ROUGE-1.5.5.pl as run by bs_pyrouge.
+
+Reproduces `ROUGE-1.5.5.pl -c 95 -m -r 1000 -n 2 -a` on the summaries written by
+`Rouge155.convert_and_evaluate`: the same tokenisation, WordNet exception list and
+Porter stemmer, the same per-summary rounding and the same bootstrap resampling
+(including Perl's drand48 sequence), so the returned dict equals
+`Rouge155.output_to_dict` of the Perl output.
+
+ROUGE-L is the summary-level union LCS over sentences (one sentence per line),
+i.e. what other packages call ROUGE-Lsum.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+
+
+REMAP = {"-lrb-": "(", "-rrb-": ")", "-lcb-": "{", "-rcb-": "}",
+         "-lsb-": "[", "-rsb-": "]", "``": '"', "''": '"'}
+
+ROUGE_TYPES = ["rouge_1", "rouge_2", "rouge_l"]
+MEASURES = ["recall", "precision", "f_score"]
+
+_EXCEPTION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wordnet_exceptions.txt")
+_exceptions = None
+
+
+def clean(x):
+    return re.sub(
+        r"-lrb-|-rrb-|-lcb-|-rcb-|-lsb-|-rsb-|``|''",
+        lambda m: REMAP.get(m.group()), x)
+
+
+def _get_exceptions():
+    # WordNet 2.0 exception lists (adj, adv, noun, verb; later files win) as used by ROUGE's -m,
+    # restricted to the keys a token can ever match
+    global _exceptions
+    if _exceptions is None:
+        _exceptions = {}
+        with open(_EXCEPTION_FILE, "r", encoding="utf-8") as f_in:
+            for line in f_in:
+                # the file starts with the WordNet license
+                if line.startswith("#"):
+                    continue
+                word, stem = line.split()
+                _exceptions[word] = stem
+    return _exceptions
+
+
+# Porter stemmer, ported from the stem() function of ROUGE-1.5.5.pl
+_c = "[^aeiou]"
+_v = "[aeiouy]"
+_C = _c + "[^aeiouy]*"
+_V = _v + "[aeiou]*"
+_mgr0 = re.compile("^(" + _C + ")?" + _V + _C)
+_meq1 = re.compile("^(" + _C + ")?" + _V + _C + "(" + _V + ")?$")
+_mgr1 = re.compile("^(" + _C + ")?" + _V + _C + _V + _C)
+_vowel_in_stem = re.compile("^(" + _C + ")?" + _v)
+_cvc = re.compile("^" + _C + _v + "[^aeiouwxy]$")
+
+_step2list = {"ational": "ate", "tional": "tion", "enci": "ence", "anci": "ance", "izer": "ize", "bli": "ble",
+              "alli": "al", "entli": "ent", "eli": "e", "ousli": "ous", "ization": "ize", "ation": "ate",
+              "ator": "ate", "alism": "al", "iveness": "ive", "fulness": "ful", "ousness": "ous", "aliti": "al",
+              "iviti": "ive", "biliti": "ble", "logi": "log"}
+_step3list = {"icate": "ic", "ative": "", "alize": "al", "iciti": "ic", "ical": "ic", "ful": "", "ness": ""}
+_step2 = re.compile("(ational|tional|enci|anci|izer|bli|alli|entli|eli|ousli|ization|ation|ator|alism|iveness|"
+                    "fulness|ousness|aliti|iviti|biliti|logi)$")
+_step3 = re.compile("(icate|ative|alize|iciti|ical|ful|ness)$")
+# a word ending in -ement does not try the rules "-ment" and "-ent"
+_step4 = re.compile("(al|ance|ence|er|ic|able|ible|ant|ement|ou|ism|ate|iti|ous|ive|ize)$")
+
+
+def porter_stem(w):
+    if len(w) < 3:
+        return w
+    # map initial y to Y so that the patterns never treat it as vowel
+    first_y = w[0] == "y"
+    if first_y:
+        w = "Y" + w[1:]
+
+    # step 1a
+    m = re.search("(ss|i)es$", w)
+    if m:
+        w = w[:m.start()] + m.group(1)
+    else:
+        m = re.search("([^s])s$", w)
+        if m:
+            w = w[:m.start()] + m.group(1)
+    # step 1b
+    if w.endswith("eed"):
+        if _mgr0.search(w[:-3]):
+            w = w[:-1]
+    else:
+        m = re.search("(ed|ing)$", w)
+        if m and _vowel_in_stem.search(w[:m.start()]):
+            w = w[:m.start()]
+            if re.search("(at|bl|iz)$", w):
+                w += "e"
+            elif re.search(r"([^aeiouylsz])\1$", w):
+                w = w[:-1]
+            elif _cvc.search(w):
+                w += "e"
+    # step 1c
+    if w.endswith("y") and _vowel_in_stem.search(w[:-1]):
+        w = w[:-1] + "i"
+    # step 2
+    m = _step2.search(w)
+    if m and _mgr0.search(w[:m.start()]):
+        w = w[:m.start()] + _step2list[m.group(1)]
+    # step 3
+    m = _step3.search(w)
+    if m and _mgr0.search(w[:m.start()]):
+        w = w[:m.start()] + _step3list[m.group(1)]
+    # step 4
+    m = _step4.search(w)
+    if m and _mgr1.search(w[:m.start()]):
+        w = w[:m.start()]
+    if w.endswith("ment") and _mgr1.search(w[:-4]):
+        w = w[:-4]
+    if w.endswith("ent"):
+        if _mgr1.search(w[:-3]):
+            w = w[:-3]
+    else:
+        m = re.search("(s|t)(ion)$", w)
+        if m and _mgr1.search(w[:m.start()] + m.group(1)):
+            w = w[:m.start()] + m.group(1)
+    # step 5
+    if w.endswith("e"):
+        stem = w[:-1]
+        if _mgr1.search(stem) or (_meq1.search(stem) and not _cvc.search(stem)):
+            w = stem
+    if w.endswith("ll") and _mgr1.search(w):
+        w = w[:-1]
+
+    if first_y:
+        w = "y" + w[1:]
+    return w
+
+
+def tokenize(text, stem_cache=None):
+    """Splits a summary (one sentence per line) into sentences of stemmed tokens."""
+    exceptions = _get_exceptions()
+    if stem_cache is None:
+        stem_cache = {}
+    sentences = []
+    for sentence in clean(text.lower()).split("\n"):
+        # the SEE reader of ROUGE-1.5.5.pl stops at the first "<" of a sentence
+        sentence = sentence.split("<", 1)[0]
+        tokens = []
+        for token in re.findall("[a-z0-9]+", sentence):
+            if len(token) > 3:
+                if token not in stem_cache:
+                    stem_cache[token] = exceptions[token] if token in exceptions else porter_stem(token)
+                token = stem_cache[token]
+            tokens.append(token)
+        sentences.append(tokens)
+    return sentences
+
+
+def _ngrams(tokens, n):
+    return Counter(" ".join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+
+
+def _lcs_mark(model, peer, hit_mask):
+    # same DP and tie-breaking as lcs_inner/markLCS of ROUGE-1.5.5.pl,
+    # marks the model positions on the traced LCS
+    n = len(peer)
+    prev = [0] * (n + 1)
+    moves = []
+    for tok in model:
+        cur = [0] * (n + 1)
+        move = bytearray(n + 1)
+        left = 0
+        for j in range(n):
+            if tok == peer[j]:
+                left = prev[j] + 1
+                move[j + 1] = 1
+            elif prev[j + 1] >= left:
+                left = prev[j + 1]
+                move[j + 1] = 2
+            else:
+                move[j + 1] = 3
+            cur[j + 1] = left
+        moves.append(move)
+        prev = cur
+    i, j = len(model), n
+    while i != 0 and j != 0:
+        move = moves[i - 1][j]
+        if move == 1:
+            i -= 1
+            j -= 1
+            hit_mask[i] = 1
+        elif move == 2:
+            i -= 1
+        else:
+            j -= 1
+
+
+def _round(x):
+    return float("%7.5f" % x)
+
+
+def _scores(hit, model_count, peer_count):
+    recall = _round(hit / model_count) if model_count != 0 else 0.
+    precision = _round(hit / peer_count) if peer_count != 0 else 0.
+    if 0.5 * precision + 0.5 * recall > 0:
+        f_score = _round((precision * recall) / (0.5 * precision + 0.5 * recall))
+    else:
+        f_score = 0.
+    return [recall, precision, f_score]
+
+
+def score_summary(candidate, reference, stem_cache=None):
+    """Returns [R, P, F] of ROUGE-1, ROUGE-2 and ROUGE-L for one candidate/reference pair."""
+    peer = tokenize(candidate, stem_cache)
+    model = tokenize(reference, stem_cache)
+    peer_tokens = [tok for sent in peer for tok in sent]
+    model_tokens = [tok for sent in model for tok in sent]
+
+    results = []
+    for n in (1, 2):
+        peer_grams, model_grams = _ngrams(peer_tokens, n), _ngrams(model_tokens, n)
+        hit = sum(min(count, peer_grams[gram]) for gram, count in model_grams.items() if gram in peer_grams)
+        results.extend(_scores(hit, sum(model_grams.values()), sum(peer_grams.values())))
+
+    # a token is a hit if it is on the LCS with any peer sentence, clipped by the unigram counts
+    peer_1grams, model_1grams = Counter(peer_tokens), Counter(model_tokens)
+    hit = 0
+    for model_sent in model:
+        hit_mask = [0] * len(model_sent)
+        model_vocab = set(model_sent)
+        for peer_sent in peer:
+            # without a common token the traced LCS is empty
+            if not model_vocab.isdisjoint(peer_sent):
+                _lcs_mark(model_sent, peer_sent, hit_mask)
+        for tok, is_hit in zip(model_sent, hit_mask):
+            if is_hit and model_1grams[tok] > 0 and peer_1grams[tok] > 0:
+                hit += 1
+                model_1grams[tok] -= 1
+                peer_1grams[tok] -= 1
+    results.extend(_scores(hit, len(model_tokens), len(peer_tokens)))
+    return results
+
+
+def _score_chunk(pairs):
+    stem_cache = {}
+    return [score_summary(candidate, reference, stem_cache) for candidate, reference in pairs]
+
+
+def bootstrap_average(scores, num_resamples=1000, confidence=95):
+    """Bootstrap averages and confidence intervals of per-summary scores, as computeAverages of ROUGE-1.5.5.pl.
+
+    Resample i draws with srand(i) and Perl's drand48, all resamples are advanced together.
+    Returns (average, lower, upper), each of shape [num_columns].
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    num_instances = scores.shape[0]
+    state = (np.arange(num_resamples, dtype=np.uint64) << np.uint64(16)) + np.uint64(0x330E)
+    samples = np.zeros((num_resamples, scores.shape[1]), dtype=np.float64)
+    for _ in range(num_instances):
+        state = (state * np.uint64(0x5DEECE66D) + np.uint64(0xB)) & np.uint64((1 << 48) - 1)
+        ridx = (np.ldexp(state.astype(np.float64), -48) * num_instances).astype(np.int64)
+        samples += scores[ridx]
+    if num_instances > 0:
+        samples /= num_instances
+    samples = np.sort(samples, axis=0)
+
+    delta = num_resamples * ((100 - confidence) / 2.0) / 100.0
+    ci_ua = int(num_resamples - delta - 1)
+    ci_la = int(delta)
+    ci_r = num_resamples - delta - 1 - ci_ua
+    average, lower, upper = [], [], []
+    for column in samples.T.tolist():
+        total = 0.
+        for x in column:
+            total += x
+        average.append(_round(total / num_resamples))
+        lower.append(_round(column[ci_la] + (column[ci_la + 1] - column[ci_la]) * ci_r))
+        upper.append(_round(column[ci_ua] + (column[ci_ua + 1] - column[ci_ua]) * ci_r))
+    return average, lower, upper
+
+
+def evaluate(candidates, references, processes=1, num_resamples=1000, confidence=95):
+    """Scores candidate summaries against references (one reference each, sentences separated by newlines).
+
+    Returns the dict of `Rouge155.output_to_dict`, e.g. rouge_1_f_score, rouge_1_f_score_cb, rouge_1_f_score_ce.
+    """
+    assert len(candidates) == len(references)
+    # empty references are skipped, the evaluation ids of the remaining pairs follow the sorted
+    # "cand.{i}.txt" file names and the instances are resampled in the sorted order of "{id}.1"
+    doc_ids = sorted((i for i in range(len(references)) if len(references[i]) > 0),
+                     key=lambda i: "cand.{}.txt".format(i))
+    doc_ids = [i for _, i in sorted(("{}.1".format(task_id), i) for task_id, i in enumerate(doc_ids, start=1))]
+    pairs = [(candidates[i], references[i]) for i in doc_ids]
+
+    chunk_size = max(1, min(256, len(pairs) // max(1, processes * 4)))
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    if processes > 1 and len(chunks) > 1:
+        with Pool(min(processes, len(chunks))) as pool:
+            chunk_scores = pool.map(_score_chunk, chunks)
+    else:
+        chunk_scores = [_score_chunk(chunk) for chunk in chunks]
+    scores = [score for chunk in chunk_scores for score in chunk]
+    if not scores:
+        scores = np.zeros((0, len(ROUGE_TYPES) * len(MEASURES)))
+
+    average, lower, upper = bootstrap_average(scores, num_resamples=num_resamples, confidence=confidence)
+    results = {}
+    column = 0
+    for rouge_type in ROUGE_TYPES:
+        for measure in MEASURES:
+            key = "{}_{}".format(rouge_type, measure)
+            results[key] = average[column]
+            results["{}_cb".format(key)] = lower[column]
+            results["{}_ce".format(key)] = upper[column]
+            column += 1
+    return results
@@ -1,3 +1,4 @@
+import json
 import pickle
 import math
 import argparse
@@ -28,6 +29,15 @@ TOKENIZER_CLASSES = {
 
 
 def read_traces_from_file(file_name):
+    if file_name.endswith(".jsonl"):
+        # written by decode_seq2seq.py in decoding order, one example per line
+        samples = {}
+        with open(file_name, "r", encoding="utf-8") as fin:
+            for line in fin:
+                sample = json.loads(line)
+                samples[sample["idx"]] = sample
+        return [samples[idx] for idx in range(len(samples))]
+
     with open(file_name, "rb") as fin:
         meta = pickle.load(fin)
         num_samples = meta["num_samples"]
@@ -123,10 +133,14 @@ def main(args):
     logger.info("*********************************************")
 
     for input_file in tqdm(glob.glob(args.input)):
-        if not Path(input_file+'.trace.pickle').exists():
+        if Path(input_file+'.trace.jsonl').exists():
+            trace_file = input_file+'.trace.jsonl'
+        elif Path(input_file+'.trace.pickle').exists():
+            trace_file = input_file+'.trace.pickle'
+        else:
             continue
         print(input_file)
-        samples = read_traces_from_file(input_file+'.trace.pickle')
+        samples = read_traces_from_file(trace_file)
 
         results = []
 
@@ -358,6 +358,8 @@ def get_args():
                         help="Use LMDB to cache training features")
     parser.add_argument("--lmdb_dtype", type=str, default='h', 
                         help="Data type for cached data type for LMDB")
+    parser.add_argument("--num_tokenize_workers", type=int, default=1,
+                        help="Number of processes to tokenize the training data")
     parser.add_argument
     args = parser.parse_args()
     return args
@@ -467,6 +469,7 @@ def main():
         example_file=args.train_file, tokenizer=tokenizer, local_rank=args.local_rank,
         cached_features_file=args.cached_train_features_file, shuffle=True, 
         lmdb_cache=args.lmdb_cache, lmdb_dtype=args.lmdb_dtype, 
+        num_workers=args.num_tokenize_workers,
     )
 
     train(args, training_features, model, tokenizer)
@@ -382,9 +382,14 @@ class BertSelfAttention(nn.Module):
 
     def forward(self, hidden_states, attention_mask, history_states=None,
                 mask_qkv=None, seg_ids=None, key_history=None, value_history=None,
-                key_cache=None, value_cache=None, rel_pos=None,
+                key_cache=None, value_cache=None, rel_pos=None, kv_cache=None,
                 ):
-        if history_states is None:
+        if kv_cache is not None:
+            # keys and values of the previous positions are read from the cache
+            mixed_query_layer = self.query(hidden_states)
+            mixed_key_layer = F.linear(hidden_states, self.key.weight)
+            mixed_value_layer = self.value(hidden_states)
+        elif history_states is None:
             mixed_query_layer = self.query(hidden_states)
             # possible issue: https://github.com/NVIDIA/apex/issues/131
             mixed_key_layer = F.linear(hidden_states, self.key.weight)
@@ -412,6 +417,9 @@ class BertSelfAttention(nn.Module):
             key_layer = torch.cat((key_history, key_layer), dim=-2)
             value_layer = torch.cat((value_history, value_layer), dim=-2)
 
+        if kv_cache is not None:
+            key_layer, value_layer = kv_cache.update(key_layer, value_layer)
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         # (batch, head, pos, pos)
         attention_scores = torch.matmul(
@@ -480,10 +488,11 @@ class BertAttention(nn.Module):
         self.output = BertSelfOutput(config)
 
     def forward(self, input_tensor, attention_mask, history_states=None,
-                mask_qkv=None, seg_ids=None, key_history=None, value_history=None, rel_pos=None):
+                mask_qkv=None, seg_ids=None, key_history=None, value_history=None, rel_pos=None, kv_cache=None):
         self_output = self.self(
             input_tensor, attention_mask, history_states=history_states,
-            mask_qkv=mask_qkv, seg_ids=seg_ids, key_history=key_history, value_history=value_history, rel_pos=rel_pos)
+            mask_qkv=mask_qkv, seg_ids=seg_ids, key_history=key_history, value_history=value_history, rel_pos=rel_pos,
+            kv_cache=kv_cache)
         attention_output = self.output(self_output, input_tensor)
         return attention_output
 
@@ -554,10 +563,11 @@ class BertLayer(nn.Module):
             self.output = BertOutput(config)
 
     def forward(self, hidden_states, attention_mask, history_states=None,
-                mask_qkv=None, seg_ids=None, key_history=None, value_history=None, rel_pos=None):
+                mask_qkv=None, seg_ids=None, key_history=None, value_history=None, rel_pos=None, kv_cache=None):
         attention_output = self.attention(
             hidden_states, attention_mask, history_states=history_states,
-            mask_qkv=mask_qkv, seg_ids=seg_ids, key_history=key_history, value_history=value_history, rel_pos=rel_pos)
+            mask_qkv=mask_qkv, seg_ids=seg_ids, key_history=key_history, value_history=value_history, rel_pos=rel_pos,
+            kv_cache=kv_cache)
         if self.ffn_type:
             layer_output = self.ffn(attention_output)
         else:
@@ -575,12 +585,19 @@ class BertEncoder(nn.Module):
 
     def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True, 
                 prev_embedding=None, prev_encoded_layers=None, mask_qkv=None, 
-                seg_ids=None, key_history=None, value_history=None, rel_pos=None):
+                seg_ids=None, key_history=None, value_history=None, rel_pos=None, kv_caches=None):
         # history embedding and encoded layer must be simultanously given
         assert (prev_embedding is None) == (prev_encoded_layers is None)
 
         all_encoder_layers = []
-        if (prev_embedding is not None) and (prev_encoded_layers is not None):
+        if kv_caches is not None:
+            for i, layer_module in enumerate(self.layer):
+                hidden_states = layer_module(
+                    hidden_states, attention_mask, mask_qkv=mask_qkv, seg_ids=seg_ids,
+                    rel_pos=rel_pos, kv_cache=kv_caches[i])
+                if output_all_encoded_layers:
+                    all_encoder_layers.append(hidden_states)
+        elif (prev_embedding is not None) and (prev_encoded_layers is not None):
             history_states = prev_embedding
             for i, layer_module in enumerate(self.layer):
                 hidden_states = layer_module(
@@ -938,7 +955,8 @@ class BertModelIncr(BertModel):
             self.rel_pos_bias = None
 
     def forward(self, input_ids, token_type_ids, position_ids, attention_mask, output_all_encoded_layers=True,
-                prev_embedding=None, prev_encoded_layers=None, mask_qkv=None, task_idx=None, rel_pos=None):
+                prev_embedding=None, prev_encoded_layers=None, mask_qkv=None, task_idx=None, rel_pos=None,
+                kv_caches=None):
         extended_attention_mask = self.get_extended_attention_mask(
             input_ids, token_type_ids, attention_mask)
 
@@ -958,7 +976,7 @@ class BertModelIncr(BertModel):
                                       output_all_encoded_layers=output_all_encoded_layers,
                                       prev_embedding=prev_embedding,
                                       prev_encoded_layers=prev_encoded_layers, mask_qkv=mask_qkv,
-                                      seg_ids=token_type_ids, rel_pos=rel_pos)
+                                      seg_ids=token_type_ids, rel_pos=rel_pos, kv_caches=kv_caches)
         sequence_output = encoded_layers[-1]
         pooled_output = self.pooler(sequence_output)
         if not output_all_encoded_layers:
@@ -1112,13 +1130,109 @@ def get_div_func():
     return div_func
 
 
+class DupNgramIndex(object):
+    """Incremental index of the n-grams generated by each beam hypothesis.
+
+    For every hypothesis it keeps a map from each (n-1)-gram to the set of tokens that
+    followed it, plus the last n-1 tokens, so the tokens that would repeat an n-gram are
+    found with one lookup instead of rescanning the whole prefix at every step.
+    """
+
+    def __init__(self, ngram_size, ignore_set=None):
+        self.ngram_size = ngram_size
+        self.ignore_set = ignore_set or set()
+        self.tails = []
+        self.ngrams = []
+
+    def update(self, wids, ptrs=None):
+        # wids: new token of each hypothesis, ptrs: index of its parent hypothesis (None at the first step)
+        n = self.ngram_size
+        if ptrs is None:
+            self.tails = [(wid,)[-(n - 1):] if n > 1 else () for wid in wids]
+            self.ngrams = [{} for _ in wids]
+            return
+
+        # indices are shared between hypotheses until one of them is updated (copy on write)
+        num_refs = {}
+        for ptr in ptrs:
+            num_refs[id(self.ngrams[ptr])] = num_refs.get(id(self.ngrams[ptr]), 0) + 1
+        tails, ngrams = [], []
+        for wid, ptr in zip(wids, ptrs):
+            tail, index = self.tails[ptr], self.ngrams[ptr]
+            key = tail if len(tail) == n - 1 else None
+            if key is not None and wid not in self.ignore_set and wid not in index.get(key, ()):
+                if num_refs[id(index)] > 1:
+                    num_refs[id(index)] -= 1
+                    index = dict(index)
+                    num_refs[id(index)] = 1
+                index[key] = index.get(key, frozenset()) | {wid}
+            tails.append((tail + (wid,))[-(n - 1):] if n > 1 else ())
+            ngrams.append(index)
+        self.tails, self.ngrams = tails, ngrams
+
+    def get_forbidden(self):
+        # returns (hypothesis indices, token ids) of the tokens that would complete a duplicate n-gram
+        rows, cols = [], []
+        for bk, (tail, index) in enumerate(zip(self.tails, self.ngrams)):
+            if len(tail) < self.ngram_size - 1 or any(tk in self.ignore_set for tk in tail):
+                continue
+            cands = index.get(tail)
+            if cands:
+                rows.extend([bk] * len(cands))
+                cols.extend(cands)
+        return rows, cols
+
+
+class KVCache(object):
+    """Preallocated keys and values of one attention layer for incremental decoding.
+
+    `update` writes the keys / values of the current positions after the committed ones and
+    returns views over all of them; only `commit`-ed positions are kept for the next step, so
+    the trailing [MASK] position of the s2s mode is simply overwritten.
+    """
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self.length = 0
+        self.key = None
+        self.value = None
+
+    def update(self, key_layer, value_layer):
+        # key_layer, value_layer: (batch, head, pos, head_hid)
+        if self.key is None:
+            batch_size, num_heads, _, head_size = key_layer.size()
+            self.key = key_layer.new_empty(batch_size, num_heads, self.max_length, head_size)
+            self.value = value_layer.new_empty(batch_size, num_heads, self.max_length, head_size)
+        end = self.length + key_layer.size(2)
+        self.key[:, :, self.length:end].copy_(key_layer)
+        self.value[:, :, self.length:end].copy_(value_layer)
+        return self.key[:, :, :end], self.value[:, :, :end]
+
+    def commit(self, num_positions):
+        self.length += num_positions
+
+    def reorder(self, index):
+        # index: (new_batch,) rows of the current cache, e.g. the flattened beam back-pointers
+        if self.key is None:
+            return
+        if index.size(0) == self.key.size(0):
+            self.key[:, :, :self.length] = self.key[index, :, :self.length]
+            self.value[:, :, :self.length] = self.value[index, :, :self.length]
+        else:
+            key, value = self.key, self.value
+            self.key = key.new_empty((index.size(0),) + key.size()[1:])
+            self.value = value.new_empty((index.size(0),) + value.size()[1:])
+            self.key[:, :, :self.length] = key[index, :, :self.length]
+            self.value[:, :, :self.length] = value[index, :, :self.length]
+
+
 class BertForSeq2SeqDecoder(PreTrainedBertModel):
     """refer to BertForPreTraining"""
 
     def __init__(self, config, mask_word_id=0, num_labels=2, num_rel=0,
                  search_beam_size=1, length_penalty=1.0, eos_id=0, sos_id=0,
                  forbid_duplicate_ngrams=False, forbid_ignore_set=None, ngram_size=3, min_len=0, mode="s2s",
-                 pos_shift=False):
+                 pos_shift=False, use_kv_cache=True):
         super(BertForSeq2SeqDecoder, self).__init__(config)
         self.bert = BertModelIncr(config)
         self.cls = BertPreTrainingHeads(
@@ -1139,6 +1253,8 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
         assert mode in ("s2s", "l2r")
         self.mode = mode
         self.pos_shift = pos_shift
+        # per-position qkv selection and segment embeddings need the hidden states of the history
+        self.use_kv_cache = use_kv_cache and getattr(config, 'num_qkv', 0) <= 1 and not getattr(config, 'seg_emb', False)
 
         self.div_func = get_div_func()
 
@@ -1153,9 +1269,12 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
         output_shape = list(token_type_ids.size())
         output_length = output_shape[1]
 
-        output_ids = []
+        # finished rows are dropped from the batch, their remaining positions are filled with [SEP]
+        output_ids = input_ids.new(batch_size, output_length - input_length).fill_(self.eos_id)
+        active_rows = torch.arange(batch_size, dtype=torch.long, device=input_ids.device)
         prev_embedding = None
         prev_encoded_layers = None
+        kv_caches = [KVCache(output_length) for _ in self.bert.encoder.layer] if self.use_kv_cache else None
         curr_ids = input_ids
         mask_ids = input_ids.new(batch_size, 1).fill_(self.mask_word_id)
         next_pos = input_length
@@ -1196,15 +1315,21 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
             new_embedding, new_encoded_layers, _ = \
                 self.bert(x_input_ids, curr_token_type_ids, curr_position_ids, curr_attention_mask,
                           output_all_encoded_layers=True, prev_embedding=prev_embedding,
-                          prev_encoded_layers=prev_encoded_layers, mask_qkv=mask_qkv, rel_pos=cur_rel_pos)
+                          prev_encoded_layers=prev_encoded_layers, mask_qkv=mask_qkv, rel_pos=cur_rel_pos,
+                          kv_caches=kv_caches)
 
             last_hidden = new_encoded_layers[-1][:, -1:, :]
             prediction_scores, _ = self.cls(
                 last_hidden, None, task_idx=task_idx)
             _, max_ids = torch.max(prediction_scores, dim=-1)
-            output_ids.append(max_ids)
-
-            if self.pos_shift:
+            output_ids[active_rows, next_pos - input_length] = max_ids[:, 0]
+
+            if kv_caches is not None:
+                # the trailing [MASK] of the s2s mode is not part of the history
+                num_new_positions = x_input_ids.size(1) if self.pos_shift else x_input_ids.size(1) - 1
+                for kv_cache in kv_caches:
+                    kv_cache.commit(num_new_positions)
+            elif self.pos_shift:
                 if prev_embedding is None:
                     prev_embedding = new_embedding
                 else:
@@ -1230,7 +1355,31 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
             curr_ids = max_ids
             next_pos += 1
 
-        return torch.cat(output_ids, dim=1)
+            is_done = max_ids[:, 0].eq(self.eos_id)
+            if next_pos < output_length and is_done.any():
+                if is_done.all():
+                    break
+                keep = (~is_done).nonzero(as_tuple=False).view(-1)
+                active_rows = active_rows[keep]
+                curr_ids = curr_ids[keep]
+                token_type_ids, position_ids, attention_mask, mask_ids = \
+                    token_type_ids[keep], position_ids[keep], attention_mask[keep], mask_ids[keep]
+                if self.pos_shift:
+                    sep_ids = sep_ids[keep]
+                if rel_pos is not None:
+                    rel_pos = rel_pos[keep]
+                if isinstance(mask_qkv, torch.Tensor):
+                    mask_qkv = mask_qkv[keep]
+                if isinstance(task_idx, torch.Tensor) and task_idx.dim() > 0:
+                    task_idx = task_idx[keep]
+                if kv_caches is not None:
+                    for kv_cache in kv_caches:
+                        kv_cache.reorder(keep)
+                else:
+                    prev_embedding = prev_embedding[keep]
+                    prev_encoded_layers = [x[keep] for x in prev_encoded_layers]
+
+        return output_ids
 
     def beam_search(self, input_ids, token_type_ids, position_ids, attention_mask, task_idx=None, mask_qkv=None):
         input_shape = list(input_ids.size())
@@ -1242,6 +1391,7 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
         output_ids = []
         prev_embedding = None
         prev_encoded_layers = None
+        kv_caches = [KVCache(output_length) for _ in self.bert.encoder.layer] if self.use_kv_cache else None
         curr_ids = input_ids
         mask_ids = input_ids.new(batch_size, 1).fill_(self.mask_word_id)
         next_pos = input_length
@@ -1254,9 +1404,9 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
         beam_masks = []
         step_ids = []
         step_back_ptrs = []
-        partial_seqs = []
         forbid_word_mask = None
-        buf_matrix = None
+        ngram_index = None
+        beam_offsets = torch.arange(batch_size, dtype=torch.long, device=input_ids.device).unsqueeze(1) * K
 
         if self.bert.rel_pos_bias is not None:
             rel_pos_mat = position_ids.unsqueeze(-2) - position_ids.unsqueeze(-1)
@@ -1290,7 +1440,8 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
             new_embedding, new_encoded_layers, _ = \
                 self.bert(x_input_ids, curr_token_type_ids, curr_position_ids, curr_attention_mask,
                           output_all_encoded_layers=True, prev_embedding=prev_embedding,
-                          prev_encoded_layers=prev_encoded_layers, mask_qkv=mask_qkv, rel_pos=cur_rel_pos)
+                          prev_encoded_layers=prev_encoded_layers, mask_qkv=mask_qkv, rel_pos=cur_rel_pos,
+                          kv_caches=kv_caches)
 
             last_hidden = new_encoded_layers[-1][:, -1:, :]
             prediction_scores, _ = self.cls(
@@ -1299,7 +1450,8 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
                 prediction_scores, dim=-1)
             
             if forbid_word_mask is not None:
-                log_scores += (forbid_word_mask * -10000.0)
+                forbid_rows, forbid_cols = forbid_word_mask
+                log_scores[forbid_rows, 0, forbid_cols] -= 10000.0
             if self.min_len and (next_pos - input_length + 1 <= self.min_len):
                 log_scores[:, :, self.eos_id].fill_(-10000.0)
             kk_scores, kk_ids = torch.topk(log_scores, k=K)
@@ -1349,9 +1501,18 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
                 y = torch.reshape(y, x_shape)
                 return y
 
-            is_first = (prev_embedding is None)
+            is_first = (next_pos == input_length)
 
-            if self.pos_shift:
+            if kv_caches is not None:
+                num_new_positions = x_input_ids.size(1) if self.pos_shift else x_input_ids.size(1) - 1
+                if is_first:
+                    beam_index = torch.arange(batch_size, device=input_ids.device).repeat_interleave(K)
+                else:
+                    beam_index = (back_ptrs + beam_offsets).view(-1)
+                for kv_cache in kv_caches:
+                    kv_cache.commit(num_new_positions)
+                    kv_cache.reorder(beam_index)
+            elif self.pos_shift:
                 if prev_embedding is None:
                     prev_embedding = first_expand(new_embedding)
                 else:
@@ -1397,60 +1558,20 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
                     mask_qkv = first_expand(mask_qkv)
 
             if self.forbid_duplicate_ngrams:
-                wids = step_ids[-1].tolist()
-                ptrs = step_back_ptrs[-1].tolist()
+                wids = step_ids[-1].view(-1).tolist()
                 if is_first:
-                    partial_seqs = []
-                    for b in range(batch_size):
-                        for k in range(K):
-                            partial_seqs.append([wids[b][k]])
+                    ngram_index = DupNgramIndex(self.ngram_size, self.forbid_ignore_set)
+                    ngram_index.update(wids)
+                else:
+                    ptrs = (step_back_ptrs[-1] + beam_offsets).view(-1).tolist()
+                    ngram_index.update(wids, ptrs)
+
+                rows, cols = ngram_index.get_forbidden()
+                if len(rows) > 0:
+                    forbid_word_mask = (torch.tensor(rows, dtype=torch.long, device=log_scores.device),
+                                        torch.tensor(cols, dtype=torch.long, device=log_scores.device))
                 else:
-                    new_partial_seqs = []
-                    for b in range(batch_size):
-                        for k in range(K):
-                            new_partial_seqs.append(
-                                partial_seqs[ptrs[b][k] + b * K] + [wids[b][k]])
-                    partial_seqs = new_partial_seqs
-
-                def get_dup_ngram_candidates(seq, n):
-                    cands = set()
-                    if len(seq) < n:
-                        return []
-                    tail = seq[-(n - 1):]
-                    if self.forbid_ignore_set and any(tk in self.forbid_ignore_set for tk in tail):
-                        return []
-                    for i in range(len(seq) - (n - 1)):
-                        mismatch = False
-                        for j in range(n - 1):
-                            if tail[j] != seq[i + j]:
-                                mismatch = True
-                                break
-                        if (not mismatch) and not (
-                                self.forbid_ignore_set and (seq[i + n - 1] in self.forbid_ignore_set)):
-                            cands.add(seq[i + n - 1])
-                    return list(sorted(cands))
-
-                if len(partial_seqs[0]) >= self.ngram_size:
-                    dup_cands = []
-                    for seq in partial_seqs:
-                        dup_cands.append(
-                            get_dup_ngram_candidates(seq, self.ngram_size))
-                    if max(len(x) for x in dup_cands) > 0:
-                        if buf_matrix is None:
-                            vocab_size = list(log_scores.size())[-1]
-                            buf_matrix = np.zeros(
-                                (batch_size * K, vocab_size), dtype=float)
-                        else:
-                            buf_matrix.fill(0)
-                        for bk, cands in enumerate(dup_cands):
-                            for i, wid in enumerate(cands):
-                                buf_matrix[bk, wid] = 1.0
-                        forbid_word_mask = torch.tensor(
-                            buf_matrix, dtype=log_scores.dtype)
-                        forbid_word_mask = torch.reshape(
-                            forbid_word_mask, [batch_size * K, 1, vocab_size]).cuda()
-                    else:
-                        forbid_word_mask = None
+                    forbid_word_mask = None
             next_pos += 1
 
         # [(batch, beam)]
@@ -9,6 +9,8 @@ import torch
 import tqdm
 import array
 import collections
+import multiprocessing
+import numpy as np
 import torch.utils.data
 from transformers.file_utils import WEIGHTS_NAME
 try:
@@ -88,12 +90,19 @@ class Seq2seqDatasetForBert(torch.utils.data.Dataset):
         else:
             return self.mask_id
 
+    @staticmethod
+    def __prefix_list(ids, max_len):
+        # features from DocDB are numpy views, only the tokens that can be kept are converted
+        ids = ids[:max_len]
+        return ids.tolist() if isinstance(ids, np.ndarray) else list(ids)
+
     def __getitem__(self, _idx):
         idx = (self.offset + _idx) % len(self.features)
         # print("%d get %d" % (_idx, idx))
         feature = self.features[idx]
-        source_ids = self.__trunk([self.cls_id] + feature.source_ids, self.max_source_len, append_sep=self.mask_way != 'v0')
-        target_ids = feature.target_ids
+        source_ids = self.__trunk([self.cls_id] + self.__prefix_list(feature.source_ids, self.max_source_len),
+                                  self.max_source_len, append_sep=self.mask_way != 'v0')
+        target_ids = self.__prefix_list(feature.target_ids, self.max_target_len)
         if self.mask_way == 'v0':
             target_ids = [self.sep_id] + target_ids
         target_ids = self.__trunk(target_ids, self.max_target_len, append_sep=self.mask_way != 'v0')
@@ -248,44 +257,130 @@ def write_to_lmdb(db, key, value):
             db.set_mapsize(new_limit)  # double it
 
 
+def _put_many_to_lmdb(db, items):
+    while True:
+        try:
+            with db.begin(write=True) as txn:
+                txn.cursor().putmulti(items)
+            return
+        except lmdb.MapFullError:
+            # the transaction is aborted, double the map_size and redo it
+            new_limit = db.info()['map_size'] * 2
+            print('>>> Doubling LMDB map size to %sMB ...' %
+                  (new_limit >> 20,))
+            db.set_mapsize(new_limit)
+
+
+def write_features_to_lmdb(features, db_path, dtype, commit_interval=100000):
+    """Writes all the features with one transaction per `commit_interval` keys."""
+    itemsize = array.array(dtype).itemsize
+    num_bytes = sum(len(f.source_ids) + len(f.target_ids) for f in features) * itemsize
+    # values plus a rough per-key overhead for the B-tree
+    map_size = max(1 << 26, 2 * (num_bytes + 64 * 2 * len(features)))
+    db = lmdb.open(db_path, readonly=False, map_size=map_size, map_async=True)
+
+    items = []
+    for idx, feature in enumerate(tqdm.tqdm(features, desc="write lmdb")):
+        items.append((b"src_ids_%d" % idx, serialize_array(feature.source_ids, dtype=dtype)))
+        items.append((b"tgt_ids_%d" % idx, serialize_array(feature.target_ids, dtype=dtype)))
+        if len(items) >= commit_interval:
+            _put_many_to_lmdb(db, items)
+            items = []
+    items.append((b"__start__", serialize_str(0)))
+    items.append((b"__size__", serialize_str(len(features))))
+    items.append((b"__dtype__", serialize_str(dtype)))
+    _put_many_to_lmdb(db, items)
+    db.sync()
+    db.close()
+
+
 def deserialize_str(x):
-    return x.decode('ascii')
+    return bytes(x).decode('ascii')
+
+
+_lmdb_envs = {}
+
+
+def _open_lmdb_readonly(db_path):
+    # lmdb refuses to open the same environment twice in a process (forked workers included),
+    # so all the readers of a path share one environment
+    if db_path not in _lmdb_envs:
+        _lmdb_envs[db_path] = lmdb.open(db_path, readonly=True, lock=False, readahead=False, meminit=False)
+    return _lmdb_envs[db_path]
 
 
 class DocDB(object):
+    """Read-only view of the LMDB feature cache. Each process keeps one long-lived read
+    transaction, and token ids are returned as numpy arrays over the mapped pages."""
+
     def __init__(self, db_path):
         self.db_path = db_path
-        self.env = lmdb.open(db_path, readonly=True, lock=False, readahead=False, meminit=False)
-        with self.env.begin(write=False) as txn:
-            self.start_key_index = int(deserialize_str(txn.get(b'__start__')))
-            self.size = int(deserialize_str(txn.get(b'__size__')))
-            self.dtype = deserialize_str(txn.get(b'__dtype__'))
+        self.env = None
+        self.txn = None
+        self.pid = None
+        txn = self._get_txn()
+        self.start_key_index = int(deserialize_str(txn.get(b'__start__')))
+        self.size = int(deserialize_str(txn.get(b'__size__')))
+        self.dtype = deserialize_str(txn.get(b'__dtype__'))
+        self.np_dtype = np.dtype(self.dtype)
+
+    def _get_txn(self):
+        # a transaction must not be shared with forked data loader workers
+        if self.txn is None or self.pid != os.getpid():
+            self.env = _open_lmdb_readonly(self.db_path)
+            self.txn = self.env.begin(write=False, buffers=True)
+            self.pid = os.getpid()
+        return self.txn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['env'], state['txn'], state['pid'] = None, None, None
+        return state
 
     def _deserialize_array(self, x):
-        data = array.array(self.dtype)
-        data.frombytes(x)
-        return data.tolist()
+        return np.frombuffer(x, dtype=self.np_dtype)
 
     def __getitem__(self, doc_id):
-        with self.env.begin(write=False) as txn:
-            # example = {
-            #     "source_ids": self._deserialize_array(txn.get(b"src_ids_%d" % doc_id)), 
-            #     "target_ids": self._deserialize_array(txn.get(b"tgt_ids_%d" % doc_id)), 
-            # }
-            example = TrainingExample(
-                source_ids=self._deserialize_array(txn.get(b"src_ids_%d" % doc_id)), 
-                target_ids=self._deserialize_array(txn.get(b"tgt_ids_%d" % doc_id)),
-                example_id=None, 
-            )
+        txn = self._get_txn()
+        example = TrainingExample(
+            source_ids=self._deserialize_array(txn.get(b"src_ids_%d" % doc_id)), 
+            target_ids=self._deserialize_array(txn.get(b"tgt_ids_%d" % doc_id)),
+            example_id=None, 
+        )
         return example
 
     def __len__(self):
         return self.size
 
 
+_tokenize_worker_state = {}
+
+
+def _init_tokenize_worker(tokenizer, eval_mode):
+    _tokenize_worker_state['tokenizer'] = tokenizer
+    _tokenize_worker_state['eval_mode'] = eval_mode
+
+
+def _convert_example_to_ids(example, tokenizer, eval_mode):
+    if isinstance(example["src"], list):
+        source_tokens = example["src"]
+        target_tokens = [] if eval_mode else example["tgt"]
+    else:
+        source_tokens = tokenizer.tokenize(example["src"])
+        target_tokens = [] if eval_mode else tokenizer.tokenize(example["tgt"])
+    source_ids = tokenizer.convert_tokens_to_ids(source_tokens)
+    target_ids = tokenizer.convert_tokens_to_ids(target_tokens)
+    return source_ids, target_ids
+
+
+def _convert_example_to_ids_in_worker(example):
+    return _convert_example_to_ids(
+        example, _tokenize_worker_state['tokenizer'], _tokenize_worker_state['eval_mode'])
+
+
 def load_and_cache_examples(
         example_file, tokenizer, local_rank, cached_features_file, shuffle=True, 
-        lmdb_cache=None, lmdb_dtype='h', eval_mode=False):
+        lmdb_cache=None, lmdb_dtype='h', eval_mode=False, num_workers=1):
     # Make sure only the first process in distributed training process the dataset, and the others will use the cache
     if local_rank not in [-1, 0]:
         torch.distributed.barrier()
@@ -309,16 +404,15 @@ def load_and_cache_examples(
         slc = collections.defaultdict(int)
         tlc = collections.defaultdict(int)
 
-        for example in tqdm.tqdm(examples):
-            if isinstance(example["src"], list):
-                source_tokens = example["src"]
-                target_tokens = [] if eval_mode else example["tgt"]
-            else:
-                source_tokens = tokenizer.tokenize(example["src"])
-                target_tokens = [] if eval_mode else tokenizer.tokenize(example["tgt"])
-            source_ids = tokenizer.convert_tokens_to_ids(source_tokens)
-            target_ids = tokenizer.convert_tokens_to_ids(target_tokens)
+        if num_workers > 1:
+            with multiprocessing.Pool(num_workers, initializer=_init_tokenize_worker,
+                                      initargs=(tokenizer, eval_mode)) as pool:
+                all_ids = list(tqdm.tqdm(
+                    pool.imap(_convert_example_to_ids_in_worker, examples, chunksize=256), total=len(examples)))
+        else:
+            all_ids = [_convert_example_to_ids(example, tokenizer, eval_mode) for example in tqdm.tqdm(examples)]
 
+        for source_ids, target_ids in all_ids:
             slc[len(source_ids)] += 1
             tlc[len(target_ids)] += 1
 
@@ -345,22 +439,10 @@ def load_and_cache_examples(
 
         if local_rank in [-1, 0] and cached_features_file is not None:
             if lmdb_cache:
-                db = lmdb.open(cached_features_file, readonly=False, map_async=True)
-                for idx, feature in enumerate(features):
-                    write_to_lmdb(
-                        db, b"src_ids_%d" % idx, 
-                        serialize_array(feature.source_ids, dtype=lmdb_dtype))
-                    write_to_lmdb(
-                        db, b"tgt_ids_%d" % idx,
-                        serialize_array(feature.target_ids, dtype=lmdb_dtype))
-                write_to_lmdb(db, b"__start__", serialize_str(0))
-                write_to_lmdb(db, b"__size__", serialize_str(len(features)))
-                write_to_lmdb(db, b"__dtype__", serialize_str(lmdb_dtype))
-                db.sync()
-                db.close()
+                write_features_to_lmdb(features, cached_features_file, dtype=lmdb_dtype)
                 logger.info("db_key_idx = %d" % len(features))
                 del features
-                features = cached_features_file
+                features = DocDB(cached_features_file)
                 logger.info("Saving features into cached lmdb dir %s", cached_features_file)
             else:
                 logger.info("Saving features into cached file %s", cached_features_file)
@@ -0,0 +1,35 @@
+import json
+import os
+import unittest
+
+from evaluations import rouge_scorer
+
+# candidates and references, with the Rouge155.output_to_dict of ROUGE-1.5.5.pl run by
+# evaluations/bs_pyrouge.py (-c 95 -m -r 1000 -n 2 -a) as eval_for_*.py --perl --pyrouge does
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "rouge_perl.json")
+
+
+class RougeScorerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with open(FIXTURE, "r", encoding="utf-8") as f_in:
+            cls.fixture = json.load(f_in)
+
+    def test_matches_perl(self):
+        results = rouge_scorer.evaluate(self.fixture["candidates"], self.fixture["references"])
+        self.assertEqual(results, self.fixture["expected"])
+
+    def test_matches_perl_with_processes(self):
+        results = rouge_scorer.evaluate(self.fixture["candidates"], self.fixture["references"], processes=2)
+        self.assertEqual(results, self.fixture["expected"])
+
+    def test_stemming(self):
+        # Porter stemmer for regular forms, the WordNet exception list for irregular ones, tokens
+        # of up to 3 characters are kept as is
+        self.assertEqual(rouge_scorer.tokenize("Running studies"), [["run", "studi"]])
+        self.assertEqual(rouge_scorer.tokenize("children went\nran"), [["child", "go"], ["ran"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
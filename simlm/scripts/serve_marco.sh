@@ -0,0 +1,45 @@
+#!/usr/bin/env bash
+
+set -x
+set -e
+
+DIR="$( cd "$( dirname "$0" )" && cd .. && pwd )"
+echo "working directory: ${DIR}"
+
+MODEL_NAME_OR_PATH=""
+if [[ $# -ge 1 && ! "$1" == "--"* ]]; then
+    MODEL_NAME_OR_PATH=$1
+    shift
+fi
+
+SPLIT="dev"
+if [[ $# -ge 1 && ! "$1" == "--"* ]]; then
+    SPLIT=$1
+    shift
+fi
+
+if [ -z "$OUTPUT_DIR" ]; then
+  OUTPUT_DIR="${MODEL_NAME_OR_PATH}"
+fi
+if [ -z "$DATA_DIR" ]; then
+  DATA_DIR="${DIR}/data/msmarco_bm25_official/"
+fi
+
+mkdir -p "${OUTPUT_DIR}"
+
+PYTHONPATH=src/ python -u src/inference/query_server_main.py \
+    --model_name_or_path "${MODEL_NAME_OR_PATH}" \
+    --do_serve \
+    --search_split "${SPLIT}" \
+    --search_out_dir "${OUTPUT_DIR}" \
+    --encode_save_dir "${OUTPUT_DIR}" \
+    --search_topk 100 \
+    --ann_nprobe 32 \
+    --serve_max_batch_size 64 \
+    --serve_max_wait_ms 5 \
+    --q_max_len 32 \
+    --add_pooler False \
+    --dataloader_num_workers 1 \
+    --output_dir "/tmp/" \
+    --data_dir "${DATA_DIR}" \
+    --report_to none "$@"
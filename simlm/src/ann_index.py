@@ -0,0 +1,109 @@
+import time
+import numpy as np
+
+from typing import List, Tuple
+
+from config import Arguments
+from logger_config import logger
+from embed_store import EmbedStore
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+def get_ann_index_path(args: Arguments) -> str:
+    return args.ann_index_path or '{}/ivf{}_pq{}.index'.format(args.encode_save_dir, args.ann_nlist, args.ann_pq_m)
+
+
+def _check_faiss():
+    assert faiss is not None, 'faiss is required for approximate search, please run: pip install faiss-cpu'
+
+
+def _sample_train_embeds(stores: List[EmbedStore], train_size: int, seed: int = 42) -> np.ndarray:
+    total = sum(len(store) for store in stores)
+    rng = np.random.RandomState(seed)
+    global_indices = np.sort(rng.choice(total, size=min(train_size, total), replace=False))
+
+    train_embeds, offset = [], 0
+    for store in stores:
+        local_indices = global_indices[(global_indices >= offset) & (global_indices < offset + len(store))] - offset
+        train_embeds.append(store.embeds[local_indices].float().numpy())
+        offset += len(store)
+
+    return np.concatenate(train_embeds, axis=0)
+
+
+def build_ivfpq_index(store_prefix_list: List[str],
+                      nlist: int,
+                      pq_m: int,
+                      pq_nbits: int = 8,
+                      train_size: int = 256 * 1024,
+                      slab_size: int = 256 * 1024):
+    _check_faiss()
+    stores = [EmbedStore(prefix) for prefix in store_prefix_list]
+    dim = stores[0].dim
+    assert dim % pq_m == 0, 'embedding dim {} should be divisible by ann_pq_m {}'.format(dim, pq_m)
+
+    quantizer = faiss.IndexFlatIP(dim)
+    index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, pq_nbits, faiss.METRIC_INNER_PRODUCT)
+
+    train_embeds = _sample_train_embeds(stores, train_size=train_size)
+    logger.info('Train IVF{},PQ{}x{} index on {} embeddings'.format(nlist, pq_m, pq_nbits, train_embeds.shape[0]))
+    start_time = time.time()
+    index.train(train_embeds)
+    logger.info('Training takes {:.1f} seconds'.format(time.time() - start_time))
+
+    for store in stores:
+        for slab_embeds, slab_ids in store.iter_slabs(slab_size=slab_size):
+            index.add_with_ids(np.ascontiguousarray(slab_embeds.float().numpy()), slab_ids.numpy())
+        logger.info('Add {} embeddings from {}, index size: {}'.format(len(store), store.prefix, index.ntotal))
+
+    return index
+
+
+def save_index(index, path: str):
+    _check_faiss()
+    faiss.write_index(index, path)
+    logger.info('Save index with {} embeddings to {}'.format(index.ntotal, path))
+
+
+def load_index(path: str):
+    _check_faiss()
+    index = faiss.read_index(path)
+    logger.info('Load index with {} embeddings from {}'.format(index.ntotal, path))
+    return index
+
+
+def ann_search(index, query_embeds: np.ndarray, topk: int, nprobe: int) -> Tuple[np.ndarray, np.ndarray]:
+    faiss.extract_index_ivf(index).nprobe = nprobe
+    scores, indices = index.search(np.ascontiguousarray(query_embeds, dtype=np.float32), topk)
+    return scores, indices
+
+
+def exact_search(store_prefix_list: List[str],
+                 query_embeds: np.ndarray,
+                 topk: int,
+                 slab_size: int = 256 * 1024) -> Tuple[np.ndarray, np.ndarray]:
+    query_embeds = query_embeds.astype(np.float32)
+    topk_scores = np.full((query_embeds.shape[0], topk), -np.inf, dtype=np.float32)
+    topk_indices = np.full((query_embeds.shape[0], topk), -1, dtype=np.int64)
+
+    for prefix in store_prefix_list:
+        for slab_embeds, slab_ids in EmbedStore(prefix).iter_slabs(slab_size=slab_size):
+            scores = query_embeds @ slab_embeds.float().numpy().T
+            merged_scores = np.concatenate([topk_scores, scores], axis=1)
+            merged_indices = np.concatenate([topk_indices, np.broadcast_to(slab_ids.numpy(), scores.shape)], axis=1)
+            pos = np.argpartition(-merged_scores, kth=topk - 1, axis=1)[:, :topk]
+            topk_scores = np.take_along_axis(merged_scores, pos, axis=1)
+            topk_indices = np.take_along_axis(merged_indices, pos, axis=1)
+
+    order = np.argsort(-topk_scores, axis=1)
+    return np.take_along_axis(topk_scores, order, axis=1), np.take_along_axis(topk_indices, order, axis=1)
+
+
+def compute_recall(approx_indices: np.ndarray, exact_indices: np.ndarray, k: int) -> float:
+    hits = [len(set(approx[:k].tolist()) & set(exact[:k].tolist()) - {-1})
+            for approx, exact in zip(approx_indices, exact_indices)]
+    return float(np.mean(hits)) / k
@@ -1,7 +1,7 @@
 import os
 import torch
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import Optional, List
 from transformers import TrainingArguments
 
 
@@ -39,6 +39,10 @@ class Arguments(TrainingArguments):
         default=True,
         metadata={"help": "no weight sharing between qry passage encoders"}
     )
+    use_tokenized_corpus: bool = field(
+        default=False,
+        metadata={"help": "compile passages to token ids once and slice them in data loaders instead of re-tokenizing"}
+    )
     use_first_positive: bool = field(
         default=False,
         metadata={"help": "Always use the first positive passage"}
@@ -65,7 +69,7 @@ class Arguments(TrainingArguments):
     do_encode: bool = field(default=False, metadata={"help": "run the encoding loop"})
     encode_in_path: str = field(default=None, metadata={"help": "Path to data to encode"})
     encode_save_dir: str = field(default=None, metadata={"help": "where to save the encode"})
-    encode_shard_size: int = field(default=int(2 * 10**6))
+    encode_shard_size: int = field(default=int(2 * 10**6), metadata={"help": "number of embeddings per slab"})
     encode_batch_size: int = field(default=256)
 
     # used for index search
@@ -75,6 +79,26 @@ class Arguments(TrainingArguments):
     search_topk: int = field(default=200, metadata={"help": "return topk search results"})
     search_out_dir: str = field(default='', metadata={"help": "output directory for writing search results"})
 
+    # used for approximate nearest neighbour search on CPU
+    do_ann_search: bool = field(default=False, metadata={"help": "run the IVF-PQ index search loop"})
+    ann_index_path: str = field(default='', metadata={"help": "where to save / load the IVF-PQ index"})
+    ann_nlist: int = field(default=4096, metadata={"help": "number of IVF clusters"})
+    ann_pq_m: int = field(default=64, metadata={"help": "number of PQ sub-quantizers"})
+    ann_nprobe: int = field(default=32, metadata={"help": "number of IVF clusters to visit per query"})
+    ann_train_size: int = field(default=256 * 1024, metadata={"help": "number of embeddings to train the index"})
+    ann_recall_num_queries: int = field(default=1000, metadata={"help": "number of queries to compare against exact search"})
+
+    # used for the online query encoding server
+    do_serve: bool = field(default=False, metadata={"help": "run the online query encoding server"})
+    serve_port: int = field(default=8000, metadata={"help": "port of the query encoding server"})
+    serve_max_batch_size: int = field(default=64, metadata={"help": "max number of queries in one dynamic batch"})
+    serve_max_wait_ms: float = field(default=5., metadata={"help": "max time to wait for a dynamic batch to fill up"})
+    serve_benchmark: bool = field(default=False, metadata={"help": "benchmark the server with local clients and exit"})
+    serve_benchmark_concurrency: List[int] = field(
+        default_factory=lambda: [1, 4, 16, 64],
+        metadata={"help": "number of concurrent benchmark clients"}
+    )
+
     # used for reranking
     do_rerank: bool = field(default=False, metadata={"help": "run the reranking loop"})
     rerank_max_length: int = field(default=256, metadata={"help": "max length for rerank inputs"})
@@ -83,6 +107,7 @@ class Arguments(TrainingArguments):
     rerank_split: str = field(default='dev', metadata={"help": "which split to rerank"})
     rerank_batch_size: int = field(default=128, metadata={"help": "rerank batch size"})
     rerank_depth: int = field(default=1000, metadata={"help": "rerank depth, useful for debugging purpose"})
+    rerank_cache_dir: str = field(default='', metadata={"help": "directory to cache rerank scores across runs"})
     rerank_forward_factor: int = field(
         default=1,
         metadata={"help": "forward n passages, then select top n/factor passages for backward"}
@@ -164,7 +189,7 @@ class Arguments(TrainingArguments):
 
     def __post_init__(self):
         assert os.path.exists(self.data_dir)
-        assert torch.cuda.is_available(), 'Only support running on GPUs'
+        assert torch.cuda.is_available() or self.do_ann_search or self.do_serve, 'Only support running on GPUs'
         assert self.task_type in ['ir', 'qa']
 
         if self.dry_run:
@@ -190,6 +215,11 @@ class Arguments(TrainingArguments):
             assert self.search_out_dir
             os.makedirs(self.search_out_dir, exist_ok=True)
 
+        if self.do_ann_search or self.do_serve:
+            assert os.path.exists(self.encode_save_dir)
+            assert self.search_out_dir
+            os.makedirs(self.search_out_dir, exist_ok=True)
+
         if self.do_rerank:
             assert os.path.exists(self.rerank_in_path)
             logger.info('Rerank result will be written to {}'.format(self.rerank_out_path))
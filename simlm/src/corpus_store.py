@@ -0,0 +1,142 @@
+import os
+import json
+import tqdm
+import numpy as np
+
+from typing import List, Dict, Tuple, Optional
+from datasets import Dataset
+from transformers import PreTrainedTokenizerFast
+
+from logger_config import logger
+
+# On-disk layout of a pre-tokenized corpus:
+#   {prefix}.ids     flat int32 token ids of all titles and passages, without special tokens
+#   {prefix}.offsets int64 array of size 2 * num_docs + 1,
+#                    title of doc i is ids[offsets[2i]:offsets[2i+1]], passage is ids[offsets[2i+1]:offsets[2i+2]]
+#   {prefix}.lengths int32 array of size 2 * num_docs, number of tokens of each title / passage before truncation
+#   {prefix}.json    header
+
+
+def get_tokenized_corpus_prefix(corpus_path: str, tokenizer: PreTrainedTokenizerFast, max_len: int) -> str:
+    tokenizer_name = os.path.basename(tokenizer.name_or_path.rstrip('/'))
+    return '{}.{}.{}'.format(corpus_path, tokenizer_name, max_len)
+
+
+def compile_corpus(corpus: Dataset,
+                   tokenizer: PreTrainedTokenizerFast,
+                   prefix: str,
+                   max_len: int,
+                   batch_size: int = 10000):
+    num_tokens = 0
+    offsets, lengths = [0], []
+    with open('{}.ids.tmp'.format(prefix), 'wb') as writer:
+        for start in tqdm.tqdm(range(0, len(corpus), batch_size), desc='compile corpus', mininterval=10):
+            batch = corpus[start:(start + batch_size)]
+            contents = batch['contents']
+            titles = batch['title'] if 'title' in batch else [''] * len(contents)
+
+            title_ids = tokenizer(titles, add_special_tokens=False)['input_ids']
+            contents_ids = tokenizer(contents, add_special_tokens=False)['input_ids']
+            for cur_title_ids, cur_contents_ids in zip(title_ids, contents_ids):
+                for ids in [cur_title_ids, cur_contents_ids]:
+                    # a pair never keeps more than max_len tokens of either side,
+                    # the full lengths are kept since truncation of a pair depends on them
+                    lengths.append(len(ids))
+                    ids = ids[:max_len]
+                    writer.write(np.array(ids, dtype=np.int32).tobytes())
+                    num_tokens += len(ids)
+                    offsets.append(num_tokens)
+
+    np.array(offsets, dtype=np.int64).tofile('{}.offsets'.format(prefix))
+    np.array(lengths, dtype=np.int32).tofile('{}.lengths'.format(prefix))
+    os.replace('{}.ids.tmp'.format(prefix), '{}.ids'.format(prefix))
+    with open('{}.json'.format(prefix), 'w', encoding='utf-8') as writer:
+        json.dump({'num_docs': len(corpus), 'num_tokens': num_tokens, 'max_len': max_len,
+                   'tokenizer': tokenizer.name_or_path}, writer)
+    logger.info('Compile {} documents with {} tokens to {}'.format(len(corpus), num_tokens, prefix))
+
+
+class TokenizedCorpus:
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.header = json.load(open('{}.json'.format(prefix), 'r', encoding='utf-8'))
+        self.ids = np.memmap('{}.ids'.format(prefix), dtype=np.int32, mode='r', shape=(self.header['num_tokens'],))
+        self.offsets = np.fromfile('{}.offsets'.format(prefix), dtype=np.int64)
+        self.lengths = np.fromfile('{}.lengths'.format(prefix), dtype=np.int32)
+        assert self.offsets.shape[0] == 2 * self.header['num_docs'] + 1
+        assert self.lengths.shape[0] == 2 * self.header['num_docs']
+
+    def __len__(self):
+        return self.header['num_docs']
+
+    def get_title_ids(self, doc_id: int) -> List[int]:
+        return self.ids[self.offsets[2 * doc_id]:self.offsets[2 * doc_id + 1]].tolist()
+
+    def get_contents_ids(self, doc_id: int) -> List[int]:
+        return self.ids[self.offsets[2 * doc_id + 1]:self.offsets[2 * doc_id + 2]].tolist()
+
+    def get_title_len(self, doc_id: int) -> int:
+        return int(self.lengths[2 * doc_id])
+
+    def get_contents_len(self, doc_id: int) -> int:
+        return int(self.lengths[2 * doc_id + 1])
+
+
+def load_or_compile_corpus(corpus: Dataset,
+                           corpus_path: str,
+                           tokenizer: PreTrainedTokenizerFast,
+                           max_len: int) -> TokenizedCorpus:
+    prefix = get_tokenized_corpus_prefix(corpus_path, tokenizer, max_len)
+    if not os.path.exists('{}.json'.format(prefix)):
+        compile_corpus(corpus, tokenizer, prefix=prefix, max_len=max_len)
+    tokenized_corpus = TokenizedCorpus(prefix)
+    assert len(tokenized_corpus) == len(corpus), '{} != {}'.format(len(tokenized_corpus), len(corpus))
+    return tokenized_corpus
+
+
+def _truncate_longest_first(first_ids: List[int], second_ids: List[int],
+                            first_len: int, second_len: int,
+                            max_num_tokens: int) -> Tuple[List, List]:
+    # same as the "longest_first" strategy of fast tokenizers, decided on the lengths before any pre-truncation:
+    # the shorter sequence keeps at most half of the budget, the longer one takes the rest
+    if first_len + second_len <= max_num_tokens:
+        return first_ids, second_ids
+
+    swap = first_len > second_len
+    short_len, long_len = sorted([first_len, second_len])
+    long_len = short_len if short_len > max_num_tokens else max(short_len, max_num_tokens - short_len)
+    if short_len + long_len > max_num_tokens:
+        short_len = max_num_tokens // 2
+        long_len = short_len + max_num_tokens % 2
+
+    first_len, second_len = (long_len, short_len) if swap else (short_len, long_len)
+    return first_ids[:first_len], second_ids[:second_len]
+
+
+def prepare_pair_inputs(tokenizer: PreTrainedTokenizerFast,
+                        first_ids: List[List[int]],
+                        second_ids: List[List[int]],
+                        max_length: int,
+                        first_lens: Optional[List[int]] = None,
+                        second_lens: Optional[List[int]] = None) -> Dict[str, List]:
+    # same output as calling the tokenizer on the raw text pairs with truncation=True,
+    # first_lens / second_lens are the lengths before pre-truncation if any
+    first_lens = first_lens or [len(ids) for ids in first_ids]
+    second_lens = second_lens or [len(ids) for ids in second_ids]
+    max_num_tokens = max_length - tokenizer.num_special_tokens_to_add(pair=True)
+    batch_dict: Dict[str, List] = {k: [] for k in tokenizer.model_input_names}
+    for cur_first_ids, cur_second_ids, first_len, second_len in zip(first_ids, second_ids, first_lens, second_lens):
+        cur_first_ids, cur_second_ids = _truncate_longest_first(cur_first_ids, cur_second_ids,
+                                                                first_len, second_len, max_num_tokens)
+        # an empty list is treated as "no pair" by the slow-path helpers, use a placeholder to keep both separators
+        placeholder = [] if cur_second_ids else [-1]
+        input_ids = tokenizer.build_inputs_with_special_tokens(cur_first_ids, cur_second_ids or placeholder)
+        keep = [idx for idx, token_id in enumerate(input_ids) if token_id != -1]
+        batch_dict['input_ids'].append([input_ids[idx] for idx in keep])
+        if 'token_type_ids' in batch_dict:
+            token_type_ids = tokenizer.create_token_type_ids_from_sequences(cur_first_ids, cur_second_ids or placeholder)
+            batch_dict['token_type_ids'].append([token_type_ids[idx] for idx in keep])
+        if 'attention_mask' in batch_dict:
+            batch_dict['attention_mask'].append([1] * len(keep))
+    return batch_dict
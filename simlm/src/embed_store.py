@@ -0,0 +1,112 @@
+import os
+import glob
+import json
+import torch
+import numpy as np
+
+from typing import List, Iterator, Tuple
+
+from logger_config import logger
+
+# On-disk layout for the embeddings written by one encoding worker:
+#   embeds_{worker_idx}.bin  raw row-major (num_rows, dim) matrix
+#   embeds_{worker_idx}.ids  int64 passage index of each row
+#   embeds_{worker_idx}.json header, only rows counted in `num_rows` are committed, `start`, `end` and
+#                            `num_shards` record the passage range of the worker the rows belong to
+
+
+def get_store_prefix(save_dir: str, worker_idx: int) -> str:
+    return '{}/embeds_{}'.format(save_dir, worker_idx)
+
+
+def get_all_store_prefixes(save_dir: str) -> List[str]:
+    path_list = glob.glob('{}/embeds_*.json'.format(save_dir))
+    prefix_list = [path[:-len('.json')] for path in path_list]
+    return sorted(prefix_list, key=lambda prefix: int(prefix.split('_')[-1]))
+
+
+def _load_header(prefix: str) -> dict:
+    header_path = '{}.json'.format(prefix)
+    if not os.path.exists(header_path):
+        return {}
+    return json.load(open(header_path, 'r', encoding='utf-8'))
+
+
+class EmbedStoreWriter:
+
+    def __init__(self, prefix: str, start: int, end: int, num_shards: int):
+        self.prefix = prefix
+        self.header = _load_header(prefix)
+        self.num_rows = self.header.get('num_rows', 0)
+
+        shard = {'start': start, 'end': end, 'num_shards': num_shards}
+        if self.num_rows > 0:
+            # committed rows can only be resumed with the passage range they were encoded for
+            committed_shard = {key: self.header.get(key) for key in shard}
+            assert committed_shard == shard, '{} was written for shard {}, not {}'.format(prefix, committed_shard, shard)
+        else:
+            self.header = shard
+
+        # drop any partially written slab left behind by an interrupted run
+        for suffix in ['bin', 'ids']:
+            path = '{}.{}'.format(prefix, suffix)
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            elif self.num_rows == 0:
+                os.truncate(path, 0)
+        if self.num_rows > 0:
+            row_bytes = self.header['dim'] * np.dtype(self.header['dtype']).itemsize
+            os.truncate('{}.bin'.format(prefix), self.num_rows * row_bytes)
+            os.truncate('{}.ids'.format(prefix), self.num_rows * np.dtype(np.int64).itemsize)
+            logger.info('Resume {} from {} committed rows'.format(prefix, self.num_rows))
+
+        self.embed_writer = open('{}.bin'.format(prefix), 'ab')
+        self.id_writer = open('{}.ids'.format(prefix), 'ab')
+
+    def append(self, embeds: torch.Tensor, ids: np.ndarray):
+        assert embeds.shape[0] == ids.shape[0], '{} != {}'.format(embeds.shape[0], ids.shape[0])
+        embeds = embeds.detach().cpu().contiguous().numpy()
+        if 'dim' not in self.header:
+            self.header.update({'dim': embeds.shape[1], 'dtype': embeds.dtype.name})
+        assert embeds.shape[1] == self.header['dim']
+        assert embeds.dtype.name == self.header['dtype'], '{} != {}'.format(embeds.dtype.name, self.header['dtype'])
+
+        for writer, array in [(self.embed_writer, embeds), (self.id_writer, ids.astype(np.int64))]:
+            writer.write(array.tobytes())
+            writer.flush()
+            os.fsync(writer.fileno())
+
+        # commit the slab only after its data hit the disk
+        self.num_rows += embeds.shape[0]
+        self.header['num_rows'] = self.num_rows
+        tmp_path = '{}.json.tmp'.format(self.prefix)
+        with open(tmp_path, 'w', encoding='utf-8') as writer:
+            json.dump(self.header, writer)
+        os.replace(tmp_path, '{}.json'.format(self.prefix))
+
+    def close(self):
+        self.embed_writer.close()
+        self.id_writer.close()
+
+
+class EmbedStore:
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        header = _load_header(prefix)
+        assert header, 'No embedding store found at {}'.format(prefix)
+        self.num_rows, self.dim = header['num_rows'], header['dim']
+
+        # zero-copy views, pages are only read when a slab gets moved to the device
+        self.embeds = torch.from_file('{}.bin'.format(prefix), shared=False,
+                                      size=self.num_rows * self.dim,
+                                      dtype=getattr(torch, header['dtype'])).view(self.num_rows, self.dim)
+        self.ids = np.memmap('{}.ids'.format(prefix), dtype=np.int64, mode='r', shape=(self.num_rows,))
+
+    def __len__(self):
+        return self.num_rows
+
+    def iter_slabs(self, slab_size: int) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        for start in range(0, self.num_rows, slab_size):
+            end = min(start + slab_size, self.num_rows)
+            yield self.embeds[start:end], torch.from_numpy(np.array(self.ids[start:end]))
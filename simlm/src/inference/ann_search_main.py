@@ -0,0 +1,146 @@
+import json
+import os
+import time
+import tqdm
+import torch
+import numpy as np
+
+from contextlib import nullcontext
+from torch.utils.data import DataLoader
+from functools import partial
+from datasets import Dataset
+from typing import Dict, List, Tuple
+from transformers.file_utils import PaddingStrategy
+from transformers import (
+    AutoTokenizer,
+    PreTrainedTokenizerFast,
+    DataCollatorWithPadding,
+    HfArgumentParser,
+    BatchEncoding
+)
+
+from config import Arguments
+from logger_config import logger
+from utils import move_to_cuda, save_json_to_file
+from embed_store import get_all_store_prefixes
+from ann_index import get_ann_index_path, build_ivfpq_index, save_index, load_index, ann_search, exact_search, compute_recall
+from metrics import compute_mrr, trec_eval, ScoredDoc
+from data_utils import load_queries, load_qrels, save_preds_to_msmarco_format
+from models import BiencoderModelForInference, BiencoderOutput
+
+parser = HfArgumentParser((Arguments,))
+args: Arguments = parser.parse_args_into_dataclasses()[0]
+assert os.path.exists(args.encode_save_dir)
+
+
+def _query_transform_func(tokenizer: PreTrainedTokenizerFast,
+                          examples: Dict[str, List]) -> BatchEncoding:
+    batch_dict = tokenizer(examples['query'],
+                           max_length=args.q_max_len,
+                           padding=PaddingStrategy.DO_NOT_PAD,
+                           truncation=True)
+
+    return batch_dict
+
+
+@torch.no_grad()
+def _encode_queries() -> Tuple[np.ndarray, List[str]]:
+    query_id_to_text = load_queries(path=os.path.join(args.data_dir, '{}_queries.tsv'.format(args.search_split)),
+                                    task_type=args.task_type)
+    query_ids = sorted(list(query_id_to_text.keys()))
+    dataset = Dataset.from_dict({'query_id': query_ids,
+                                 'query': [query_id_to_text[query_id] for query_id in query_ids]})
+
+    use_cuda = torch.cuda.is_available()
+    tokenizer: PreTrainedTokenizerFast = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    model: BiencoderModelForInference = BiencoderModelForInference.build(args)
+    model.eval()
+    if use_cuda:
+        model.cuda()
+
+    dataset.set_transform(partial(_query_transform_func, tokenizer))
+
+    data_collator = DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8)
+    data_loader = DataLoader(
+        dataset,
+        batch_size=512,
+        shuffle=False,
+        drop_last=False,
+        num_workers=args.dataloader_num_workers,
+        collate_fn=data_collator,
+        pin_memory=use_cuda)
+
+    encoded_embeds = []
+    for batch_dict in tqdm.tqdm(data_loader, desc='query encoding', mininterval=5):
+        if use_cuda:
+            batch_dict = move_to_cuda(batch_dict)
+
+        with torch.cuda.amp.autocast() if args.fp16 and use_cuda else nullcontext():
+            outputs: BiencoderOutput = model(query=batch_dict, passage=None)
+        encoded_embeds.append(outputs.q_reps.float().cpu().numpy())
+
+    return np.concatenate(encoded_embeds, axis=0), query_ids
+
+
+def _save_preds_and_metrics(query_ids: List[str], scores: np.ndarray, indices: np.ndarray):
+    preds: Dict[str, List[ScoredDoc]] = {}
+    for query_id, cur_scores, cur_indices in zip(query_ids, scores.tolist(), indices.tolist()):
+        # faiss pads with -1 when fewer than topk candidates are found in the probed lists
+        preds[query_id] = [ScoredDoc(qid=query_id, pid=str(doc_id), rank=rank + 1, score=score)
+                           for rank, (score, doc_id) in enumerate(zip(cur_scores, cur_indices)) if doc_id >= 0]
+    out_path = os.path.join(args.search_out_dir, '{}.ann.msmarco.txt'.format(args.search_split))
+    save_preds_to_msmarco_format(preds, out_path)
+
+    path_qrels = os.path.join(args.data_dir, '{}_qrels.txt'.format(args.search_split))
+    if os.path.exists(path_qrels):
+        qrels = load_qrels(path=path_qrels)
+        all_metrics = trec_eval(qrels=qrels, predictions=preds)
+        all_metrics['mrr'] = compute_mrr(qrels=qrels, predictions=preds)
+
+        logger.info('{} trec metrics = {}'.format(args.search_split, json.dumps(all_metrics, ensure_ascii=False, indent=4)))
+        save_json_to_file(all_metrics, os.path.join(args.search_out_dir, 'metrics_ann_{}.json'.format(args.search_split)))
+    else:
+        logger.warning('No qrels found for {}'.format(args.search_split))
+
+
+def _ann_search_queries():
+    logger.info('Args={}'.format(str(args)))
+    store_prefix_list = get_all_store_prefixes(args.encode_save_dir)
+    assert len(store_prefix_list) > 0
+
+    index_path = get_ann_index_path(args)
+    if os.path.exists(index_path):
+        index = load_index(index_path)
+    else:
+        index = build_ivfpq_index(store_prefix_list,
+                                  nlist=args.ann_nlist,
+                                  pq_m=args.ann_pq_m,
+                                  train_size=args.ann_train_size,
+                                  slab_size=args.encode_shard_size)
+        save_index(index, index_path)
+
+    query_embeds, query_ids = _encode_queries()
+
+    start_time = time.time()
+    scores, indices = ann_search(index, query_embeds, topk=args.search_topk, nprobe=args.ann_nprobe)
+    latency_ms = (time.time() - start_time) * 1000 / len(query_ids)
+    logger.info('Search {} queries with nprobe={}: {:.2f} ms per query'.format(len(query_ids), args.ann_nprobe, latency_ms))
+    _save_preds_and_metrics(query_ids, scores, indices)
+
+    # recall of the approximate top-k against brute force search on a subset of queries
+    num_eval = min(args.ann_recall_num_queries, len(query_ids))
+    if num_eval > 0:
+        _, exact_indices = exact_search(store_prefix_list, query_embeds[:num_eval], topk=args.search_topk)
+        report = {'nprobe': args.ann_nprobe,
+                  'ms_per_query': round(latency_ms, 3),
+                  'num_queries': num_eval}
+        for k in sorted({1, 10, 100, args.search_topk}):
+            if k <= args.search_topk:
+                report['recall@{}'.format(k)] = round(compute_recall(indices[:num_eval], exact_indices, k=k), 4)
+        logger.info('Recall vs exact search: {}'.format(json.dumps(report, indent=4)))
+        save_json_to_file(report, os.path.join(args.search_out_dir,
+                                                'ann_recall_{}_nprobe{}.json'.format(args.search_split, args.ann_nprobe)))
+
+
+if __name__ == '__main__':
+    _ann_search_queries()
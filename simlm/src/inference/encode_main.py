@@ -1,12 +1,13 @@
 import os
 import tqdm
 import torch
+import numpy as np
 
 from contextlib import nullcontext
 from torch.utils.data import DataLoader
 from functools import partial
 from datasets import load_dataset
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from transformers.file_utils import PaddingStrategy
 from transformers import (
     AutoTokenizer,
@@ -19,6 +20,7 @@ from transformers import (
 from config import Arguments
 from logger_config import logger
 from utils import move_to_cuda
+from embed_store import EmbedStoreWriter, get_store_prefix
 from models import BiencoderModelForInference, BiencoderOutput
 
 parser = HfArgumentParser((Arguments,))
@@ -39,23 +41,33 @@ def _psg_transform_func(tokenizer: PreTrainedTokenizerFast,
     return batch_dict
 
 
+def _get_contiguous_shard_range(num_examples: int, shard_idx: int) -> Tuple[int, int]:
+    # same split as Dataset.shard(contiguous=True), but keeps track of the global passage index
+    num_shards = torch.cuda.device_count()
+    div, mod = num_examples // num_shards, num_examples % num_shards
+    start = div * shard_idx + min(shard_idx, mod)
+    end = start + div + (1 if shard_idx < mod else 0)
+    return start, end
+
+
 @torch.no_grad()
 def _worker_encode_passages(gpu_idx: int):
-    def _get_out_path(shard_idx: int = 0) -> str:
-        return '{}/shard_{}_{}'.format(args.encode_save_dir, gpu_idx, shard_idx)
-
-    if os.path.exists(_get_out_path(0)):
-        logger.error('{} already exists, will skip encoding'.format(_get_out_path(0)))
-        return
+    store_prefix = get_store_prefix(args.encode_save_dir, gpu_idx)
 
     dataset = load_dataset('json', data_files=args.encode_in_path)['train']
     if args.dry_run:
         dataset = dataset.select(range(4096))
-    dataset = dataset.shard(num_shards=torch.cuda.device_count(),
-                            index=gpu_idx,
-                            contiguous=True)
 
-    logger.info('GPU {} needs to process {} examples'.format(gpu_idx, len(dataset)))
+    start, end = _get_contiguous_shard_range(len(dataset), gpu_idx)
+    writer = EmbedStoreWriter(store_prefix, start=start, end=end, num_shards=torch.cuda.device_count())
+    num_committed = writer.num_rows
+    if start + num_committed >= end:
+        logger.error('{} already contains {} embeddings, will skip encoding'.format(store_prefix, num_committed))
+        writer.close()
+        return
+    dataset = dataset.select(range(start + num_committed, end))
+
+    logger.info('GPU {} needs to process {} examples, {} already encoded'.format(gpu_idx, len(dataset), num_committed))
     torch.cuda.set_device(gpu_idx)
 
     tokenizer: PreTrainedTokenizerFast = AutoTokenizer.from_pretrained(args.model_name_or_path)
@@ -75,7 +87,16 @@ def _worker_encode_passages(gpu_idx: int):
         collate_fn=data_collator,
         pin_memory=True)
 
-    num_encoded_docs, encoded_embeds, cur_shard_idx = 0, [], 0
+    next_psg_idx = start + num_committed
+    num_encoded_docs, encoded_embeds = 0, []
+
+    def _flush():
+        concat_embeds = torch.cat(encoded_embeds, dim=0)
+        logger.info('GPU {} save {} embeds to {}'.format(gpu_idx, concat_embeds.shape[0], store_prefix))
+        writer.append(concat_embeds, np.arange(next_psg_idx, next_psg_idx + concat_embeds.shape[0]))
+        encoded_embeds.clear()
+        return next_psg_idx + concat_embeds.shape[0]
+
     for batch_dict in tqdm.tqdm(data_loader, desc='passage encoding', mininterval=8):
         batch_dict = move_to_cuda(batch_dict)
 
@@ -85,20 +106,13 @@ def _worker_encode_passages(gpu_idx: int):
         num_encoded_docs += outputs.p_reps.shape[0]
 
         if num_encoded_docs >= args.encode_shard_size:
-            out_path = _get_out_path(cur_shard_idx)
-            concat_embeds = torch.cat(encoded_embeds, dim=0)
-            logger.info('GPU {} save {} embeds to {}'.format(gpu_idx, concat_embeds.shape[0], out_path))
-            torch.save(concat_embeds, out_path)
-
-            cur_shard_idx += 1
+            next_psg_idx = _flush()
             num_encoded_docs = 0
-            encoded_embeds.clear()
 
     if num_encoded_docs > 0:
-        out_path = _get_out_path(cur_shard_idx)
-        concat_embeds = torch.cat(encoded_embeds, dim=0)
-        logger.info('GPU {} save {} embeds to {}'.format(gpu_idx, concat_embeds.shape[0], out_path))
-        torch.save(concat_embeds, out_path)
+        next_psg_idx = _flush()
+    writer.close()
+    assert next_psg_idx == end, '{} != {}'.format(next_psg_idx, end)
 
     logger.info('Done computing score for worker {}'.format(gpu_idx))
 
@@ -0,0 +1,250 @@
+import json
+import os
+import time
+import queue
+import threading
+import torch
+import numpy as np
+
+from contextlib import nullcontext
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.request import urlopen, Request
+from typing import Dict, List, Tuple, Optional
+from transformers import (
+    AutoTokenizer,
+    PreTrainedTokenizerFast,
+    HfArgumentParser
+)
+
+from config import Arguments
+from logger_config import logger
+from utils import move_to_cuda, save_json_to_file
+from ann_index import get_ann_index_path, load_index, ann_search
+from data_utils import load_queries
+from models import BiencoderModelForInference, BiencoderOutput
+
+parser = HfArgumentParser((Arguments,))
+args: Arguments = parser.parse_args_into_dataclasses()[0]
+
+
+class _PendingQuery:
+
+    def __init__(self, query: str):
+        self.query = query
+        self.input_ids: List[int] = []
+        self.arrival_time = time.time()
+        self.done = threading.Event()
+        self.result: List[Tuple[int, float]] = []
+        self.error: Optional[Exception] = None
+
+
+class DynamicBatchSearcher:
+    """ Coalesces concurrent single-query requests into batches under a latency budget,
+    encodes them bucketed by token length and searches the IVF-PQ index directly.
+    """
+
+    def __init__(self, model: BiencoderModelForInference,
+                 tokenizer: PreTrainedTokenizerFast,
+                 index,
+                 max_batch_size: int,
+                 max_wait_ms: float,
+                 q_max_len: int,
+                 topk: int,
+                 nprobe: int,
+                 fp16: bool = False,
+                 bucket_width: int = 8):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.index = index
+        self.max_batch_size = max_batch_size
+        self.max_wait_secs = max_wait_ms / 1000
+        self.q_max_len = q_max_len
+        self.topk = topk
+        self.nprobe = nprobe
+        self.fp16 = fp16
+        self.bucket_width = bucket_width
+        self.use_cuda = next(model.parameters()).is_cuda
+
+        self.pending: queue.Queue = queue.Queue()
+        self.num_batches, self.num_queries, self.num_padding_tokens, self.num_tokens = 0, 0, 0, 0
+        self.worker = threading.Thread(target=self._loop, daemon=True)
+        self.worker.start()
+
+    def search(self, query: str) -> List[Tuple[int, float]]:
+        pending_query = _PendingQuery(query)
+        self.pending.put(pending_query)
+        pending_query.done.wait()
+        if pending_query.error is not None:
+            raise pending_query.error
+        return pending_query.result
+
+    def _collect(self) -> List[_PendingQuery]:
+        batch = [self.pending.get()]
+        deadline = batch[0].arrival_time + self.max_wait_secs
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            # fast tokenizers are not thread-safe with truncation, so tokenize here instead of on the request threads
+            try:
+                batch_input_ids = self.tokenizer([pending_query.query for pending_query in batch],
+                                                 max_length=self.q_max_len, truncation=True)['input_ids']
+            except Exception as e:
+                logger.error('Failed to tokenize {} queries: {}'.format(len(batch), e))
+                self._finish(batch, error=e)
+                continue
+
+            buckets: Dict[int, List[_PendingQuery]] = defaultdict(list)
+            for pending_query, input_ids in zip(batch, batch_input_ids):
+                pending_query.input_ids = input_ids
+                buckets[(len(input_ids) - 1) // self.bucket_width].append(pending_query)
+
+            for bucket in buckets.values():
+                try:
+                    self._search_bucket(bucket)
+                except Exception as e:
+                    logger.error('Failed to process {} queries: {}'.format(len(bucket), e))
+                    self._finish(bucket, error=e)
+                    continue
+                self._finish(bucket)
+
+    @staticmethod
+    def _finish(pending_queries: List[_PendingQuery], error: Optional[Exception] = None):
+        for pending_query in pending_queries:
+            pending_query.error = error
+            pending_query.done.set()
+
+    @torch.no_grad()
+    def _search_bucket(self, bucket: List[_PendingQuery]):
+        max_len = max(len(pending_query.input_ids) for pending_query in bucket)
+        input_ids = torch.full((len(bucket), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(bucket), max_len), dtype=torch.long)
+        for idx, pending_query in enumerate(bucket):
+            input_ids[idx, :len(pending_query.input_ids)] = torch.tensor(pending_query.input_ids)
+            attention_mask[idx, :len(pending_query.input_ids)] = 1
+        batch_dict = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if 'token_type_ids' in self.tokenizer.model_input_names:
+            batch_dict['token_type_ids'] = torch.zeros_like(input_ids)
+        if self.use_cuda:
+            batch_dict = move_to_cuda(batch_dict)
+
+        with torch.cuda.amp.autocast() if self.fp16 and self.use_cuda else nullcontext():
+            outputs: BiencoderOutput = self.model(query=batch_dict, passage=None)
+        scores, indices = ann_search(self.index, outputs.q_reps.float().cpu().numpy(),
+                                     topk=self.topk, nprobe=self.nprobe)
+
+        for pending_query, cur_scores, cur_indices in zip(bucket, scores.tolist(), indices.tolist()):
+            pending_query.result = [(doc_id, score) for doc_id, score in zip(cur_indices, cur_scores) if doc_id >= 0]
+
+        self.num_batches += 1
+        self.num_queries += len(bucket)
+        self.num_tokens += input_ids.numel()
+        self.num_padding_tokens += input_ids.numel() - int(attention_mask.sum())
+
+
+def _build_handler(searcher: DynamicBatchSearcher):
+
+    class _Handler(BaseHTTPRequestHandler):
+        # POST /search with {"query": "..."}, returns {"doc_ids": [...], "scores": [...]}
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            try:
+                result = searcher.search(json.loads(body)['query'])
+            except Exception as e:
+                self.send_error(500, explain=str(e))
+                return
+            response = json.dumps({'doc_ids': [doc_id for doc_id, _ in result],
+                                   'scores': [round(score, 4) for _, score in result]}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, format, *log_args):
+            pass
+
+    return _Handler
+
+
+def _benchmark(searcher: DynamicBatchSearcher, port: int):
+    query_id_to_text = load_queries(path=os.path.join(args.data_dir, '{}_queries.tsv'.format(args.search_split)),
+                                    task_type=args.task_type)
+    queries = list(query_id_to_text.values())
+
+    def _client(client_idx: int, num_clients: int, latencies: List[float]):
+        for query in queries[client_idx::num_clients]:
+            start_time = time.time()
+            request = Request('http://127.0.0.1:{}/search'.format(port),
+                              data=json.dumps({'query': query}).encode('utf-8'),
+                              headers={'Content-Type': 'application/json'})
+            urlopen(request).read()
+            latencies.append(time.time() - start_time)
+
+    reports = []
+    for num_clients in args.serve_benchmark_concurrency:
+        searcher.num_batches, searcher.num_queries, searcher.num_padding_tokens, searcher.num_tokens = 0, 0, 0, 0
+        latencies: List[float] = []
+        clients = [threading.Thread(target=_client, args=(idx, num_clients, latencies)) for idx in range(num_clients)]
+        start_time = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.time() - start_time
+
+        latencies_ms = np.array(latencies) * 1000
+        report = {'concurrency': num_clients,
+                  'queries_per_second': round(len(latencies) / elapsed, 2),
+                  'p50_ms': round(float(np.percentile(latencies_ms, 50)), 2),
+                  'p99_ms': round(float(np.percentile(latencies_ms, 99)), 2),
+                  'avg_batch_size': round(searcher.num_queries / max(1, searcher.num_batches), 2),
+                  'padding_ratio': round(searcher.num_padding_tokens / max(1, searcher.num_tokens), 4)}
+        logger.info('Benchmark: {}'.format(json.dumps(report)))
+        reports.append(report)
+
+    save_json_to_file(reports, os.path.join(args.search_out_dir, 'serve_benchmark_{}.json'.format(args.search_split)))
+
+
+def _serve():
+    logger.info('Args={}'.format(str(args)))
+    tokenizer: PreTrainedTokenizerFast = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    model: BiencoderModelForInference = BiencoderModelForInference.build(args)
+    model.eval()
+    if torch.cuda.is_available():
+        model.cuda()
+
+    index = load_index(get_ann_index_path(args))
+    searcher = DynamicBatchSearcher(model, tokenizer, index,
+                                    max_batch_size=args.serve_max_batch_size,
+                                    max_wait_ms=args.serve_max_wait_ms,
+                                    q_max_len=args.q_max_len,
+                                    topk=args.search_topk,
+                                    nprobe=args.ann_nprobe,
+                                    fp16=args.fp16)
+
+    server = ThreadingHTTPServer(('127.0.0.1' if args.serve_benchmark else '0.0.0.0', args.serve_port),
+                                 _build_handler(searcher))
+    if not args.serve_benchmark:
+        logger.info('Serving on port {}'.format(args.serve_port))
+        server.serve_forever()
+        return
+
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    _benchmark(searcher, port=args.serve_port)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    _serve()
@@ -1,18 +1,20 @@
 import os
+import glob
+import hashlib
 import tqdm
 import torch
 
 from contextlib import nullcontext
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset as TorchDataset
 from functools import partial
 from datasets import Dataset
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from transformers.file_utils import PaddingStrategy
 from transformers.modeling_outputs import SequenceClassifierOutput
 from transformers import (
+    AutoConfig,
     AutoTokenizer,
     PreTrainedTokenizerFast,
-    DataCollatorWithPadding,
     HfArgumentParser,
     BatchEncoding
 )
@@ -52,27 +54,116 @@ def _rerank_transform_func(tokenizer: PreTrainedTokenizerFast,
     return batch_dict
 
 
+def _resolve_hub_weights(model_name_or_path: str) -> List[str]:
+    # for transformers versions without `_commit_hash`, such as the pinned 4.15.0
+    from transformers.file_utils import WEIGHTS_NAME, cached_path, hf_bucket_url
+    return [cached_path(hf_bucket_url(model_name_or_path, filename=WEIGHTS_NAME))]
+
+
+def _get_model_hash() -> str:
+    # scores depend on the weights and on how inputs are truncated
+    if os.path.isdir(args.model_name_or_path):
+        hasher = hashlib.sha1('{}_{}'.format(args.rerank_max_length, os.path.basename(args.model_name_or_path)).encode('utf-8'))
+        weight_paths = sorted(glob.glob(os.path.join(args.model_name_or_path, '*.bin'))
+                              + glob.glob(os.path.join(args.model_name_or_path, '*.safetensors')))
+    else:
+        # hub model: the full name and the resolved revision identify the weights
+        revision = getattr(AutoConfig.from_pretrained(args.model_name_or_path), '_commit_hash', None)
+        if revision:
+            key = '{}_{}@{}'.format(args.rerank_max_length, args.model_name_or_path, revision)
+            return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        # no revision available, hash the weights as resolved in the local cache instead
+        hasher = hashlib.sha1('{}_{}'.format(args.rerank_max_length, args.model_name_or_path).encode('utf-8'))
+        weight_paths = _resolve_hub_weights(args.model_name_or_path)
+
+    for path in weight_paths:
+        with open(path, 'rb') as reader:
+            for chunk in iter(lambda: reader.read(1 << 24), b''):
+                hasher.update(chunk)
+    return hasher.hexdigest()[:16]
+
+
+def _load_score_cache(cache_dir: str) -> Dict[Tuple[str, str], float]:
+    # (qid, pid) -> score, written by all workers of previous runs with the same model
+    qid_pid_to_score = {}
+    for path in glob.glob('{}/scores_*.tsv'.format(cache_dir)):
+        for line in open(path, 'r', encoding='utf-8'):
+            fs = line.strip().split('\t')
+            # skip a partially written last line
+            if len(fs) == 3:
+                qid_pid_to_score[(fs[0], fs[1])] = float(fs[2])
+    logger.info('Load {} cached scores from {}'.format(len(qid_pid_to_score), cache_dir))
+    return qid_pid_to_score
+
+
+class _QueryGroupDataset(TorchDataset):
+    # each item is a group of (qid, pid) pairs from whole queries, batched in the collate function
+
+    def __init__(self, qid_pid_groups: List[List[Tuple[str, str]]]):
+        self.qid_pid_groups = qid_pid_groups
+
+    def __len__(self):
+        return len(self.qid_pid_groups)
+
+    def __getitem__(self, idx: int) -> List[Tuple[str, str]]:
+        return self.qid_pid_groups[idx]
+
+
+def _rerank_collate_func(tokenizer: PreTrainedTokenizerFast,
+                         corpus: Dataset,
+                         queries: Dict[str, str],
+                         groups: List[List[Tuple[str, str]]]) -> List[Tuple[List[Tuple[str, str]], BatchEncoding]]:
+    assert len(groups) == 1
+    qid_pid = groups[0]
+    batch_dict = _rerank_transform_func(tokenizer, corpus, queries,
+                                        {'query_id': [t[0] for t in qid_pid], 'doc_id': [t[1] for t in qid_pid]})
+
+    # sort by length so that each batch has little padding
+    sorted_indices = sorted(range(len(qid_pid)), key=lambda idx: len(batch_dict['input_ids'][idx]))
+    batches = []
+    for start in range(0, len(sorted_indices), args.rerank_batch_size):
+        batch_indices = sorted_indices[start:(start + args.rerank_batch_size)]
+        features = [{k: batch_dict[k][idx] for k in batch_dict} for idx in batch_indices]
+        batches.append(([qid_pid[idx] for idx in batch_indices],
+                        tokenizer.pad(features,
+                                      pad_to_multiple_of=8 if args.fp16 else None,
+                                      return_tensors='pt')))
+    return batches
+
+
 @torch.no_grad()
 def _worker_compute_reranker_score(gpu_idx: int):
     preds = load_msmarco_predictions(args.rerank_in_path)
     query_ids = sorted(list(preds.keys()))
-    qid_pid = []
-    for query_id in tqdm.tqdm(query_ids, desc='load qid-pid', mininterval=2):
-        qid_pid += [(scored_doc.qid, scored_doc.pid) for scored_doc in preds[query_id]
-                    if scored_doc.rank <= args.rerank_depth]
-
-    dataset = Dataset.from_dict({'query_id': [t[0] for t in qid_pid],
-                                 'doc_id': [t[1] for t in qid_pid]})
-    dataset = dataset.shard(num_shards=torch.cuda.device_count(),
-                            index=gpu_idx,
-                            contiguous=True)
-
-    logger.info('GPU {} needs to process {} examples'.format(gpu_idx, len(dataset)))
+    # shard by query so that a worker sees all the passages of its queries
+    query_ids = query_ids[gpu_idx::torch.cuda.device_count()]
+    query_id_to_pids = {query_id: [scored_doc.pid for scored_doc in preds[query_id]
+                                   if scored_doc.rank <= args.rerank_depth]
+                        for query_id in query_ids}
+
+    qid_pid_to_score: Dict[Tuple[str, str], float] = {}
+    cache_writer = None
+    if args.rerank_cache_dir:
+        cache_dir = os.path.join(args.rerank_cache_dir, _get_model_hash())
+        os.makedirs(cache_dir, exist_ok=True)
+        qid_pid_to_score = _load_score_cache(cache_dir)
+        cache_writer = open('{}/scores_{}.tsv'.format(cache_dir, gpu_idx), 'a', encoding='utf-8')
+
+    # group whole queries until there are enough uncached pairs for a few batches
+    qid_pid_groups, cur_group, num_pairs = [], [], 0
+    for query_id in query_ids:
+        cur_group += [(query_id, pid) for pid in query_id_to_pids[query_id] if (query_id, pid) not in qid_pid_to_score]
+        if len(cur_group) >= args.rerank_batch_size * 16:
+            qid_pid_groups.append(cur_group)
+            num_pairs += len(cur_group)
+            cur_group = []
+    if cur_group:
+        qid_pid_groups.append(cur_group)
+        num_pairs += len(cur_group)
+
+    logger.info('GPU {} needs to process {} queries, {} uncached pairs'.format(gpu_idx, len(query_ids), num_pairs))
     torch.cuda.set_device(gpu_idx)
 
-    query_ids, doc_ids = dataset['query_id'], dataset['doc_id']
-    assert len(dataset) == len(query_ids)
-
     tokenizer: PreTrainedTokenizerFast = AutoTokenizer.from_pretrained(args.model_name_or_path)
     model: RerankerForInference = RerankerForInference.from_pretrained(args.model_name_or_path)
     model.eval()
@@ -81,35 +172,56 @@ def _worker_compute_reranker_score(gpu_idx: int):
     corpus: Dataset = load_corpus(path=os.path.join(args.data_dir, 'passages.jsonl.gz'))
     queries = load_queries(path='{}/{}_queries.tsv'.format(args.data_dir, args.rerank_split),
                            task_type=args.task_type)
-    dataset.set_transform(partial(_rerank_transform_func, tokenizer, corpus, queries))
 
-    data_collator = DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8 if args.fp16 else None)
     data_loader = DataLoader(
-        dataset,
-        batch_size=args.rerank_batch_size,
+        _QueryGroupDataset(qid_pid_groups),
+        batch_size=1,
         shuffle=False,
         drop_last=False,
         num_workers=args.dataloader_num_workers,
-        collate_fn=data_collator,
+        collate_fn=partial(_rerank_collate_func, tokenizer, corpus, queries),
         pin_memory=True)
 
-    scores = []
-    for batch_dict in tqdm.tqdm(data_loader, desc='passage rerank', mininterval=5):
-        batch_dict = move_to_cuda(batch_dict)
-
-        with torch.cuda.amp.autocast() if args.fp16 else nullcontext():
-            outputs: SequenceClassifierOutput = model(batch_dict)
-        scores.append(outputs.logits.squeeze(dim=-1).cpu())
-        assert len(scores[-1].shape) == 1
-
-    all_scores = torch.cat(scores, dim=-1)
-    assert all_scores.shape[0] == len(query_ids), '{} != {}'.format(all_scores.shape[0], len(query_ids))
-    all_scores = all_scores.tolist()
-
-    with open(get_rerank_shard_path(args, gpu_idx), 'w', encoding='utf-8') as writer:
-        for idx in range(len(query_ids)):
-            # dummy rank, since a query may be split across different workers
-            writer.write('{}\t{}\t{}\t{}\n'.format(query_ids[idx], doc_ids[idx], -1, round(all_scores[idx], 5)))
+    writer = open(get_rerank_shard_path(args, gpu_idx), 'w', encoding='utf-8')
+    num_written_queries = 0
+
+    def _write_completed_queries():
+        # a query is complete once all of its passages have a score
+        nonlocal num_written_queries
+        while num_written_queries < len(query_ids):
+            query_id = query_ids[num_written_queries]
+            pids = query_id_to_pids[query_id]
+            if not all((query_id, pid) in qid_pid_to_score for pid in pids):
+                break
+            for pid in pids:
+                # dummy rank, rank is assigned after merging
+                writer.write('{}\t{}\t{}\t{}\n'.format(query_id, pid, -1, round(qid_pid_to_score[(query_id, pid)], 5)))
+            num_written_queries += 1
+        writer.flush()
+
+    _write_completed_queries()
+    for batches in tqdm.tqdm(data_loader, desc='passage rerank', mininterval=5):
+        for batch_qid_pid, batch_dict in batches:
+            batch_dict = move_to_cuda(batch_dict)
+
+            with torch.cuda.amp.autocast() if args.fp16 else nullcontext():
+                outputs: SequenceClassifierOutput = model(batch_dict)
+            batch_scores = outputs.logits.squeeze(dim=-1).cpu().tolist()
+            assert len(batch_scores) == len(batch_qid_pid)
+
+            for (query_id, pid), score in zip(batch_qid_pid, batch_scores):
+                qid_pid_to_score[(query_id, pid)] = score
+                if cache_writer is not None:
+                    cache_writer.write('{}\t{}\t{}\n'.format(query_id, pid, score))
+
+        if cache_writer is not None:
+            cache_writer.flush()
+        _write_completed_queries()
+
+    assert num_written_queries == len(query_ids), '{} != {}'.format(num_written_queries, len(query_ids))
+    writer.close()
+    if cache_writer is not None:
+        cache_writer.close()
 
     logger.info('Done computing rerank score for worker {}'.format(gpu_idx))
 
@@ -1,13 +1,11 @@
 import json
 import os
-import glob
 import tqdm
 import torch
 
 from contextlib import nullcontext
 from torch.utils.data import DataLoader
 from functools import partial
-from collections import defaultdict
 from datasets import Dataset
 from typing import Dict, List, Tuple
 from transformers.file_utils import PaddingStrategy
@@ -22,6 +20,7 @@ from transformers import (
 from config import Arguments
 from logger_config import logger
 from utils import move_to_cuda, save_json_to_file
+from embed_store import EmbedStore, get_all_store_prefixes
 from metrics import compute_mrr, trec_eval, ScoredDoc
 from data_utils import load_queries, load_qrels, load_msmarco_predictions, save_preds_to_msmarco_format
 from models import BiencoderModelForInference, BiencoderOutput
@@ -31,17 +30,11 @@ args: Arguments = parser.parse_args_into_dataclasses()[0]
 assert os.path.exists(args.encode_save_dir)
 
 
-def _get_all_shards_path() -> List[str]:
-    path_list = glob.glob('{}/shard_*_*'.format(args.encode_save_dir))
-    assert len(path_list) > 0
-
-    def _parse_worker_idx_shard_idx(p: str) -> Tuple:
-        worker_idx, shard_idx = [int(f) for f in os.path.basename(p).split('_')[-2:]]
-        return worker_idx, shard_idx
-
-    path_list = sorted(path_list, key=lambda path: _parse_worker_idx_shard_idx(path))
-    logger.info('Embeddings path list: {}'.format(path_list))
-    return path_list
+def _get_all_store_prefixes() -> List[str]:
+    prefix_list = get_all_store_prefixes(args.encode_save_dir)
+    assert len(prefix_list) > 0
+    logger.info('Embedding store list: {}'.format(prefix_list))
+    return prefix_list
 
 
 def _get_topk_result_save_path(worker_idx: int) -> str:
@@ -60,8 +53,8 @@ def _query_transform_func(tokenizer: PreTrainedTokenizerFast,
 
 @torch.no_grad()
 def _worker_encode_queries(gpu_idx: int) -> Tuple:
-    # fail fast if shard does not exist
-    _get_all_shards_path()
+    # fail fast if embedding store does not exist
+    _get_all_store_prefixes()
 
     query_id_to_text = load_queries(path=os.path.join(args.data_dir, '{}_queries.tsv'.format(args.search_split)),
                                     task_type=args.task_type)
@@ -111,39 +104,57 @@ def _worker_encode_queries(gpu_idx: int) -> Tuple:
     return query_embeds, query_ids, query_id_to_text
 
 
+def _merge_topk_(topk_scores: torch.Tensor, topk_indices: torch.Tensor,
+                 new_scores: torch.Tensor, new_indices: torch.Tensor):
+    # in-place merge of (batch_size, k) running results with (batch_size, k') candidates
+    merged_scores = torch.cat([topk_scores, new_scores], dim=-1)
+    merged_indices = torch.cat([topk_indices, new_indices], dim=-1)
+    sorted_scores, sorted_pos = torch.topk(merged_scores, k=topk_scores.shape[-1], dim=-1, largest=True)
+    topk_scores.copy_(sorted_scores)
+    topk_indices.copy_(merged_indices.gather(dim=-1, index=sorted_pos))
+
+
 @torch.no_grad()
 def _worker_batch_search(gpu_idx: int):
-    embeds_path_list = _get_all_shards_path()
+    store_prefix_list = _get_all_store_prefixes()
 
     query_embeds, query_ids, query_id_to_text = _worker_encode_queries(gpu_idx)
     assert query_embeds.shape[0] == len(query_ids), '{} != {}'.format(query_embeds.shape[0], len(query_ids))
 
-    query_id_to_topk = defaultdict(list)
-    psg_idx_offset = 0
-    for shard_idx, shard_path in enumerate(embeds_path_list):
-        shard_psg_embed = torch.load(shard_path, map_location=lambda storage, loc: storage).to(query_embeds.device)
-        logger.info('Load {} passage embeddings from {}'.format(shard_psg_embed.shape[0], shard_path))
-
-        for start in tqdm.tqdm(range(0, len(query_ids), args.search_batch_size),
-                               desc="search shard {}".format(shard_idx),
-                               mininterval=5):
-            batch_query_embed = query_embeds[start:(start + args.search_batch_size)]
-            batch_query_ids = query_ids[start:(start + args.search_batch_size)]
-            batch_score = torch.mm(batch_query_embed, shard_psg_embed.t())
-            batch_sorted_score, batch_sorted_indices = torch.topk(batch_score, k=args.search_topk, dim=-1, largest=True)
-            for batch_idx, query_id in enumerate(batch_query_ids):
-                cur_scores = batch_sorted_score[batch_idx].cpu().tolist()
-                cur_indices = [idx + psg_idx_offset for idx in batch_sorted_indices[batch_idx].cpu().tolist()]
-                query_id_to_topk[query_id] += list(zip(cur_scores, cur_indices))
-                query_id_to_topk[query_id] = sorted(query_id_to_topk[query_id], key=lambda t: (-t[0], t[1]))
-                query_id_to_topk[query_id] = query_id_to_topk[query_id][:args.search_topk]
-
-        psg_idx_offset += shard_psg_embed.shape[0]
-
+    # running top-k kept on device, merged with each shard via a single topk over the concatenation
+    topk_scores = torch.full((len(query_ids), args.search_topk), float('-inf'),
+                             dtype=query_embeds.dtype, device=query_embeds.device)
+    topk_indices = torch.full((len(query_ids), args.search_topk), -1,
+                              dtype=torch.long, device=query_embeds.device)
+    slab_idx = 0
+    for store_prefix in store_prefix_list:
+        store = EmbedStore(store_prefix)
+        logger.info('Open {} passage embeddings from {}'.format(len(store), store_prefix))
+
+        for slab_psg_embed, slab_psg_ids in store.iter_slabs(slab_size=args.encode_shard_size):
+            slab_psg_embed = slab_psg_embed.to(query_embeds.device, dtype=query_embeds.dtype)
+            slab_psg_ids = slab_psg_ids.to(query_embeds.device)
+
+            slab_topk = min(args.search_topk, slab_psg_embed.shape[0])
+            for start in tqdm.tqdm(range(0, len(query_ids), args.search_batch_size),
+                                   desc="search slab {}".format(slab_idx),
+                                   mininterval=5):
+                end = start + args.search_batch_size
+                batch_query_embed = query_embeds[start:end]
+                batch_score = torch.mm(batch_query_embed, slab_psg_embed.t())
+                batch_sorted_score, batch_sorted_indices = torch.topk(batch_score, k=slab_topk, dim=-1, largest=True)
+                _merge_topk_(topk_scores[start:end], topk_indices[start:end],
+                             batch_sorted_score, slab_psg_ids[batch_sorted_indices])
+            slab_idx += 1
+
+    topk_scores, topk_indices = topk_scores.float().cpu().tolist(), topk_indices.cpu().tolist()
     out_path = _get_topk_result_save_path(worker_idx=gpu_idx)
     with open(out_path, 'w', encoding='utf-8') as writer:
-        for query_id in query_id_to_text:
-            for rank, (score, doc_id) in enumerate(query_id_to_topk[query_id]):
+        for query_id, cur_scores, cur_indices in zip(query_ids, topk_scores, topk_indices):
+            for rank, (score, doc_id) in enumerate(zip(cur_scores, cur_indices)):
+                # fewer passages than search_topk
+                if doc_id < 0:
+                    break
                 writer.write('{}\t{}\t{}\t{}\n'.format(query_id, doc_id, rank + 1, round(score, 4)))
 
     logger.info('Write scores to {} done'.format(out_path))
@@ -8,6 +8,7 @@ from transformers import PreTrainedTokenizerFast, Trainer
 
 from config import Arguments
 from logger_config import logger
+from corpus_store import TokenizedCorpus, load_or_compile_corpus, prepare_pair_inputs
 from .loader_utils import group_doc_ids
 
 
@@ -20,6 +21,10 @@ class RetrievalDataLoader:
         self.tokenizer = tokenizer
         corpus_path = os.path.join(args.data_dir, 'passages.jsonl.gz')
         self.corpus: Dataset = load_dataset('json', data_files=corpus_path)['train']
+        self.tokenized_corpus: Optional[TokenizedCorpus] = None
+        if args.use_tokenized_corpus:
+            with args.main_process_first(desc='compile corpus'):
+                self.tokenized_corpus = load_or_compile_corpus(self.corpus, corpus_path, tokenizer, args.p_max_len)
         self.train_dataset, self.eval_dataset = self._get_transformed_datasets()
 
         # use its state to decide which positives/negatives to sample
@@ -36,18 +41,26 @@ class RetrievalDataLoader:
         )
         assert len(input_doc_ids) == len(examples['query']) * self.args.train_n_passages
 
-        input_docs: List[str] = [self.corpus[doc_id]['contents'] for doc_id in input_doc_ids]
-        input_titles: List[str] = [self.corpus[doc_id]['title'] for doc_id in input_doc_ids]
-
         query_batch_dict = self.tokenizer(examples['query'],
                                           max_length=self.args.q_max_len,
                                           padding=PaddingStrategy.DO_NOT_PAD,
                                           truncation=True)
-        doc_batch_dict = self.tokenizer(input_titles,
-                                        text_pair=input_docs,
-                                        max_length=self.args.p_max_len,
-                                        padding=PaddingStrategy.DO_NOT_PAD,
-                                        truncation=True)
+        if self.tokenized_corpus is not None:
+            doc_batch_dict = prepare_pair_inputs(
+                self.tokenizer,
+                first_ids=[self.tokenized_corpus.get_title_ids(doc_id) for doc_id in input_doc_ids],
+                second_ids=[self.tokenized_corpus.get_contents_ids(doc_id) for doc_id in input_doc_ids],
+                max_length=self.args.p_max_len,
+                first_lens=[self.tokenized_corpus.get_title_len(doc_id) for doc_id in input_doc_ids],
+                second_lens=[self.tokenized_corpus.get_contents_len(doc_id) for doc_id in input_doc_ids])
+        else:
+            input_docs: List[str] = [self.corpus[doc_id]['contents'] for doc_id in input_doc_ids]
+            input_titles: List[str] = [self.corpus[doc_id]['title'] for doc_id in input_doc_ids]
+            doc_batch_dict = self.tokenizer(input_titles,
+                                            text_pair=input_docs,
+                                            max_length=self.args.p_max_len,
+                                            padding=PaddingStrategy.DO_NOT_PAD,
+                                            truncation=True)
 
         merged_dict = {'q_{}'.format(k): v for k, v in query_batch_dict.items()}
         step_size = self.args.train_n_passages
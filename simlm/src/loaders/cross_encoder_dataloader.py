@@ -8,6 +8,7 @@ from transformers import PreTrainedTokenizerFast, Trainer
 
 from config import Arguments
 from logger_config import logger
+from corpus_store import TokenizedCorpus, load_or_compile_corpus, prepare_pair_inputs
 from .loader_utils import group_doc_ids
 
 
@@ -20,6 +21,11 @@ class CrossEncoderDataLoader:
         self.tokenizer = tokenizer
         corpus_path = os.path.join(args.data_dir, 'passages.jsonl.gz')
         self.corpus: Dataset = load_dataset('json', data_files=corpus_path)['train']
+        self.tokenized_corpus: Optional[TokenizedCorpus] = None
+        if args.use_tokenized_corpus:
+            with args.main_process_first(desc='compile corpus'):
+                self.tokenized_corpus = load_or_compile_corpus(self.corpus, corpus_path, tokenizer, args.rerank_max_length)
+            self.title_sep_ids: List[int] = tokenizer(': ', add_special_tokens=False)['input_ids']
         self.train_dataset, self.eval_dataset = self._get_transformed_datasets()
 
         # use its state to decide which positives/negatives to sample
@@ -36,20 +42,23 @@ class CrossEncoderDataLoader:
         )
         assert len(input_doc_ids) == len(examples['query']) * self.args.train_n_passages
 
-        input_queries, input_docs = [], []
-        for idx, doc_id in enumerate(input_doc_ids):
-            prefix = ''
-            if self.corpus[doc_id].get('title', ''):
-                prefix = self.corpus[doc_id]['title'] + ': '
+        if self.tokenized_corpus is not None:
+            batch_dict = self._prepare_tokenized_inputs(examples['query'], input_doc_ids)
+        else:
+            input_queries, input_docs = [], []
+            for idx, doc_id in enumerate(input_doc_ids):
+                prefix = ''
+                if self.corpus[doc_id].get('title', ''):
+                    prefix = self.corpus[doc_id]['title'] + ': '
 
-            input_docs.append(prefix + self.corpus[doc_id]['contents'])
-            input_queries.append(examples['query'][idx // self.args.train_n_passages])
+                input_docs.append(prefix + self.corpus[doc_id]['contents'])
+                input_queries.append(examples['query'][idx // self.args.train_n_passages])
 
-        batch_dict = self.tokenizer(input_queries,
-                                    text_pair=input_docs,
-                                    max_length=self.args.rerank_max_length,
-                                    padding=PaddingStrategy.DO_NOT_PAD,
-                                    truncation=True)
+            batch_dict = self.tokenizer(input_queries,
+                                        text_pair=input_docs,
+                                        max_length=self.args.rerank_max_length,
+                                        padding=PaddingStrategy.DO_NOT_PAD,
+                                        truncation=True)
 
         packed_batch_dict = {}
         for k in batch_dict:
@@ -61,6 +70,28 @@ class CrossEncoderDataLoader:
 
         return packed_batch_dict
 
+    def _prepare_tokenized_inputs(self, queries: List[str], input_doc_ids: List[int]) -> Dict[str, List]:
+        query_ids: List[List[int]] = self.tokenizer(queries, add_special_tokens=False)['input_ids']
+
+        input_query_ids, input_doc_token_ids, input_doc_lens = [], [], []
+        for idx, doc_id in enumerate(input_doc_ids):
+            title_len = self.tokenized_corpus.get_title_len(doc_id)
+            doc_len = self.tokenized_corpus.get_contents_len(doc_id)
+            prefix_ids = []
+            if title_len > 0:
+                prefix_ids = self.tokenized_corpus.get_title_ids(doc_id) + self.title_sep_ids
+                doc_len += title_len + len(self.title_sep_ids)
+
+            input_doc_token_ids.append(prefix_ids + self.tokenized_corpus.get_contents_ids(doc_id))
+            input_doc_lens.append(doc_len)
+            input_query_ids.append(query_ids[idx // self.args.train_n_passages])
+
+        return prepare_pair_inputs(self.tokenizer,
+                                   first_ids=input_query_ids,
+                                   second_ids=input_doc_token_ids,
+                                   max_length=self.args.rerank_max_length,
+                                   second_lens=input_doc_lens)
+
     def _get_transformed_datasets(self) -> Tuple:
         data_files = {}
         if self.args.train_file is not None:
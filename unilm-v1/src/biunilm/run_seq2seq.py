@@ -190,6 +190,8 @@ def main():
                         help='the max size of ngram mask')
     parser.add_argument('--mask_whole_word', action='store_true',
                         help="Whether masking a whole word.")
+    parser.add_argument('--batch_masking', action='store_true',
+                        help="Mask the whole batch at once in the collate function instead of per example.")
     parser.add_argument('--do_l2r_training', action='store_true',
                         help="Whether to do left to right training")
     parser.add_argument('--has_sentence_oracle', action='store_true',
@@ -273,7 +275,7 @@ def main():
     if args.do_train:
         print("Loading Train Dataset", args.data_dir)
         bi_uni_pipeline = [seq2seq_loader.Preprocess4Seq2seq(args.max_pred, args.mask_prob, list(tokenizer.vocab.keys(
-        )), tokenizer.convert_tokens_to_ids, args.max_seq_length, new_segment_ids=args.new_segment_ids, truncate_config={'max_len_a': args.max_len_a, 'max_len_b': args.max_len_b, 'trunc_seg': args.trunc_seg, 'always_truncate_tail': args.always_truncate_tail}, mask_source_words=args.mask_source_words, skipgram_prb=args.skipgram_prb, skipgram_size=args.skipgram_size, mask_whole_word=args.mask_whole_word, mode="s2s", has_oracle=args.has_sentence_oracle, num_qkv=args.num_qkv, s2s_special_token=args.s2s_special_token, s2s_add_segment=args.s2s_add_segment, s2s_share_segment=args.s2s_share_segment, pos_shift=args.pos_shift)]
+        )), tokenizer.convert_tokens_to_ids, args.max_seq_length, new_segment_ids=args.new_segment_ids, truncate_config={'max_len_a': args.max_len_a, 'max_len_b': args.max_len_b, 'trunc_seg': args.trunc_seg, 'always_truncate_tail': args.always_truncate_tail}, mask_source_words=args.mask_source_words, skipgram_prb=args.skipgram_prb, skipgram_size=args.skipgram_size, mask_whole_word=args.mask_whole_word, mode="s2s", has_oracle=args.has_sentence_oracle, num_qkv=args.num_qkv, s2s_special_token=args.s2s_special_token, s2s_add_segment=args.s2s_add_segment, s2s_share_segment=args.s2s_share_segment, pos_shift=args.pos_shift, batch_masking=args.batch_masking and not args.pos_shift)]
         file_oracle = None
         if args.has_sentence_oracle:
             file_oracle = os.path.join(args.data_dir, 'train.oracle')
@@ -289,8 +291,13 @@ def main():
         else:
             train_sampler = DistributedSampler(train_dataset)
             _batch_size = args.train_batch_size // dist.get_world_size()
+        if args.batch_masking and not args.pos_shift:
+            collate_fn = seq2seq_loader.BatchMasker4Seq2seq(args.max_pred, list(tokenizer.vocab.keys()), tokenizer.convert_tokens_to_ids, skipgram_prb=args.skipgram_prb,
+                                                            skipgram_size=args.skipgram_size, mask_whole_word=args.mask_whole_word, mask_source_words=args.mask_source_words)
+        else:
+            collate_fn = seq2seq_loader.batch_list_to_batch_tensors
         train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=_batch_size, sampler=train_sampler,
-                                                       num_workers=args.num_workers, collate_fn=seq2seq_loader.batch_list_to_batch_tensors, pin_memory=False)
+                                                       num_workers=args.num_workers, collate_fn=collate_fn, pin_memory=False)
 
     # note: args.train_batch_size has been changed to (/= args.gradient_accumulation_steps)
     # t_total = int(math.ceil(len(train_dataset.ex_list) / args.train_batch_size)
@@ -428,8 +435,8 @@ def main():
                 else:
                     input_ids, segment_ids, input_mask, mask_qkv, lm_label_ids, masked_pos, masked_weights, is_next, task_idx = batch
                     oracle_pos, oracle_weights, oracle_labels = None, None, None
-                loss_tuple = model(input_ids, segment_ids, input_mask, lm_label_ids, is_next, masked_pos=masked_pos, masked_weights=masked_weights, task_idx=task_idx, masked_pos_2=oracle_pos, masked_weights_2=oracle_weights,
-                                   masked_labels_2=oracle_labels, mask_qkv=mask_qkv)
+                loss_tuple = model(input_ids, segment_ids, None, lm_label_ids, is_next, masked_pos=masked_pos, masked_weights=masked_weights, task_idx=task_idx, masked_pos_2=oracle_pos, masked_weights_2=oracle_weights,
+                                   masked_labels_2=oracle_labels, mask_qkv=mask_qkv, attention_mask_spec=input_mask)
                 masked_lm_loss, next_sentence_loss = loss_tuple
                 if n_gpu > 1:    # mean() to average on multi-gpu.
                     # loss = loss.mean()
@@ -1,6 +1,8 @@
 from random import randint, shuffle, choice
 from random import random as rand
+import os
 import math
+import numpy as np
 import torch
 
 from biunilm.loader_utils import get_random_word, batch_list_to_batch_tensors, Pipeline
@@ -51,6 +53,15 @@ def truncate_tokens_pair(tokens_a, tokens_b, max_len, max_len_a=0, max_len_b=0,
     return num_truncated_a, num_truncated_b
 
 
+def get_seq2seq_attention_mask_spec(src_end, tgt_start, tgt_end, causal_src=False):
+    """ Compact form of a seq2seq attention mask, collated as a [batch_size, 4] LongTensor
+    instead of a dense max_len x max_len mask per example.
+    Query i attends key j if j < src_end (and j <= i when causal_src),
+    or if tgt_start <= j <= i < tgt_end.
+    The dense mask is built by `expand_seq2seq_attention_mask` in pytorch_pretrained_bert.modeling. """
+    return [src_end, tgt_start, tgt_end, int(causal_src)]
+
+
 class Seq2SeqDataset(torch.utils.data.Dataset):
     """ Load sentence pair (sequential or random order) from corpus """
 
@@ -108,7 +119,7 @@ class Seq2SeqDataset(torch.utils.data.Dataset):
 class Preprocess4Seq2seq(Pipeline):
     """ Pre-processing steps for pretraining transformer """
 
-    def __init__(self, max_pred, mask_prob, vocab_words, indexer, max_len=512, skipgram_prb=0, skipgram_size=0, block_mask=False, mask_whole_word=False, new_segment_ids=False, truncate_config={}, mask_source_words=False, mode="s2s", has_oracle=False, num_qkv=0, s2s_special_token=False, s2s_add_segment=False, s2s_share_segment=False, pos_shift=False):
+    def __init__(self, max_pred, mask_prob, vocab_words, indexer, max_len=512, skipgram_prb=0, skipgram_size=0, block_mask=False, mask_whole_word=False, new_segment_ids=False, truncate_config={}, mask_source_words=False, mode="s2s", has_oracle=False, num_qkv=0, s2s_special_token=False, s2s_add_segment=False, s2s_share_segment=False, pos_shift=False, batch_masking=False):
         super().__init__()
         self.max_len = max_len
         self.max_pred = max_pred  # max tokens of prediction
@@ -116,8 +127,6 @@ class Preprocess4Seq2seq(Pipeline):
         self.vocab_words = vocab_words  # vocabulary (sub)words
         self.indexer = indexer  # function from token to token index
         self.max_len = max_len
-        self._tril_matrix = torch.tril(torch.ones(
-            (max_len, max_len), dtype=torch.long))
         self.skipgram_prb = skipgram_prb
         self.skipgram_size = skipgram_size
         self.mask_whole_word = mask_whole_word
@@ -137,9 +146,12 @@ class Preprocess4Seq2seq(Pipeline):
         self.s2s_add_segment = s2s_add_segment
         self.s2s_share_segment = s2s_share_segment
         self.pos_shift = pos_shift
+        # leave the masking to BatchMasker4Seq2seq in the collate function
+        self.batch_masking = batch_masking
 
     def __call__(self, instance):
         tokens_a, tokens_b = instance[:2]
+        masking_spec = None
 
         if self.pos_shift:
             tokens_b = ['[S2S_SOS]'] + tokens_b
@@ -177,6 +189,15 @@ class Preprocess4Seq2seq(Pipeline):
             masked_pos = [len(tokens_a)+2+i for i in range(len(tokens_b))]
             masked_weights = [1]*n_pred
             masked_ids = self.indexer(tokens_b[1:]+['[SEP]'])
+        elif self.batch_masking:
+            effective_length = len(tokens_b)
+            if self.mask_source_words:
+                effective_length += len(tokens_a)
+            n_pred = min(self.max_pred, max(
+                1, int(round(effective_length*self.mask_prob))))
+            # positions are sampled for the whole batch by BatchMasker4Seq2seq
+            masked_ids, masked_pos, masked_weights = None, None, None
+            masking_spec = [len(tokens_a)+2, len(tokens), n_pred]
         else:
             # For masked Language Models
             # the number of prediction is sometimes less than max_pred when sequence is short
@@ -266,16 +287,13 @@ class Preprocess4Seq2seq(Pipeline):
         else:
             mask_qkv = None
 
-        input_mask = torch.zeros(self.max_len, self.max_len, dtype=torch.long)
+        # compact attention mask, expanded on device by the model (see get_seq2seq_attention_mask_spec)
         if self.mode == "s2s":
-            input_mask[:, :len(tokens_a)+2].fill_(1)
-            second_st, second_end = len(
-                tokens_a)+2, len(tokens_a)+len(tokens_b)+3
-            input_mask[second_st:second_end, second_st:second_end].copy_(
-                self._tril_matrix[:second_end-second_st, :second_end-second_st])
+            input_mask = get_seq2seq_attention_mask_spec(
+                len(tokens_a)+2, len(tokens_a)+2, len(tokens_a)+len(tokens_b)+3)
         else:
-            st, end = 0, len(tokens_a) + len(tokens_b) + 3
-            input_mask[st:end, st:end].copy_(self._tril_matrix[:end, :end])
+            input_mask = get_seq2seq_attention_mask_spec(
+                0, 0, len(tokens_a)+len(tokens_b)+3)
 
         # Zero Padding for masked target
         if self.max_pred > n_pred:
@@ -286,6 +304,8 @@ class Preprocess4Seq2seq(Pipeline):
                 masked_pos.extend([0]*n_pad)
             if masked_weights is not None:
                 masked_weights.extend([0]*n_pad)
+        if masking_spec is not None:
+            masked_pos = masking_spec
 
         oracle_pos = None
         oracle_weights = None
@@ -315,6 +335,124 @@ class Preprocess4Seq2seq(Pipeline):
         return (input_ids, segment_ids, input_mask, mask_qkv, masked_ids, masked_pos, masked_weights, -1, self.task_idx)
 
 
+class BatchMasker4Seq2seq(object):
+    """ Collate function that samples the masked positions of a whole batch at once,
+    used with Preprocess4Seq2seq(batch_masking=True).
+
+    Same sampling as Preprocess4Seq2seq: candidates are visited in a random order and
+    each unmasked candidate adds a span (an n-gram with skipgram_prb, optionally expanded
+    to whole words) until n_pred positions are masked. All examples of the batch take
+    their next candidate together, so the loop runs over candidates instead of tokens.
+    """
+
+    def __init__(self, max_pred, vocab_words, indexer, skipgram_prb=0, skipgram_size=0, mask_whole_word=False, mask_source_words=False):
+        self.max_pred = max_pred
+        self.skipgram_prb = skipgram_prb if skipgram_size >= 2 else 0
+        self.skipgram_size = skipgram_size
+        self.mask_whole_word = mask_whole_word
+        self.mask_source_words = mask_source_words
+        self.mask_id = indexer(['[MASK]'])[0]
+        # token id -> token properties, "##" marks the continuation of a word
+        self.vocab_ids = np.array(indexer(vocab_words), dtype=np.int64)
+        vocab_size = int(self.vocab_ids.max()) + 1
+        self.is_subword = np.zeros(vocab_size, dtype=bool)
+        self.is_cls = np.zeros(vocab_size, dtype=bool)
+        self.is_sep = np.zeros(vocab_size, dtype=bool)
+        for w, i in zip(vocab_words, self.vocab_ids):
+            self.is_subword[i] = w.startswith('##')
+            self.is_cls[i] = (w == '[CLS]')
+            self.is_sep[i] = w.startswith('[SEP')
+        self._rng, self._rng_pid = None, None
+
+    def _get_rng(self):
+        # seeded from `random`, which is reseeded in every data loader worker
+        if self._rng_pid != os.getpid():
+            self._rng = np.random.RandomState(randint(0, 2**32-1))
+            self._rng_pid = os.getpid()
+        return self._rng
+
+    def __call__(self, batch):
+        batch_tensors = batch_list_to_batch_tensors(batch)
+        input_ids = batch_tensors[0].numpy()
+        masked_ids, masked_pos, masked_weights = self.mask(
+            input_ids, batch_tensors[5].numpy())
+        batch_tensors[4] = torch.from_numpy(masked_ids)
+        batch_tensors[5] = torch.from_numpy(masked_pos)
+        batch_tensors[6] = torch.from_numpy(masked_weights)
+        return batch_tensors
+
+    def mask(self, input_ids, masking_spec):
+        """ Masks `input_ids` [batch_size, seq_len] in place, `masking_spec` [batch_size, 3] holds
+        the target start, the sequence length and n_pred of each example.
+        Returns masked_ids, masked_pos and masked_weights of shape [batch_size, max_pred]. """
+        rng = self._get_rng()
+        batch_size, seq_len = input_ids.shape
+        tgt_start, seq_end, n_pred = masking_spec[:, 0:1], masking_spec[:, 1:2], masking_spec[:, 2]
+        idx = np.arange(seq_len)[None, :]
+        rows = np.arange(batch_size)[:, None]
+
+        # only mask tokens_b (target sequence), we will mask [SEP] as an ending symbol
+        is_cand = (idx >= tgt_start) & (idx < seq_end) & ~self.is_cls[input_ids]
+        if self.mask_source_words:
+            is_cand |= (idx < tgt_start) & ~self.is_cls[input_ids] & ~self.is_sep[input_ids]
+        num_cand = is_cand.sum(1)
+        # candidates in a random visiting order, followed by the other positions
+        cand_order = np.argsort(np.where(is_cand, rng.random_sample(input_ids.shape), 2.0), axis=1)
+
+        # span [span_st, span_end) added by each candidate, cut before the first position that cannot be masked
+        span_st = cand_order
+        span_end = cand_order + 1
+        if self.skipgram_prb > 0:
+            is_ngram = rng.random_sample(input_ids.shape) < self.skipgram_prb
+            span_end[is_ngram] += rng.randint(1, self.skipgram_size, size=int(is_ngram.sum()))
+        if self.mask_whole_word:
+            # first token of the word at each position, first word boundary at or after each position
+            is_subword = self.is_subword[input_ids]
+            word_st = np.maximum.accumulate(np.where(is_subword, -1, idx), axis=1)
+            word_end = np.minimum.accumulate(np.where(is_subword, seq_len, idx)[:, ::-1], axis=1)[:, ::-1]
+            span_st = word_st[rows, cand_order]
+            span_end = np.where(span_end < seq_len, word_end[rows, np.minimum(span_end, seq_len - 1)], span_end)
+        can_mask = is_cand & (idx > 0)
+        next_invalid = np.minimum.accumulate(np.where(can_mask, seq_len, idx)[:, ::-1], axis=1)[:, ::-1]
+        span_end = np.where(span_st >= 0, np.minimum(span_end, next_invalid[rows, np.maximum(span_st, 0)]), span_st)
+
+        # the spans are added in order, skipping candidates that are already masked, until n_pred positions are masked
+        masked = np.zeros(input_ids.shape, dtype=bool)
+        num_masked = np.zeros(batch_size, dtype=np.int64)
+        offsets = np.arange(max(1, int((span_end - span_st).max())))[None, :]
+        for step in range(int(num_cand.max())):
+            active = (step < num_cand) & (num_masked < n_pred)
+            if not active.any():
+                break
+            active &= ~masked[rows[:, 0], cand_order[:, step]]
+            span_pos = span_st[:, step:step+1] + offsets
+            new = (span_pos < span_end[:, step:step+1]) & active[:, None]
+            span_pos = np.clip(span_pos, 0, seq_len - 1)
+            new &= ~masked[rows, span_pos]
+            masked[np.nonzero(new)[0], span_pos[new]] = True
+            num_masked += new.sum(1)
+
+        # keep a random subset of n_pred positions if the last span went over
+        for i in np.nonzero(num_masked > n_pred)[0]:
+            pos = np.nonzero(masked[i])[0]
+            masked[i, rng.choice(pos, len(pos) - n_pred[i], replace=False)] = False
+        num_masked = np.minimum(num_masked, n_pred)
+
+        masked_weights = (np.arange(self.max_pred)[None, :] < num_masked[:, None]).astype(np.int64)
+        masked_pos = np.zeros((batch_size, self.max_pred), dtype=np.int64)
+        masked_rows, masked_cols = np.nonzero(masked)
+        masked_pos[masked_rows, np.arange(len(masked_rows)) - np.repeat(np.cumsum(num_masked) - num_masked, num_masked)] = masked_cols
+        masked_ids = input_ids[rows, masked_pos] * masked_weights
+
+        # 80% [MASK], 10% random word, 10% unchanged
+        rand_mask, rand_word = rng.random_sample(input_ids.shape), rng.random_sample(input_ids.shape)
+        to_mask = masked & (rand_mask < 0.8)
+        to_random = masked & (rand_mask >= 0.8) & (rand_word < 0.5)
+        input_ids[to_mask] = self.mask_id
+        input_ids[to_random] = self.vocab_ids[rng.randint(0, len(self.vocab_ids), size=int(to_random.sum()))]
+        return masked_ids, masked_pos, masked_weights
+
+
 class Preprocess4Seq2seqDecoder(Pipeline):
     """ Pre-processing steps for pretraining transformer """
 
@@ -324,8 +462,6 @@ class Preprocess4Seq2seqDecoder(Pipeline):
         self.vocab_words = vocab_words  # vocabulary (sub)words
         self.indexer = indexer  # function from token to token index
         self.max_len = max_len
-        self._tril_matrix = torch.tril(torch.ones(
-            (max_len, max_len), dtype=torch.long))
         self.new_segment_ids = new_segment_ids
         self.task_idx = 3   # relax projection layer for different tasks
         assert mode in ("s2s", "l2r")
@@ -389,19 +525,8 @@ class Preprocess4Seq2seqDecoder(Pipeline):
         # Token Indexing
         input_ids = self.indexer(tokens)
 
-        # Zero Padding
-        input_mask = torch.zeros(
-            max_len_in_batch, max_len_in_batch, dtype=torch.long)
-        if self.mode == "s2s":
-            input_mask[:, :len(tokens_a)+2].fill_(1)
-        else:
-            st, end = 0, len(tokens_a) + 2
-            input_mask[st:end, st:end].copy_(
-                self._tril_matrix[:end, :end])
-            input_mask[end:, :len(tokens_a)+2].fill_(1)
-        second_st, second_end = len(padded_tokens_a), max_len_in_batch
-
-        input_mask[second_st:second_end, second_st:second_end].copy_(
-            self._tril_matrix[:second_end-second_st, :second_end-second_st])
+        # the padding between the source and the target is never attended
+        input_mask = get_seq2seq_attention_mask_spec(
+            len(tokens_a)+2, len(padded_tokens_a), max_len_in_batch, causal_src=self.mode != "s2s")
 
         return (input_ids, segment_ids, position_ids, input_mask, mask_qkv, self.task_idx)
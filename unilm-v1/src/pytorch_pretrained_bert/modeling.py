@@ -54,6 +54,20 @@ def swish(x):
 ACT2FN = {"gelu": gelu, "relu": torch.nn.functional.relu, "swish": swish}
 
 
+def expand_seq2seq_attention_mask(mask_spec, seq_len):
+    """Builds the [batch_size, seq_len, seq_len] attention mask from its compact form.
+        `mask_spec` is a [batch_size, 4] LongTensor of (src_end, tgt_start, tgt_end, causal_src),
+        see biunilm.seq2seq_loader.get_seq2seq_attention_mask_spec.
+    """
+    index = torch.arange(seq_len, device=mask_spec.device)
+    row, col = index.view(1, -1, 1), index.view(1, 1, -1)
+    src_end, tgt_start, tgt_end, causal_src = [
+        x.view(-1, 1, 1) for x in mask_spec.unbind(dim=-1)]
+    src_mask = (col < src_end) & ((causal_src == 0) | (col <= row))
+    tgt_mask = (col >= tgt_start) & (col <= row) & (row < tgt_end)
+    return (src_mask | tgt_mask).long()
+
+
 class BertConfig(object):
     """Configuration class to store the configuration of a `BertModel`.
     """
@@ -1209,7 +1223,10 @@ class BertForPreTrainingLossMask(PreTrainedBertModel):
                 next_sentence_label=None, masked_pos=None, masked_weights=None, task_idx=None, pair_x=None,
                 pair_x_mask=None, pair_y=None, pair_y_mask=None, pair_r=None, pair_pos_neg_mask=None,
                 pair_loss_mask=None, masked_pos_2=None, masked_weights_2=None, masked_labels_2=None,
-                num_tokens_a=None, num_tokens_b=None, mask_qkv=None):
+                num_tokens_a=None, num_tokens_b=None, mask_qkv=None, attention_mask_spec=None):
+        if attention_mask_spec is not None:
+            attention_mask = expand_seq2seq_attention_mask(
+                attention_mask_spec, input_ids.size(1))
         if token_type_ids is None and attention_mask is None:
             task_0 = (task_idx == 0)
             task_1 = (task_idx == 1)
@@ -1399,7 +1416,10 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
         self.mode = mode
         self.pos_shift = pos_shift
 
-    def forward(self, input_ids, token_type_ids, position_ids, attention_mask, task_idx=None, mask_qkv=None):
+    def forward(self, input_ids, token_type_ids, position_ids, attention_mask, task_idx=None, mask_qkv=None, attention_mask_spec=None):
+        if attention_mask_spec is not None:
+            attention_mask = expand_seq2seq_attention_mask(
+                attention_mask_spec, token_type_ids.size(1))
         if self.search_beam_size > 1:
             return self.beam_search(input_ids, token_type_ids, position_ids, attention_mask, task_idx=task_idx, mask_qkv=mask_qkv)
 
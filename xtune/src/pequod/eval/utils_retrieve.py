@@ -29,6 +29,25 @@ def knn(x, y, k, use_gpu, dist='cosine'):
   return knnGPU(x, y, k) if use_gpu else knnCPU(x, y, k, dist)
 
 
+def merge_topk(sims, inds, k):
+  """Keeps the k largest of the concatenated per-chunk candidates of each row, sorted.
+
+  Rows with fewer than k candidates are padded with -inf / -1, as faiss pads its results.
+  """
+  sims = np.concatenate(sims, axis=1)
+  inds = np.concatenate(inds, axis=1)
+  if sims.shape[1] < k:
+    pad = k - sims.shape[1]
+    sims = np.concatenate([sims, np.full((sims.shape[0], pad), -np.inf, dtype=sims.dtype)], axis=1)
+    inds = np.concatenate([inds, np.full((inds.shape[0], pad), -1, dtype=inds.dtype)], axis=1)
+  if sims.shape[1] > k:
+    part = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    sims = np.take_along_axis(sims, part, axis=1)
+    inds = np.take_along_axis(inds, part, axis=1)
+  order = np.argsort(-sims, axis=1, kind='stable')
+  return np.take_along_axis(sims, order, axis=1), np.take_along_axis(inds, order, axis=1)
+
+
 def knnGPU(x, y, k, mem=5*1024*1024*1024):
   dim = x.shape[1]
   batch_size = mem // (dim*4)
@@ -47,28 +66,36 @@ def knnGPU(x, y, k, mem=5*1024*1024*1024):
       bsims.append(bsim)
       binds.append(bind + yfrom)
       del idx
-    bsims = np.concatenate(bsims, axis=1)
-    binds = np.concatenate(binds, axis=1)
-    aux = np.argsort(-bsims, axis=1)
-    for i in range(xfrom, xto):
-      for j in range(k):
-        sim[i, j] = bsims[i-xfrom, aux[i-xfrom, j]]
-        ind[i, j] = binds[i-xfrom, aux[i-xfrom, j]]
+    sim[xfrom:xto], ind[xfrom:xto] = merge_topk(bsims, binds, k)
   return sim, ind
 
 
-def knnCPU(x, y, k, dist='cosine'):
+def knnCPU(x, y, k, dist='cosine', mem=1024*1024*1024):
   # x: query, y: database
+  # the database is indexed in chunks of at most `mem` bytes and queries are
+  # searched in chunks whose (query, database chunk) distance block fits in `mem`
   dim = x.shape[1]
-  if dist == 'cosine':
-    idx = faiss.IndexFlatIP(dim)
-  else:
-    idx = faiss.IndexFlatL2(dim)
-  idx.add(y)
-  sim, ind = idx.search(x, k)
+  ybatch_size = max(1, mem // (dim*4))
+  xbatch_size = max(1, mem // (min(ybatch_size, y.shape[0])*4))
+  ychunks = []
+  for yfrom in range(0, y.shape[0], ybatch_size):
+    idx = faiss.IndexFlatIP(dim) if dist == 'cosine' else faiss.IndexFlatL2(dim)
+    idx.add(np.ascontiguousarray(y[yfrom:yfrom + ybatch_size]))
+    ychunks.append((yfrom, idx))
 
-  if dist != 'cosine':
-    sim = 1 / (1 + sim)
+  sim = np.zeros((x.shape[0], k), dtype=np.float32)
+  ind = np.zeros((x.shape[0], k), dtype=np.int64)
+  for xfrom in range(0, x.shape[0], xbatch_size):
+    xto = min(xfrom + xbatch_size, x.shape[0])
+    xchunk = np.ascontiguousarray(x[xfrom:xto])
+    bsims, binds = [], []
+    for yfrom, idx in ychunks:
+      bsim, bind = idx.search(xchunk, min(k, idx.ntotal))
+      if dist != 'cosine':
+        bsim = 1 / (1 + bsim)
+      bsims.append(bsim)
+      binds.append(bind + yfrom)
+    sim[xfrom:xto], ind[xfrom:xto] = merge_topk(bsims, binds, k)
   return sim, ind
 
 
@@ -81,13 +108,30 @@ def score(x, y, fwd_mean, bwd_mean, margin, dist='cosine'):
     return margin(sim, (fwd_mean + bwd_mean) / 2)
 
 
-def score_candidates(x, y, candidate_inds, fwd_mean, bwd_mean, margin, dist='cosine'):
+def score_pairs(x, y, fwd_mean, bwd_mean, margin, dist='cosine'):
+  """Row-wise version of `score`: x, y are (n, dim), fwd_mean, bwd_mean are (n,) or broadcastable."""
+  if dist == 'cosine':
+    sim = np.einsum('nd,nd->n', x, y)
+  else:
+    sim = 1 / (1 + ((x - y) ** 2).sum(axis=-1))
+  return margin(sim, (fwd_mean + bwd_mean) / 2)
+
+
+def score_candidates(x, y, candidate_inds, fwd_mean, bwd_mean, margin, dist='cosine', mem=1024*1024*1024):
   print(' - scoring {:d} candidates using {}'.format(x.shape[0], dist))
+  n, k = candidate_inds.shape
+  # gather the candidate embeddings of a block of rows at once, bounded by `mem` bytes
+  batch_size = max(1, mem // (k*x.shape[1]*4))
   scores = np.zeros(candidate_inds.shape)
-  for i in range(scores.shape[0]):
-    for j in range(scores.shape[1]):
-      k = candidate_inds[i, j]
-      scores[i, j] = score(x[i], y[k], fwd_mean[i], bwd_mean[k], margin, dist)
+  for start in range(0, n, batch_size):
+    end = min(start + batch_size, n)
+    cand = candidate_inds[start:end]
+    cand_y = y[cand]
+    if dist == 'cosine':
+      sim = np.einsum('nd,nkd->nk', x[start:end], cand_y)
+    else:
+      sim = 1 / (1 + ((x[start:end, None, :] - cand_y) ** 2).sum(axis=-1))
+    scores[start:end] = margin(sim, (fwd_mean[start:end, None] + bwd_mean[cand]) / 2)
   return scores
 
 
@@ -188,8 +232,10 @@ def mine_bitext(x, y, src_text_file, trg_text_file, output_file, mode='mine',
       print(trg_sents[best[i]], file=fout)
 
   elif mode == 'score':
-    for i, j in zip(src_inds, trg_inds):
-      s = score(x[i], y[j], x2y_mean[i], y2x_mean[j], margin)
+    num_pairs = min(len(src_inds), len(trg_inds))
+    src_inds, trg_inds = np.asarray(src_inds[:num_pairs]), np.asarray(trg_inds[:num_pairs])
+    scores = score_pairs(x[src_inds], y[trg_inds], x2y_mean[src_inds], y2x_mean[trg_inds], margin)
+    for s, i, j in zip(scores, src_inds, trg_inds):
       print(s, src_sents[i], trg_sents[j], sep='\t', file=fout)
 
   elif mode == 'mine':
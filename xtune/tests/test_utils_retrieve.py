@@ -0,0 +1,89 @@
+import unittest
+
+import numpy as np
+
+from src.pequod.eval.utils_retrieve import knnCPU, merge_topk, score, score_candidates, score_pairs
+
+MARGINS = {'ratio': lambda a, b: a / b, 'distance': lambda a, b: a - b}
+
+
+class KnnCPUTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.randn(7, 16).astype(np.float32)
+        self.y = rng.randn(20, 16).astype(np.float32)
+
+    def test_matches_brute_force(self):
+        # a small memory budget splits both the queries and the database into chunks
+        sim, ind = knnCPU(self.x, self.y, 5, mem=16 * 4 * 6)
+        expected = np.argsort(-self.x.dot(self.y.T), axis=1, kind='stable')[:, :5]
+        np.testing.assert_array_equal(ind, expected)
+        np.testing.assert_allclose(sim, np.take_along_axis(self.x.dot(self.y.T), expected, axis=1), rtol=1e-5)
+
+    def test_database_smaller_than_k(self):
+        for dist in ['cosine', 'l2']:
+            for mem in [1024 * 1024 * 1024, 16 * 4 * 2]:
+                sim, ind = knnCPU(self.x, self.y[:3], 5, dist=dist, mem=mem)
+                self.assertEqual(sim.shape, (7, 5))
+                self.assertEqual(ind.shape, (7, 5))
+                self.assertEqual(sorted(ind[0, :3].tolist()), [0, 1, 2])
+                self.assertTrue((ind[:, 3:] == -1).all())
+                self.assertTrue(np.isneginf(sim[:, 3:]).all())
+
+
+class MergeTopkTest(unittest.TestCase):
+
+    def test_merge(self):
+        sims = [np.array([[0.9, 0.1]]), np.array([[0.5, 0.7]])]
+        inds = [np.array([[0, 1]]), np.array([[2, 3]])]
+        sim, ind = merge_topk(sims, inds, 3)
+        np.testing.assert_array_equal(ind, [[0, 3, 2]])
+        np.testing.assert_allclose(sim, [[0.9, 0.7, 0.5]])
+
+    def test_pad(self):
+        sim, ind = merge_topk([np.array([[0.2]])], [np.array([[4]])], 3)
+        np.testing.assert_array_equal(ind, [[4, -1, -1]])
+        self.assertEqual(sim[0, 0], 0.2)
+        self.assertTrue(np.isneginf(sim[0, 1:]).all())
+
+
+class ScoreCandidatesTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.randn(9, 16).astype(np.float32)
+        self.y = rng.randn(13, 16).astype(np.float32)
+        self.candidate_inds = rng.randint(0, 13, size=(9, 4))
+        # positive means, as the averages of the kNN similarities are for the cosine margin
+        self.fwd_mean = rng.uniform(0.5, 1.5, size=9).astype(np.float32)
+        self.bwd_mean = rng.uniform(0.5, 1.5, size=13).astype(np.float32)
+
+    def test_matches_loop(self):
+        for margin_name, margin in MARGINS.items():
+            for dist in ['cosine', 'l2']:
+                expected = np.zeros(self.candidate_inds.shape)
+                for i in range(expected.shape[0]):
+                    for j in range(expected.shape[1]):
+                        k = self.candidate_inds[i, j]
+                        expected[i, j] = score(self.x[i], self.y[k], self.fwd_mean[i], self.bwd_mean[k], margin, dist)
+                # a small memory budget scores the rows in several blocks
+                for mem in [1024 * 1024 * 1024, 4 * 16 * 4 * 2]:
+                    scores = score_candidates(self.x, self.y, self.candidate_inds, self.fwd_mean, self.bwd_mean,
+                                              margin, dist=dist, mem=mem)
+                    np.testing.assert_allclose(scores, expected, rtol=1e-5, atol=1e-6,
+                                               err_msg='{} margin, {} dist'.format(margin_name, dist))
+
+    def test_score_pairs_matches_loop(self):
+        y = self.y[self.candidate_inds[:, 0]]
+        bwd_mean = self.bwd_mean[self.candidate_inds[:, 0]]
+        for margin in MARGINS.values():
+            for dist in ['cosine', 'l2']:
+                expected = [score(self.x[i], y[i], self.fwd_mean[i], bwd_mean[i], margin, dist)
+                            for i in range(self.x.shape[0])]
+                np.testing.assert_allclose(score_pairs(self.x, y, self.fwd_mean, bwd_mean, margin, dist),
+                                           expected, rtol=1e-5, atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()